@@ -3,6 +3,7 @@ import subprocess
 import logging
 import re
 from .adapter import Adapter
+from ..tracer import tracer, get_argv_class, DEVICE_CATEGORY
 import time
 try:
     from shlex import quote # Python 3
@@ -65,7 +66,11 @@ class ADB(Adapter):
 
         self.logger.debug('command:')
         self.logger.debug(args)
-        r = subprocess.check_output(args).strip()
+        if tracer.enabled:
+            with tracer.span("adb %s" % get_argv_class(extra_args), DEVICE_CATEGORY):
+                r = subprocess.check_output(args).strip()
+        else:
+            r = subprocess.check_output(args).strip()
         if not isinstance(r, str):
             r = r.decode()
         self.logger.debug('return:')
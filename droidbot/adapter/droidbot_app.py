@@ -6,6 +6,7 @@ import json
 import struct
 import traceback
 from .adapter import Adapter
+from ..tracer import tracer, traced
 
 DROIDBOT_APP_REMOTE_ADDR = "tcp:7336"
 DROIDBOT_APP_PACKAGE = "io.github.ylimit.droidbotapp"
@@ -223,6 +224,7 @@ class DroidBotAppConn(Adapter):
             children_ids.append(child_tree['temp_id'])
         view_tree['children'] = children_ids
 
+    @traced("layout receive")
     def get_views(self):
         get_views_times = 0
         while not self.last_acc_event:
@@ -243,7 +245,8 @@ class DroidBotAppConn(Adapter):
             return None
         view_tree['parent'] = -1
         view_list = []
-        self.__view_tree_to_list(view_tree, view_list)
+        with tracer.span("layout parse"):
+            self.__view_tree_to_list(view_tree, view_list)
         self.last_acc_event['view_list'] = view_list
         return view_list
 
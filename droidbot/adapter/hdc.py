@@ -8,6 +8,7 @@ import os
 import pathlib
 from typing import Dict
 from ..utils import get_yml_config
+from ..tracer import tracer, traced, get_argv_class, DEVICE_CATEGORY
 from .hmdriver import HmClient
 try:
     from shlex import quote # Python 3
@@ -103,7 +104,11 @@ class HDC(Adapter):
 
         self.logger.debug('Runing command:')
         self.logger.debug(" ".join([str(arg) for arg in args]))
-        r = subprocess.check_output(args).strip()
+        if tracer.enabled:
+            with tracer.span("hdc %s" % get_argv_class(extra_args), DEVICE_CATEGORY):
+                r = subprocess.check_output(args).strip()
+        else:
+            r = subprocess.check_output(args).strip()
         if not isinstance(r, str):
             r = r.decode()
         self.logger.debug('Return value:')
@@ -387,6 +392,7 @@ class Dumper:
 
         return view
     
+    @traced("layout parse")
     def transfer_views_to_android_style(self, views_raw: Dict):
         """
         bfs the view tree and turn it into the android style
@@ -457,6 +463,7 @@ class UitestDumper(Dumper):
         self.output_dir = output_dir
         self.hdc = hdc
 
+    @traced("layout receive")
     def dump_view(self)->str:
         """
         Using uitest to dumpLayout, and return the remote path of the layout file
@@ -500,6 +507,7 @@ class HmDriverDumper(Dumper):
             HmDriverDumper.device.start()
             HmDriverDumper._has_started = True
 
+    @traced("layout receive", DEVICE_CATEGORY)
     def _request_hierarchy(self):
         request_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
         params = {"api": "captureLayout", "args": []}
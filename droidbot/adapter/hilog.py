@@ -1,32 +1,128 @@
+import collections
+import itertools
 import subprocess
 import logging
 import threading
+import time
+from .adapter import Adapter
 from .hdc import HDC_EXEC, HDC
+from ..log_parser import LogBuffer, iter_log_blocks
 
-class Hilog:
-    def __init__(self, device=None):
+# Default number of recent lines kept in memory
+DEFAULT_MAX_RECENT_LINES = 20000
+# Size of the buffer of hilog.txt, and max number of seconds before the buffered lines are flushed
+HILOG_WRITE_BUFFER_SIZE = 256 * 1024
+HILOG_FLUSH_INTERVAL = 2
+# Max number of pids hilog filters on
+HILOG_MAX_FILTER_PIDS = 5
+# Length of the "MM-DD HH:MM:SS.mmm" time at the beginning of the lines
+HILOG_TIME_LENGTH = 18
+
+
+class Hilog(Adapter):
+    """
+    A connection with the target HarmonyOS device through hilog.
+    The output is read in blocks, the lines are kept in a bounded ring buffer,
+    each with a sequence number, and written to hilog.txt through a buffered file.
+    The parsed records are in log_buffer.
+    With filter_app, only the logs of the app and of keep_processes are read, filtered on the device.
+    """
+
+    def __init__(self, device=None, max_recent_lines=DEFAULT_MAX_RECENT_LINES):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.device = device
         self.connected = False
         self.process = None
-        self.recent_lines = []
+        self.listen_thread = None
+        self.lock = threading.Lock()
+        self.recent_lines = collections.deque(maxlen=max_recent_lines)
+        # the total number of lines read, i.e. the sequence number of the next line
+        self.num_lines = 0
+        self.last_read_seq = 0
+        self.log_buffer = LogBuffer()
+        # filters applied by hilog on the device
+        self.pids = None
+        self.domains = None
+        # the app whose logs are read, following its restarts, and the other processes whose logs are kept
+        self.app_package = None
+        self.keep_processes = set()
+        # after reconnecting, the lines hilog prints again from its buffer are skipped
+        self.skip_until_time = None
         if device.output_dir is None:
             self.out_file = None
         else:
             self.out_file = "%s/hilog.txt" % device.output_dir
-    
+
     def set_up(self):
         self.logger.info(f"[CONNECTION] Setting up Adapter hilog")
 
+    def get_hilog_cmd(self):
+        cmd = [HDC_EXEC, "-t", self.device.serial, "shell", "hilog"]
+        if self.pids:
+            cmd += ["-P", ",".join(str(pid) for pid in self.pids)]
+        if self.domains:
+            cmd += ["-D", ",".join(self.domains)]
+        return cmd
+
     def connect(self):
-        self.process = subprocess.Popen([HDC_EXEC, "shell", "hilog"],
+        self.process = subprocess.Popen(self.get_hilog_cmd(),
                                         stdin=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
                                         stdout=subprocess.PIPE)
         self.connected = True
-        listen_thread = threading.Thread(target=self.handle_output)
-        listen_thread.start()
-    
+        self.listen_thread = threading.Thread(target=self.handle_output, args=(self.process,), daemon=True)
+        self.listen_thread.start()
+
+    def set_filter(self, pids=None, domains=None):
+        """
+        only read the logs of some processes and/or of some domains, filtered on the device.
+        Reconnects if the filter changes while connected.
+        :param pids: list of at most HILOG_MAX_FILTER_PIDS pids, None for all processes
+        :param domains: list of hex domain ids (e.g. "0xD001100"), None for all domains
+        """
+        if pids == self.pids and domains == self.domains:
+            return
+        self.logger.info("Filtering hilog on pids %s and domains %s" % (pids, domains))
+        self.pids = pids
+        self.domains = domains
+        if self.connected:
+            self.disconnect()
+            last_lines = self.__get_lines_since(self.num_lines - 1)[0]
+            if last_lines:
+                self.skip_until_time = last_lines[-1][:HILOG_TIME_LENGTH]
+            self.connect()
+
+    def filter_app(self, package_name):
+        """
+        only read the logs of an app and of keep_processes, filtered on the device.
+        The filter follows the pid of the app when it is restarted.
+        :param package_name: the bundle name of the app
+        """
+        self.app_package = package_name
+        self.device.process_monitor.add_state_listener(self.on_processes_changed)
+        self.update_filter()
+
+    def on_processes_changed(self, started_pids, died_pids):
+        self.update_filter()
+
+    def update_filter(self):
+        """
+        filter on the current pids of the app and of keep_processes
+        """
+        if self.app_package is None:
+            return
+        process_monitor = self.device.process_monitor
+        pid = process_monitor.pid_of(self.app_package)
+        if pid is None:
+            # keep the filter until the app is started again
+            return
+        keep_pids = [process_monitor.pid_of(process) for process in sorted(self.keep_processes)]
+        pids = [pid] + [keep_pid for keep_pid in keep_pids if keep_pid is not None]
+        if len(pids) > HILOG_MAX_FILTER_PIDS:
+            self.logger.warning("hilog filters on %d pids at most, ignoring %s" % (HILOG_MAX_FILTER_PIDS,
+                                                                                  pids[HILOG_MAX_FILTER_PIDS:]))
+        self.set_filter(pids=pids[:HILOG_MAX_FILTER_PIDS], domains=self.domains)
+
     def check_connectivity(self):
         return self.connected
 
@@ -34,32 +130,87 @@ class Hilog:
         self.connected = False
         if self.process is not None:
             self.process.terminate()
+        if self.listen_thread is not None and self.listen_thread is not threading.current_thread():
+            self.listen_thread.join(timeout=5)
+            self.listen_thread = None
 
-    def handle_output(self):
+    def handle_output(self, process):
         f = None
         if self.out_file is not None:
-            f = open(self.out_file, 'w', encoding='utf-8')
-
-        while self.connected:
-            line = self.process.stdout.readline()
-            if not isinstance(line, str):
-                line = line.decode()
-            self.recent_lines.append(line)
-            self.parse_line(line)
+            f = open(self.out_file, 'ab', buffering=HILOG_WRITE_BUFFER_SIZE)
+        last_flush_time = time.time()
+
+        for data, lines in iter_log_blocks(process.stdout.fileno()):
+            if not self.connected:
+                break
+            if self.skip_until_time is not None:
+                lines = self.__skip_replayed_lines(lines)
+                data = self.__get_new_data(data, lines)
             if f is not None:
-                f.write(line)
+                f.write(data)
+                if time.time() - last_flush_time > HILOG_FLUSH_INTERVAL:
+                    f.flush()
+                    last_flush_time = time.time()
+            if lines:
+                self.add_lines(lines)
         if f is not None:
             f.close()
         self.logger.info(f"[CONNECTION] Hilog is disconnected")
-    
+
+    @staticmethod
+    def __get_new_data(data, lines):
+        # the rest of the block from the first new line
+        if not lines:
+            return b""
+        start = data.find(lines[0][:HILOG_TIME_LENGTH].encode("utf-8"))
+        if start >= 0:
+            return data[start:]
+        # the first new line began in the previous block, so the lines are written again,
+        # followed by the beginning of the line the block ends with
+        return ("\n".join(lines) + "\n").encode("utf-8") + data[data.rfind(b"\n") + 1:]
+
+    def __skip_replayed_lines(self, lines):
+        # skip the lines read before reconnecting, the times of the lines only increase
+        num_skipped = 0
+        for line in lines:
+            if line[:HILOG_TIME_LENGTH] > self.skip_until_time:
+                self.skip_until_time = None
+                break
+            num_skipped += 1
+        return lines[num_skipped:]
+
+    def add_lines(self, lines):
+        with self.lock:
+            self.recent_lines.extend(lines)
+            self.num_lines += len(lines)
+        self.log_buffer.add_lines(lines)
+
     def tear_down(self):
         pass
 
-    def parse_line(self, hilog_line):
-        # 解析逻辑可以在这里实现
-        pass
+    def get_seq(self):
+        """
+        get the sequence number of the next line, to read the lines since now later
+        """
+        return self.num_lines
+
+    def get_lines_since(self, seq):
+        """
+        get the lines read since a sequence number, as far as they are still in the ring buffer
+        :param seq: a sequence number returned by get_seq
+        :return: iterator of str, without the line breaks
+        """
+        return iter(self.__get_lines_since(seq)[0])
+
+    def __get_lines_since(self, seq):
+        with self.lock:
+            first_seq = self.num_lines - len(self.recent_lines)
+            lines = list(itertools.islice(self.recent_lines, max(0, seq - first_seq), None))
+            return lines, self.num_lines
 
     def get_recent_lines(self):
-        lines = self.recent_lines
-        self.recent_lines = []
+        """
+        get the lines read since the last call
+        """
+        lines, self.last_read_seq = self.__get_lines_since(self.last_read_seq)
         return lines
@@ -1,12 +1,18 @@
+import collections
 import subprocess
 import logging
 import copy
 from .adapter import Adapter
+from ..log_parser import LogBuffer, iter_log_blocks
+
+# Max number of recent lines kept until get_recent_lines is called
+MAX_RECENT_LINES = 20000
 
 
 class Logcat(Adapter):
     """
     A connection with the target device through logcat.
+    The parsed records are in log_buffer.
     """
 
     def __init__(self, device=None):
@@ -22,7 +28,8 @@ class Logcat(Adapter):
         self.connected = False
         self.process = None
         self.parsers = []
-        self.recent_lines = []
+        self.recent_lines = collections.deque(maxlen=MAX_RECENT_LINES)
+        self.log_buffer = LogBuffer()
         if device.output_dir is None:
             self.out_file = None
         else:
@@ -48,8 +55,8 @@ class Logcat(Adapter):
 
     def get_recent_lines(self):
         lines = self.recent_lines
-        self.recent_lines = []
-        return lines
+        self.recent_lines = collections.deque(maxlen=MAX_RECENT_LINES)
+        return list(lines)
 
     def handle_output(self):
         self.connected = True
@@ -58,16 +65,18 @@ class Logcat(Adapter):
         if self.out_file is not None:
             f = open(self.out_file, 'w', encoding='utf-8')
 
-        while self.connected:
-            if self.process is None:
+        for data, lines in iter_log_blocks(self.process.stdout.fileno()):
+            if not self.connected:
+                break
+            if not lines:
                 continue
-            line = self.process.stdout.readline()
-            if not isinstance(line, str):
-                line = line.decode()
-            self.recent_lines.append(line)
-            self.parse_line(line)
+            self.recent_lines.extend(lines)
+            self.log_buffer.add_lines(lines)
+            if self.parsers:
+                for line in lines:
+                    self.parse_line(line)
             if f is not None:
-                f.write(line)
+                f.write("\n".join(lines) + "\n")
         if f is not None:
             f.close()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
@@ -4,33 +4,50 @@ import time
 import subprocess
 from .adapter import Adapter
 
+# Default number of seconds between two refreshes of the process table
+DEFAULT_PROCESS_REFRESH_INTERVAL = 1
+# The ps commands tried in order, the first one listing the processes is kept
+PS_CMDS = ["ps -A -o PID,PPID,USER,NAME", "ps -ef", "ps"]
+PS_END_MARKER = "__PS_END__"
+
 
 class ProcessMonitor(Adapter):
     """
-    monitoring the state of process on the device
+    monitoring the state of process on the device.
+    The process table is refreshed with ps over one persistent shell, and shared by all the callers
+    that need the pid of a package.
     """
 
-    def __init__(self, device=None, app=None):
+    def __init__(self, device=None, app=None, refresh_interval=DEFAULT_PROCESS_REFRESH_INTERVAL):
         """
         initiate a process monitor
         :param device: Device instance
         :param app: App instance
+        :param refresh_interval: seconds between two refreshes of the process table
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
-        self.enabled = True
+        self.enabled = False
         self.device = device
         self.app = app
+        self.refresh_interval = refresh_interval
         self.pid2user = {}
         self.pid2ppid = {}
         self.pid2name = {}
+        self.name2pid = {}
+        self.package2pid = {}
         self.listeners = set()
         self.lock = threading.Lock()
+        self.shell = None
+        self.shell_lock = threading.Lock()
+        self.ps_cmd_idx = 0
+        self.refresh_requested = threading.Event()
+        self.last_refresh_time = None
 
     def add_state_listener(self, state_listener):
         """
         add one state listener to the listeners list
-        :param state_listener:
+        :param state_listener: a function called with (started_pids, died_pids) after each refresh changing them
         :return:
         """
         self.listeners.add(state_listener)
@@ -46,69 +63,183 @@ class ProcessMonitor(Adapter):
     def connect(self):
         """
         start the monitor in a another thread.
-        From now on, the on_state_updated method in listeners will be continuously called
+        From now on, the listeners will be called with the changes of the processes
         :return:
         """
         self.enabled = True
-        gps_thread = threading.Thread(target=self.maintain_process_mapping)
+        gps_thread = threading.Thread(target=self.maintain_process_mapping, daemon=True)
         gps_thread.start()
         return True
 
     def disconnect(self):
         self.enabled = False
+        self.refresh_requested.set()
+        self.__close_shell()
 
     def check_connectivity(self):
         return self.enabled
 
-    def maintain_process_mapping(self):
+    def set_up(self):
+        pass
+
+    def tear_down(self):
+        pass
+
+    def __get_shell_cmd(self):
+        if self.device is None:
+            return ["adb", "shell"]
+        if self.device.is_harmonyos:
+            from .hdc import HDC_EXEC
+            return [HDC_EXEC, "-t", self.device.serial, "shell"]
+        return ["adb", "-s", self.device.serial, "shell"]
+
+    def __close_shell(self):
+        with self.shell_lock:
+            if self.shell is not None:
+                self.shell.kill()
+                self.shell = None
+
+    def __run_ps(self, ps_cmd):
         """
-        maintain pid2user mapping, pid2ppid mapping and pid2name mapping by continuously calling ps command
+        run ps in the persistent shell, starting it if needed
+        :return: list of str, the output lines
         """
-        while self.enabled:
-            if self.device is not None:
-                ps_cmd = ["adb", "-s", self.device.serial, "shell", "ps"]
-            else:
-                ps_cmd = ["adb", "shell", "ps"]
+        with self.shell_lock:
+            if self.shell is None or self.shell.poll() is not None:
+                self.shell = subprocess.Popen(self.__get_shell_cmd(),
+                                              stdin=subprocess.PIPE,
+                                              stdout=subprocess.PIPE,
+                                              stderr=subprocess.DEVNULL)
+            self.shell.stdin.write(("%s; echo %s\n" % (ps_cmd, PS_END_MARKER)).encode())
+            self.shell.stdin.flush()
+            lines = []
+            while True:
+                line = self.shell.stdout.readline()
+                if not line:
+                    # the shell exited, it is restarted at the next refresh
+                    self.shell = None
+                    break
+                line = line.decode("utf-8", errors="replace")
+                if PS_END_MARKER in line and "echo" not in line:
+                    break
+                lines.append(line)
+            return lines
 
-            try:
-                ps_out = subprocess.check_output(ps_cmd)
-                if not isinstance(ps_out, str):
-                    ps_out = ps_out.decode()
-            except subprocess.CalledProcessError:
+    @staticmethod
+    def parse_ps_output(ps_out_lines):
+        """
+        parse the output of ps, whatever its columns are
+        :return: dict of pid -> (ppid, user, name)
+        """
+        processes = {}
+        columns = None
+        for ps_out_line in ps_out_lines:
+            segs = ps_out_line.split()
+            if columns is None:
+                # skip the echoed command and prompt until the header
+                if "PID" in segs and "PPID" in segs:
+                    columns = segs
+                    pid_idx = columns.index("PID")
+                    ppid_idx = columns.index("PPID")
+                    user_idx = columns.index("USER") if "USER" in columns else columns.index("UID") \
+                        if "UID" in columns else None
+                continue
+            if len(segs) < len(columns) or not segs[pid_idx].isdigit() or not segs[ppid_idx].isdigit():
                 continue
+            user = segs[user_idx] if user_idx is not None else None
+            # the NAME column of the old ps is after an unnamed state column, while CMD is followed by the args
+            name = segs[-1] if columns[-1] == "NAME" else segs[len(columns) - 1]
+            processes[int(segs[pid_idx])] = (int(segs[ppid_idx]), user, name)
+        return processes
 
-            # parse ps_out to update self.pid2uid mapping and self.pid2name mapping
-            ps_out_lines = ps_out.splitlines()
-            ps_out_head = ps_out_lines[0].split()
-            if ps_out_head[0] != "USER" or ps_out_head[1] != "PID" \
-                    or ps_out_head[2] != "PPID" or ps_out_head[-1] != "NAME":
-                self.device.logger.warning("ps command output format error: %s" % ps_out_head)
-
-            for ps_out_line in ps_out_lines[1:]:
-                segs = ps_out_line.split()
-                if len(segs) < 4:
-                    continue
-                user = segs[0]
-                pid = segs[1]
-                ppid = segs[2]
-                name = segs[-1]
-                self.lock.acquire()
-                self.pid2name[pid] = name
-                self.pid2ppid[pid] = ppid
-                self.pid2user[pid] = user
-                self.lock.release()
-
-            time.sleep(1)
+    def refresh(self):
+        """
+        refresh the process table now
+        :return: True if the table is refreshed
+        """
+        processes = {}
+        while self.ps_cmd_idx < len(PS_CMDS):
+            try:
+                processes = self.parse_ps_output(self.__run_ps(PS_CMDS[self.ps_cmd_idx]))
+            except Exception as e:
+                self.logger.warning("Refreshing the process table failed: %s" % e)
+                self.__close_shell()
+                return False
+            if processes:
+                break
+            # the ps of the device does not support these options
+            self.ps_cmd_idx += 1
+        if not processes:
+            self.logger.warning("Cannot list the processes of the device.")
+            return False
+
+        pid2name = {}
+        pid2ppid = {}
+        pid2user = {}
+        name2pid = {}
+        # the lowest pid of the processes of each package, including its "package:service" processes
+        package2pid = {}
+        for pid in sorted(processes.keys(), reverse=True):
+            ppid, user, name = processes[pid]
+            pid2name[pid] = name
+            pid2ppid[pid] = ppid
+            pid2user[pid] = user
+            name2pid[name] = pid
+            package2pid[name.split(":")[0]] = pid
+        with self.lock:
+            started_pids = pid2name.keys() - self.pid2name.keys()
+            died_pids = self.pid2name.keys() - pid2name.keys()
+            self.pid2name = pid2name
+            self.pid2ppid = pid2ppid
+            self.pid2user = pid2user
+            self.name2pid = name2pid
+            self.package2pid = package2pid
+            self.last_refresh_time = time.time()
+        if started_pids or died_pids:
+            for listener in list(self.listeners):
+                listener(started_pids, died_pids)
+        return True
+
+    def request_refresh(self):
+        """
+        refresh the process table as soon as possible, e.g. after starting an app
+        """
+        self.refresh_requested.set()
+
+    def maintain_process_mapping(self):
+        """
+        maintain pid2user mapping, pid2ppid mapping and pid2name mapping by continuously calling ps command
+        """
+        while self.enabled:
+            self.refresh()
+            self.refresh_requested.wait(self.refresh_interval)
+            self.refresh_requested.clear()
+        self.__close_shell()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
+    def pid_of(self, package):
+        """
+        get the pid of a package from the process table
+        :param package: str, the package (bundle) name
+        :return: the pid of the process named package, or the lowest pid of its package:service processes,
+                 None if it is not running
+        """
+        if not self.enabled:
+            # the table is not maintained, refresh it on demand
+            self.refresh()
+        with self.lock:
+            pid = self.name2pid.get(package)
+            return pid if pid is not None else self.package2pid.get(package)
+
     def get_ppids_by_pid(self, pid):
         """
         get the parent pids of given pid
         @return:
         """
+        pid = int(pid)
         self.lock.acquire()
         ppids = []
-        while pid in self.pid2ppid:
+        while pid in self.pid2ppid and pid not in ppids:
             ppids.append(pid)
             pid = self.pid2ppid[pid]
         self.lock.release()
@@ -0,0 +1,166 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import typing
+if typing.TYPE_CHECKING:
+    from .device import Device
+    from .device_hm import DeviceHM
+    from .app import App
+    from .app_hm import AppHM
+    from .log_parser import LogRecord
+
+CRASHES_FILE_NAME = "crashes.jsonl"
+# (kind, tag, keyword): a log record of the app is a crash if its tag contains tag and its content contains keyword.
+# The records must mention the package name of the app.
+CRASH_SIGNATURES = [
+    # Android
+    ("crash", "AndroidRuntime", "Process: "),
+    ("anr", "ActivityManager", "ANR in "),
+    ("death", "ActivityManager", "has died"),
+    # HarmonyOS, reported by the fault logger and the app manager
+    ("crash", "Faultlogger", "CPP_CRASH"),
+    ("crash", "Faultlogger", "JS_ERROR"),
+    ("crash", "", "JsError"),
+    ("freeze", "Faultlogger", "APP_FREEZE"),
+    ("freeze", "", "THREAD_BLOCK_6S"),
+    ("freeze", "", "APP_INPUT_BLOCK"),
+    ("death", "AppMgrService", "died"),
+]
+# The HarmonyOS processes reporting the crashes of the apps, whose logs are kept when hilog is filtered on the app
+CRASH_REPORTER_PROCESSES = ["faultloggerd", "hiview", "foundation"]
+# Records of the same failure logged within this number of seconds are one crash
+CRASH_DEBOUNCE_SECONDS = 3
+# Deaths of the app logged within this number of seconds after DroidBot killed it are not crashes
+KILL_EXPECTED_SECONDS = 5
+
+NUMBER_RE = re.compile(r"\d+")
+
+
+class Crash(object):
+    """
+    A crash, ANR/app freeze or death of the app, and the log records reporting it.
+    """
+
+    def __init__(self, kind, record:"LogRecord"):
+        self.kind = kind
+        self.detect_time = time.monotonic()
+        self.records = [record]
+        # the same failure on other runs or steps has the same signature
+        normalized_content = NUMBER_RE.sub("N", record.content)
+        self.signature = hashlib.md5(("%s|%s|%s" % (kind, record.tag, normalized_content)).encode("utf-8")) \
+            .hexdigest()[:16]
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "signature": self.signature,
+            "time": self.records[0].time,
+            "lines": [record.to_line() for record in self.records]
+        }
+
+
+class CrashDetector(object):
+    """
+    Detect the crashes, ANRs/app freezes and deaths of the app as they are logged,
+    so that the exploration restarts the app at once instead of noticing it from later states.
+    """
+
+    def __init__(self, device:typing.Union["Device", "DeviceHM"], app:typing.Union["App", "AppHM"]):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device = device
+        self.package_name = app.get_package_name()
+        self.lock = threading.Lock()
+        self.crashed = threading.Event()
+        self.pending_crashes = []
+        self.last_crash = None
+        self.num_crashes = 0
+        # the app is being killed by DroidBot until this time
+        self.kill_expected_until = 0.0
+        self.out_file = os.path.join(device.output_dir, CRASHES_FILE_NAME) if device.output_dir is not None else None
+
+        log_adapter = device.hilog if device.is_harmonyos else device.logcat
+        # the detector is fed by the log, so read it even if it is not saved
+        device.adapters[log_adapter] = True
+        log_adapter.log_buffer.add_listener(self.on_records)
+        if device.is_harmonyos:
+            log_adapter.keep_processes.update(CRASH_REPORTER_PROCESSES)
+            log_adapter.update_filter()
+
+    def on_records(self, records):
+        """
+        check the new log records, called in the thread reading the log
+        :param records: list of LogRecord
+        """
+        for record in records:
+            if self.package_name not in record.content:
+                continue
+            for kind, tag, keyword in CRASH_SIGNATURES:
+                if tag in record.tag and keyword in record.content:
+                    if kind == "death" and time.monotonic() < self.kill_expected_until:
+                        self.logger.debug("Ignored the death of %s killed on purpose" % self.package_name)
+                    else:
+                        self.__add_crash(kind, record)
+                    break
+
+    def expect_kill(self):
+        """
+        called when DroidBot kills the app, whose death is then not reported as a crash for a while
+        """
+        self.kill_expected_until = time.monotonic() + KILL_EXPECTED_SECONDS
+
+    def __add_crash(self, kind, record:"LogRecord"):
+        with self.lock:
+            last_crash = self.last_crash
+            if last_crash is not None and time.monotonic() - last_crash.detect_time < CRASH_DEBOUNCE_SECONDS:
+                last_crash.records.append(record)
+                return
+            crash = Crash(kind, record)
+            self.last_crash = crash
+            self.pending_crashes.append(crash)
+            self.num_crashes += 1
+        self.logger.warning("Detected %s of %s: %s" % (kind, self.package_name, record.content))
+        self.crashed.set()
+
+    def wait(self, timeout):
+        """
+        sleep until the timeout or until a crash is detected
+        :return: True if a crash is detected
+        """
+        return self.crashed.wait(timeout)
+
+    def has_crash(self):
+        return self.crashed.is_set()
+
+    def pop_crashes(self):
+        """
+        get the crashes detected since the last call
+        :return: list of Crash
+        """
+        with self.lock:
+            crashes = self.pending_crashes
+            self.pending_crashes = []
+            self.crashed.clear()
+        return crashes
+
+    def save_crash(self, crash:Crash, event_str=None, state_str=None):
+        """
+        record a crash with the event that triggered it, for triage
+        :param crash: Crash
+        :param event_str: the event sent before the crash
+        :param state_str: the state the event was sent in
+        """
+        if self.out_file is None:
+            return
+        crash_dict = crash.to_dict()
+        crash_dict["event_str"] = event_str
+        crash_dict["state_str"] = state_str
+        try:
+            with open(self.out_file, "a") as f:
+                f.write(json.dumps(crash_dict) + "\n")
+        except Exception as e:
+            self.logger.warning("Saving crash failed: %s" % e)
@@ -9,13 +9,14 @@ from .adapter.adb import ADB
 from .adapter.droidbot_app import DroidBotAppConn
 from .adapter.logcat import Logcat
 from .adapter.minicap import Minicap
-from .adapter.process_monitor import ProcessMonitor
+from .adapter.process_monitor import ProcessMonitor, DEFAULT_PROCESS_REFRESH_INTERVAL
 from .adapter.telnet import TelnetConsole
 from .adapter.user_input_monitor import UserInputMonitor
 from .adapter.droidbot_ime import DroidBotIme
 from .app import App
 from .intent import Intent
 from .adapter.hdc import HDC
+from .tracer import traced
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
@@ -28,11 +29,14 @@ class Device(object):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False, is_harmonyos=False, save_log=False):
+                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False, is_harmonyos=False, save_log=False,
+                 run_store=False, perceptual_dedup=False,
+                 process_refresh_interval=DEFAULT_PROCESS_REFRESH_INTERVAL):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param process_refresh_interval: seconds between two refreshes of the process table
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -78,11 +82,21 @@ class Device(object):
         self.minicap = Minicap(device=self)
         self.logcat = Logcat(device=self)
         self.user_input_monitor = UserInputMonitor(device=self)
-        self.process_monitor = ProcessMonitor(device=self)
+        self.process_monitor = ProcessMonitor(device=self, refresh_interval=process_refresh_interval)
         self.droidbot_ime = DroidBotIme(device=self)
         self.hdc = HDC(device=self)
         self.is_harmonyos = is_harmonyos
         self.save_log = save_log
+        # record the outputs in one database instead of a file per state, event and view image
+        self.run_store = None
+        if run_store and output_dir is not None:
+            from .run_store import RunStore
+            self.run_store = RunStore(RunStore.get_db_path(output_dir))
+        # store each distinct screenshot and view image once
+        self.image_store = None
+        if self.run_store is None and output_dir is not None:
+            from .image_store import ImageStore
+            self.image_store = ImageStore(output_dir, perceptual=perceptual_dedup)
     
         self.adapters = {
             self.adb: True,
@@ -189,6 +203,10 @@ class Device(object):
             if os.path.exists(temp_dir):
                 import shutil
                 shutil.rmtree(temp_dir)
+        if self.run_store is not None:
+            self.run_store.close()
+        if self.image_store is not None:
+            self.image_store.close()
 
     def tear_down(self):
         for adapter in self.adapters:
@@ -480,8 +498,12 @@ class Device(object):
             cmd = intent.get_cmd()
         else:
             cmd = intent
-        return self.adb.shell(cmd)
+        r = self.adb.shell(cmd)
+        # the processes change when an app is started or stopped
+        self.process_monitor.request_refresh()
+        return r
 
+    @traced("event send")
     def send_event(self, event):
         """
         send one event to device
@@ -732,31 +754,7 @@ class Device(object):
         else:
             package = app
 
-        name2pid = {}
-        ps_out = self.adb.shell(["ps"])
-        ps_out_lines = ps_out.splitlines()
-        ps_out_head = ps_out_lines[0].split()
-        if ps_out_head[1] != "PID" or ps_out_head[-1] != "NAME":
-            self.logger.warning("ps command output format error: %s" % ps_out_head)
-        for ps_out_line in ps_out_lines[1:]:
-            segs = ps_out_line.split()
-            if len(segs) < 4:
-                continue
-            pid = int(segs[1])
-            name = segs[-1]
-            name2pid[name] = pid
-
-        if package in name2pid:
-            return name2pid[package]
-
-        possible_pids = []
-        for name in name2pid:
-            if name.startswith(package):
-                possible_pids.append(name2pid[name])
-        if len(possible_pids) > 0:
-            return min(possible_pids)
-
-        return None
+        return self.process_monitor.pid_of(package)
 
     def push_file(self, local_file, remote_dir="/sdcard/"):
         """
@@ -772,6 +770,7 @@ class Device(object):
     def pull_file(self, remote_file, local_file):
         self.adb.run_cmd(["pull", remote_file, local_file])
 
+    @traced("screenshot")
     def take_screenshot(self):
         # image = None
         #
@@ -810,6 +809,7 @@ class Device(object):
 
         return local_image_path
 
+    @traced("state capture")
     def get_current_state(self):
         self.logger.debug("getting current device state...")
         current_state = None
@@ -837,6 +837,26 @@ class Device(object):
             self.logger.warning("Failed to get current state!")
         return current_state
 
+    @traced("layout state capture")
+    def get_layout_state(self):
+        """
+        capture the views of the current screen without a screenshot, activity stack or services,
+        which is enough to compare the state_str with a known state
+        :return: DeviceState without screenshot, or None if failed
+        """
+        try:
+            views = self.get_views()
+            foreground_activity = self.get_top_activity_name()
+            from .device_state import DeviceState
+            return DeviceState(self,
+                               views=views,
+                               foreground_activity=foreground_activity,
+                               activity_stack=[foreground_activity],
+                               background_services=None)
+        except Exception as e:
+            self.logger.warning("exception in get_layout_state: %s" % e)
+            return None
+
     def get_last_known_state(self):
         return self.last_know_state
 
@@ -13,7 +13,9 @@ from .device import Device
 from .adapter.hdc import HDC, HDC_EXEC
 from .app_hm import AppHM
 from .adapter.hilog import Hilog
+from .adapter.process_monitor import ProcessMonitor, DEFAULT_PROCESS_REFRESH_INTERVAL
 from .intent import Intent
+from .tracer import traced
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
@@ -26,11 +28,14 @@ class DeviceHM(Device):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False, is_harmonyos=True, save_log=False):
+                 enable_accessibility_hard=False, humanoid=None, ignore_ad=False, is_harmonyos=True, save_log=False,
+                 run_store=False, perceptual_dedup=False, hilog_app_only=False,
+                 process_refresh_interval=DEFAULT_PROCESS_REFRESH_INTERVAL):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param process_refresh_interval: seconds between two refreshes of the process table
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -63,15 +68,29 @@ class DeviceHM(Device):
 
         self.is_harmonyos = is_harmonyos
         self.save_log = save_log
+        # filter hilog on the pid of the app on the device
+        self.hilog_app_only = hilog_app_only
+        # record the outputs in one database instead of a file per state, event and view image
+        self.run_store = None
+        if run_store and output_dir is not None:
+            from .run_store import RunStore
+            self.run_store = RunStore(RunStore.get_db_path(output_dir))
+        # store each distinct screenshot and view image once
+        self.image_store = None
+        if self.run_store is None and output_dir is not None:
+            from .image_store import ImageStore
+            self.image_store = ImageStore(output_dir, perceptual=perceptual_dedup)
 
         # adapters
         self.hdc = HDC(device=self)
         self.hilog = Hilog(device=self)
+        self.process_monitor = ProcessMonitor(device=self, refresh_interval=process_refresh_interval)
 
         self.logger.info("You're runing droidbot on HarmonyOS")
         self.adapters = {
             self.hdc: True,
-            self.hilog: True if self.save_log else False
+            self.hilog: True if self.save_log else False,
+            self.process_monitor: True
         }
 
     def check_connectivity(self):
@@ -139,6 +158,10 @@ class DeviceHM(Device):
             if os.path.exists(temp_dir):
                 import shutil
                 shutil.rmtree(temp_dir)
+        if self.run_store is not None:
+            self.run_store.close()
+        if self.image_store is not None:
+            self.image_store.close()
 
     def tear_down(self):
         for adapter in self.adapters:
@@ -253,8 +276,12 @@ class DeviceHM(Device):
             cmd = intent.get_cmd()
         else:
             cmd = intent
-        return self.hdc.shell(cmd)
+        r = self.hdc.shell(cmd)
+        # the processes change when an app is started or stopped
+        self.process_monitor.request_refresh()
+        return r
 
+    @traced("event send")
     def send_event(self, event:"InputEvent"):
         """
         send one event to device
@@ -281,6 +308,15 @@ class DeviceHM(Device):
         intent = Intent(suffix=package_name)
         self.send_intent(intent)
 
+    def get_app_pid(self, app):
+        """
+        get the pid of an app from the process table
+        :param app: instance of AppHM, or str of bundle name
+        :return: int, or None if the app is not running
+        """
+        package = app.get_package_name() if isinstance(app, AppHM) else app
+        return self.process_monitor.pid_of(package)
+
     def get_top_activity_name(self) -> str:
         """
         Get current activity
@@ -393,6 +429,8 @@ class DeviceHM(Device):
         """
         assert isinstance(app, AppHM)
         package_name = app.get_package_name()
+        if self.hilog_app_only:
+            self.hilog.filter_app(package_name)
         if package_name not in self.hdc.get_installed_apps():
             install_cmd = [HDC_EXEC, "-t", self.serial, "install", "-r"]
             install_cmd.append(HDC.get_relative_path(app.app_path))
@@ -478,6 +516,7 @@ class DeviceHM(Device):
         r = self.hdc.run_cmd(["file", "recv", remote_file, local_file])
         assert not r.startswith("[Fail]"), "Error with receiving file"
 
+    @traced("screenshot")
     def take_screenshot(self):
         
         if self.output_dir is None:
@@ -495,6 +534,7 @@ class DeviceHM(Device):
 
         return local_path
 
+    @traced("state capture")
     def get_current_state(self):
         self.logger.debug("getting current device state...")
         current_state = None
@@ -524,6 +564,26 @@ class DeviceHM(Device):
             self.logger.warning("Failed to get current state!")
         return current_state
 
+    @traced("layout state capture")
+    def get_layout_state(self):
+        """
+        capture the views of the current screen without a screenshot,
+        which is enough to compare the state_str with a known state
+        :return: DeviceState without screenshot, or None if failed
+        """
+        try:
+            foreground_activity = self.get_top_activity_name()
+            views = self.get_views() if foreground_activity is not None else []
+            from .device_state import DeviceState
+            return DeviceState(self,
+                               views=views,
+                               foreground_activity=foreground_activity,
+                               activity_stack=[foreground_activity],
+                               background_services=None)
+        except Exception as e:
+            self.logger.warning("exception in get_layout_state: %s" % e)
+            return None
+
     def get_last_known_state(self):
         return self.last_know_state
 
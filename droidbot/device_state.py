@@ -3,6 +3,7 @@ import math
 import os
 
 from .utils import md5, deprecated
+from .tracer import traced, IO_CATEGORY
 from .input_event import TouchEvent, LongTouchEvent, ScrollEvent, SetTextEvent, KeyEvent
 
 
@@ -11,6 +12,7 @@ class DeviceState(object):
     the state of the current device
     """
 
+    @traced("state build")
     def __init__(self, device, views, foreground_activity, activity_stack, background_services,
                  tag=None, screenshot_path=None):
         self.device = device
@@ -22,6 +24,9 @@ class DeviceState(object):
             tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         self.tag = tag
         self.screenshot_path = screenshot_path
+        # the file captured from the device, which the view images are cropped from,
+        # since the saved screenshot can be a near-identical one with perceptual dedup
+        self.capture_path = screenshot_path
         if foreground_activity is not None:
             self.views = self.__parse_views(views)
             self.view_tree = {}
@@ -63,6 +68,40 @@ class DeviceState(object):
         import json
         return json.dumps(self.to_dict(), indent=2)
 
+    @staticmethod
+    def from_dict(device, state_dict, screenshot_path=None):
+        """
+        rebuild a state from the output of to_dict without querying the device
+        @param device: Device, the device the state was captured on
+        @param state_dict: dict, the output of DeviceState.to_dict
+        @param screenshot_path: str, path to the screenshot of the state
+        @return: DeviceState
+        """
+        state = DeviceState.__new__(DeviceState)
+        state.device = device
+        state.foreground_activity = state_dict['foreground_activity']
+        state.activity_stack = state_dict['activity_stack'] or []
+        state.background_services = state_dict['background_services']
+        state.tag = state_dict['tag']
+        state.screenshot_path = screenshot_path
+        state.capture_path = None
+        # the views already carry their signatures and view_strs, so nothing is recomputed here
+        state.views = state_dict['views']
+        state.view_tree = {}
+        state.state_str = state_dict['state_str']
+        state.structure_str = state_dict['state_str_content_free']
+        if state.foreground_activity is not None:
+            state.search_content = state.__get_search_content()
+            state.text_representation = state.get_text_representation()
+        else:
+            state.search_content = state.state_str
+            state.text_representation = state.state_str
+        state.possible_events = None
+        state.width = state_dict['width']
+        state.height = state_dict['height']
+        state.pagePath = state.__get_pagePath()
+        return state
+
     def __parse_views(self, raw_views):
         views = []
         if not raw_views or len(raw_views) == 0:
@@ -154,15 +193,22 @@ class DeviceState(object):
                                self.device.display_info["height"]]
             }))
         else:
-            view_signatures = set()
-            for view in self.views:
-                view_signature = DeviceState.__get_content_free_view_signature(view)
-                if view_signature:
-                    view_signatures.add(view_signature)
+            view_signatures = self.get_content_free_view_signatures()
             state_str = "%s{%s}" % (self.foreground_activity, ",".join(sorted(view_signatures)))
         import hashlib
         return hashlib.md5(state_str.encode('utf-8')).hexdigest()
 
+    def get_content_free_view_signatures(self):
+        """
+        get the set of content-free signatures of the views in this state
+        """
+        view_signatures = set()
+        for view in self.views:
+            view_signature = DeviceState.__get_content_free_view_signature(view)
+            if view_signature:
+                view_signatures.add(view_signature)
+        return view_signatures
+
     def __get_search_content(self):
         """
         get a text for searching the state
@@ -184,6 +230,7 @@ class DeviceState(object):
                 property_values.add(property_value)
         return property_values
 
+    @traced("state save", IO_CATEGORY)
     def save2dir(self, output_dir=None):
         try:
             if output_dir is None:
@@ -191,8 +238,6 @@ class DeviceState(object):
                     return
                 else:
                     output_dir = os.path.join(self.device.output_dir, "states")
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
             dest_state_json_path = "%s/state_%s.json" % (output_dir, self.tag)
             if not self.device.is_harmonyos:
                 if self.device.adapters[self.device.minicap]:
@@ -201,11 +246,21 @@ class DeviceState(object):
                     dest_screenshot_path = "%s/screen_%s.png" % (output_dir, self.tag)
             else:
                 dest_screenshot_path = "%s/screen_%s.jpeg" % (output_dir, self.tag)
+            if self.device.run_store is not None:
+                # the files are written when the run store is exported
+                self.device.run_store.add_state(self, dest_screenshot_path)
+                self.screenshot_path = dest_screenshot_path
+                return
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
             state_json_file = open(dest_state_json_path, "w")
             state_json_file.write(self.to_json())
             state_json_file.close()
-            import shutil
-            shutil.copyfile(self.screenshot_path, dest_screenshot_path)
+            if self.device.image_store is not None:
+                self.device.image_store.add_screenshot(self.screenshot_path, dest_screenshot_path)
+            else:
+                import shutil
+                shutil.copyfile(self.screenshot_path, dest_screenshot_path)
             self.screenshot_path = dest_screenshot_path
             # from PIL.Image import Image
             # if isinstance(self.screenshot_path, Image):
@@ -236,6 +291,7 @@ class DeviceState(object):
         except Exception as e:
             self.device.logger.warning(e)
 
+    @traced("view image save", IO_CATEGORY)
     def save_view_img(self, view_dict, output_dir=None):
         try:
             if output_dir is None:
@@ -243,7 +299,8 @@ class DeviceState(object):
                     return
                 else:
                     output_dir = os.path.join(self.device.output_dir, "views")
-            if not os.path.exists(output_dir):
+            run_store = self.device.run_store
+            if run_store is None and not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             view_str = view_dict['view_str']
             # Crop the wiget image from the screenshot
@@ -256,8 +313,17 @@ class DeviceState(object):
             else:
                 # HarmonyOS
                 view_file_path = "%s/view_%s.jpeg" % (output_dir, view_str)
+            if run_store is not None:
+                # cropped when the run store is exported
+                if not run_store.has_view(view_file_path):
+                    run_store.add_view(view_file_path, self.screenshot_path, view_dict['bounds'])
+                return
             if os.path.exists(view_file_path):
                 return
+            if self.device.image_store is not None:
+                crop_source_path = self.capture_path if self.capture_path is not None else self.screenshot_path
+                self.device.image_store.add_view_img(crop_source_path, view_dict['bounds'], view_file_path)
+                return
             from PIL import Image
             # Load the original image:
             view_bound = view_dict['bounds']
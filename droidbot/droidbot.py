@@ -13,6 +13,9 @@ from .device import Device
 from .app import App
 from .env_manager import AppEnvManager
 from .input_manager import InputManager
+from .tracer import tracer
+from .adapter.process_monitor import DEFAULT_PROCESS_REFRESH_INTERVAL
+from .utg import NEAR_DUPLICATE_THRESHOLD
 
 # device and app class for harmonyOS
 from .device_hm import DeviceHM
@@ -50,8 +53,28 @@ class DroidBot(object):
                  humanoid=None,
                  ignore_ad=False,
                  replay_output=None,
+                 resume_dir=None,
+                 text_cache_dir=None,
+                 warm_start_dir=None,
+                 text_encoder="bert",
+                 inference_backend="eager",
+                 inference_threads=None,
+                 pipeline=False,
+                 replay_fast_forward=False,
+                 replay_checkpoint_interval=None,
+                 detect_crashes=False,
+                 train_interval=10,
+                 background_training=True,
+                 train_iterations=10,
+                 train_time_budget=None,
+                 near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD,
                  is_harmonyos=False,
-                 save_log=False):
+                 save_log=False,
+                 run_store=False,
+                 perceptual_dedup=False,
+                 hilog_app_only=False,
+                 process_refresh_interval=DEFAULT_PROCESS_REFRESH_INTERVAL,
+                 trace=False):
         """
         initiate droidbot with configurations
         :return:
@@ -65,6 +88,10 @@ class DroidBot(object):
 
         self.is_harmonyos = is_harmonyos
         self.save_log = save_log
+        self.run_store = run_store
+        self.perceptual_dedup = perceptual_dedup
+        self.hilog_app_only = hilog_app_only
+        self.process_refresh_interval = process_refresh_interval
 
         self.output_dir = output_dir
         if output_dir is not None:
@@ -93,6 +120,9 @@ class DroidBot(object):
             except Exception as e:
                 self.logger.error(f"Fail to adapt the html to HarmonyOS. Exeception {e}")
             
+        if trace:
+            # time the stages of the run, written to the output dir when stopped
+            tracer.enable(output_dir)
 
         self.timeout = timeout
         self.timer = None
@@ -108,6 +138,21 @@ class DroidBot(object):
         self.humanoid = humanoid
         self.ignore_ad = ignore_ad
         self.replay_output = replay_output
+        self.resume_dir = resume_dir
+        self.text_cache_dir = text_cache_dir
+        self.warm_start_dir = warm_start_dir
+        self.text_encoder = text_encoder
+        self.inference_backend = inference_backend
+        self.inference_threads = inference_threads
+        self.pipeline = pipeline
+        self.replay_fast_forward = replay_fast_forward
+        self.replay_checkpoint_interval = replay_checkpoint_interval
+        self.detect_crashes = detect_crashes
+        self.train_interval = train_interval
+        self.background_training = background_training
+        self.train_iterations = train_iterations
+        self.train_time_budget = train_time_budget
+        self.near_duplicate_threshold = near_duplicate_threshold
 
 
         self.enabled = True
@@ -125,7 +170,10 @@ class DroidBot(object):
                     humanoid=self.humanoid,
                     ignore_ad=ignore_ad,
                     is_harmonyos=self.is_harmonyos,
-                    save_log=self.save_log)
+                    save_log=self.save_log,
+                    run_store=self.run_store,
+                    perceptual_dedup=self.perceptual_dedup,
+                    process_refresh_interval=self.process_refresh_interval)
                 self.app = App(app_path, output_dir=self.output_dir)
 
                 self.env_manager = AppEnvManager(
@@ -142,7 +190,22 @@ class DroidBot(object):
                     script_path=script_path,
                     profiling_method=profiling_method,
                     master=master,
-                    replay_output=replay_output)
+                    replay_output=replay_output,
+                    resume_dir=resume_dir,
+                    text_cache_dir=text_cache_dir,
+                    warm_start_dir=warm_start_dir,
+                    text_encoder=text_encoder,
+                    inference_backend=inference_backend,
+                    inference_threads=inference_threads,
+                    pipeline=pipeline,
+                    replay_fast_forward=replay_fast_forward,
+                    replay_checkpoint_interval=replay_checkpoint_interval,
+                    detect_crashes=detect_crashes,
+                    train_interval=train_interval,
+                    background_training=background_training,
+                    train_iterations=train_iterations,
+                    train_time_budget=train_time_budget,
+                    near_duplicate_threshold=near_duplicate_threshold)
             # The initialization of HarmonyOS
             else:
                 self.device = DeviceHM(
@@ -155,7 +218,11 @@ class DroidBot(object):
                     humanoid=self.humanoid,
                     ignore_ad=ignore_ad,
                     is_harmonyos=self.is_harmonyos,
-                    save_log=self.save_log)
+                    save_log=self.save_log,
+                    run_store=self.run_store,
+                    perceptual_dedup=self.perceptual_dedup,
+                    hilog_app_only=self.hilog_app_only,
+                    process_refresh_interval=self.process_refresh_interval)
                 AppHM.device_serial = device_serial
                 self.app = AppHM(app_path, output_dir=self.output_dir)
 
@@ -173,7 +240,22 @@ class DroidBot(object):
                     script_path=script_path,
                     profiling_method=profiling_method,
                     master=master,
-                    replay_output=replay_output)
+                    replay_output=replay_output,
+                    resume_dir=resume_dir,
+                    text_cache_dir=text_cache_dir,
+                    warm_start_dir=warm_start_dir,
+                    text_encoder=text_encoder,
+                    inference_backend=inference_backend,
+                    inference_threads=inference_threads,
+                    pipeline=pipeline,
+                    replay_fast_forward=replay_fast_forward,
+                    replay_checkpoint_interval=replay_checkpoint_interval,
+                    detect_crashes=detect_crashes,
+                    train_interval=train_interval,
+                    background_training=background_training,
+                    train_iterations=train_iterations,
+                    train_time_budget=train_time_budget,
+                    near_duplicate_threshold=near_duplicate_threshold)
         except Exception:
             import traceback
             traceback.print_exc()
@@ -258,6 +340,7 @@ class DroidBot(object):
             import xmlrpc.client
             proxy = xmlrpc.client.ServerProxy(self.input_manager.policy.master)
             proxy.stop_worker(self.device.serial)
+        tracer.close()
 
 
 class DroidBotException(Exception):
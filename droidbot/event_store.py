@@ -0,0 +1,114 @@
+import bisect
+import json
+import logging
+import os
+
+from .run_store import RUN_STORE_FILE_NAME
+
+# All the events of a run, one JSON object per line, appended next to the event_*.json files
+EVENTS_FILE_NAME = "events.jsonl"
+
+
+class ReplayEventStore(object):
+    """
+    The events recorded in a droidbot output dir, loaded once and indexed by the state they start from,
+    so that finding the next event to replay in a state does not read any file.
+    """
+
+    def __init__(self, output_dir):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.event_dir = os.path.join(output_dir, "events")
+        self.event_dicts = []
+        self.start_state_index = {}
+        # (start_state, event_str) -> the distinct stop_states the event led to in the record
+        self.outcomes = {}
+
+        events_file_path = os.path.join(self.event_dir, EVENTS_FILE_NAME)
+        run_store_path = os.path.join(output_dir, RUN_STORE_FILE_NAME)
+        if os.path.exists(events_file_path):
+            self.__load_events_file(events_file_path)
+        elif os.path.exists(run_store_path):
+            self.__load_run_store(run_store_path)
+        else:
+            self.__load_event_files()
+        for event_idx, event_dict in enumerate(self.event_dicts):
+            self.start_state_index.setdefault(event_dict["start_state"], []).append(event_idx)
+            self.outcomes.setdefault((event_dict["start_state"], event_dict.get("event_str")), set()) \
+                .add(event_dict.get("stop_state"))
+        self.logger.info("Loaded %d events to replay from %s" % (len(self.event_dicts), self.event_dir))
+
+    def __len__(self):
+        return len(self.event_dicts)
+
+    def __load_events_file(self, events_file_path):
+        with open(events_file_path, "r") as f:
+            for line_no, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    event_dict = json.loads(line)
+                except Exception:
+                    # the last line may be partial if the recording run was killed
+                    self.logger.info("Loading line %d of %s failed" % (line_no + 1, events_file_path))
+                    continue
+                self.__add(event_dict)
+
+    def __load_event_files(self):
+        # output dirs recorded before the events file existed
+        event_paths = sorted([os.path.join(self.event_dir, x) for x in next(os.walk(self.event_dir))[2]
+                              if x.startswith("event_") and x.endswith(".json")])
+        for event_path in event_paths:
+            try:
+                with open(event_path, "r") as f:
+                    event_dict = json.load(f)
+            except Exception:
+                self.logger.info("Loading %s failed" % event_path)
+                continue
+            self.__add(event_dict)
+
+    def __load_run_store(self, run_store_path):
+        # output dirs recorded with a run store and not exported
+        from .run_store import RunStore
+        self.event_dir = run_store_path
+        run_store = RunStore(run_store_path)
+        try:
+            for event_dict in run_store.get_event_dicts():
+                self.__add(event_dict)
+        finally:
+            run_store.close()
+
+    def __add(self, event_dict):
+        if not isinstance(event_dict, dict) or "start_state" not in event_dict or "event" not in event_dict:
+            return
+        self.event_dicts.append(event_dict)
+
+    def get(self, event_idx):
+        return self.event_dicts[event_idx]
+
+    def get_name(self, event_idx):
+        return "event_%s" % self.event_dicts[event_idx].get("tag")
+
+    def is_uncertain(self, event_idx):
+        """
+        check whether the record does not guarantee that the replay is in the start state of an event,
+        i.e. the previous event did not end in it, or the previous event led to different states in the record
+        """
+        if event_idx == 0:
+            return True
+        prev_event_dict = self.event_dicts[event_idx - 1]
+        if prev_event_dict.get("stop_state") != self.event_dicts[event_idx]["start_state"]:
+            return True
+        return len(self.outcomes[(prev_event_dict["start_state"], prev_event_dict.get("event_str"))]) > 1
+
+    def find(self, state_str, from_idx=0):
+        """
+        find the first event starting from a state, at or after a position of the replay
+        :param state_str: the state_str of the current state
+        :param from_idx: the position of the replay cursor
+        :return: the position of the event, or None if there is no such event
+        """
+        event_idxs = self.start_state_index.get(state_str)
+        if not event_idxs:
+            return None
+        i = bisect.bisect_left(event_idxs, from_idx)
+        return event_idxs[i] if i < len(event_idxs) else None
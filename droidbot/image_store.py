@@ -0,0 +1,186 @@
+import collections
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import threading
+
+IMAGES_DIR_NAME = "images"
+THUMBNAILS_DIR_NAME = "thumbnails"
+# Max size of the screenshot thumbnails shown in the UTG of the report
+THUMBNAIL_SIZE = (180, 360)
+# Number of decoded screenshots kept in memory to crop views from
+MAX_DECODED_IMAGES = 4
+# Size of the grayscale image a perceptual hash is computed from, one bit per adjacent pixel pair
+PERCEPTUAL_HASH_SIZE = (9, 8)
+
+
+class ImageStore(object):
+    """
+    Content-addressed store of the screenshots and view images of a run.
+    Each distinct image is written once under <output_dir>/images,
+    and the files of the output layout (states/screen_*, views/view_*) are hard links to it.
+    With perceptual hashing, screenshots that only differ by a few pixels are also stored once.
+    Thumbnails of the screenshots are generated in a background thread for the report.
+    """
+
+    def __init__(self, output_dir, perceptual=False, thumbnails=True):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.output_dir = output_dir
+        self.store_dir = os.path.join(output_dir, IMAGES_DIR_NAME)
+        self.thumbnail_dir = os.path.join(output_dir, THUMBNAILS_DIR_NAME)
+        self.perceptual = perceptual
+        self.lock = threading.Lock()
+        # digest -> path of the stored image
+        self.stored_paths = {}
+        # path of a file in the output layout -> digest of its content
+        self.file_digests = {}
+        self.decoded_images = collections.OrderedDict()
+        # digest -> path of the thumbnail, once generated
+        self.thumbnail_paths = {}
+
+        self.thumbnail_queue = None
+        self.thumbnail_thread = None
+        if thumbnails:
+            self.thumbnail_queue = queue.Queue()
+            self.thumbnail_thread = threading.Thread(target=self.__generate_thumbnails, daemon=True)
+            self.thumbnail_thread.start()
+
+    def close(self):
+        """
+        finish generating the queued thumbnails
+        """
+        if self.thumbnail_thread is not None:
+            self.thumbnail_queue.put(None)
+            self.thumbnail_thread.join()
+            self.thumbnail_thread = None
+
+    @staticmethod
+    def get_perceptual_hash(img):
+        """
+        difference hash of an image, equal for images that only differ by noise or a few pixels
+        :param img: PIL Image
+        :return: str
+        """
+        from PIL import Image
+        img.draft("L", (PERCEPTUAL_HASH_SIZE[0] * 8, PERCEPTUAL_HASH_SIZE[1] * 8))
+        pixels = list(img.convert("L").resize(PERCEPTUAL_HASH_SIZE, Image.BILINEAR).getdata())
+        width = PERCEPTUAL_HASH_SIZE[0]
+        bits = 0
+        for row in range(PERCEPTUAL_HASH_SIZE[1]):
+            for col in range(width - 1):
+                bits = (bits << 1) | (pixels[row * width + col] > pixels[row * width + col + 1])
+        return "%016x" % bits
+
+    def __get_digest(self, file_path):
+        if self.perceptual:
+            from PIL import Image
+            with Image.open(file_path) as img:
+                return "p%s%s" % (self.get_perceptual_hash(img), os.path.splitext(file_path)[1])
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        return sha1.hexdigest() + os.path.splitext(file_path)[1]
+
+    def __link(self, stored_path, dest_path):
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.link(stored_path, dest_path)
+        except OSError:
+            # e.g. the file system does not support hard links
+            shutil.copyfile(stored_path, dest_path)
+
+    def add_screenshot(self, src_path, dest_path):
+        """
+        store a screenshot and link it to a path of the output layout
+        :param src_path: the screenshot taken from the device
+        :param dest_path: the path in the output layout
+        """
+        digest = self.__get_digest(src_path)
+        with self.lock:
+            stored_path = self.stored_paths.get(digest)
+            is_new = stored_path is None
+            if is_new:
+                if not os.path.exists(self.store_dir):
+                    os.makedirs(self.store_dir)
+                stored_path = os.path.join(self.store_dir, digest)
+                shutil.copyfile(src_path, stored_path)
+                self.stored_paths[digest] = stored_path
+            self.file_digests[os.path.abspath(dest_path)] = digest
+        self.__link(stored_path, dest_path)
+        if is_new and self.thumbnail_queue is not None:
+            self.thumbnail_queue.put((digest, stored_path))
+
+    def __get_decoded_image(self, file_path):
+        from PIL import Image
+        img = self.decoded_images.get(file_path)
+        if img is None:
+            img = Image.open(file_path)
+            img.load()
+            self.decoded_images[file_path] = img
+            while len(self.decoded_images) > MAX_DECODED_IMAGES:
+                self.decoded_images.popitem(last=False)
+        else:
+            self.decoded_images.move_to_end(file_path)
+        return img
+
+    def add_view_img(self, screenshot_path, bounds, dest_path):
+        """
+        crop the image of a view from a screenshot, store it and link it to a path of the output layout.
+        The screenshot is decoded once for all its views, and the crop is only encoded if it is new.
+        :param screenshot_path: the screenshot of the state the view is in
+        :param bounds: the bounds of the view
+        :param dest_path: the path in the output layout
+        """
+        original_img = self.__get_decoded_image(screenshot_path)
+        view_img = original_img.crop((min(original_img.width - 1, max(0, bounds[0][0])),
+                                      min(original_img.height - 1, max(0, bounds[0][1])),
+                                      min(original_img.width, max(0, bounds[1][0])),
+                                      min(original_img.height, max(0, bounds[1][1])))).convert("RGB")
+        sha1 = hashlib.sha1(view_img.tobytes())
+        sha1.update(str(view_img.size).encode("utf-8"))
+        digest = "v%s%s" % (sha1.hexdigest(), os.path.splitext(dest_path)[1])
+        with self.lock:
+            stored_path = self.stored_paths.get(digest)
+            if stored_path is None:
+                if not os.path.exists(self.store_dir):
+                    os.makedirs(self.store_dir)
+                stored_path = os.path.join(self.store_dir, digest)
+                view_img.save(stored_path)
+                self.stored_paths[digest] = stored_path
+            self.file_digests[os.path.abspath(dest_path)] = digest
+        self.__link(stored_path, dest_path)
+
+    def get_thumbnail_path(self, file_path):
+        """
+        get the thumbnail of a screenshot added to the store
+        :param file_path: the path of the screenshot in the output layout
+        :return: the path of the thumbnail, or None if it is not generated (yet)
+        """
+        with self.lock:
+            digest = self.file_digests.get(os.path.abspath(file_path))
+            return self.thumbnail_paths.get(digest) if digest is not None else None
+
+    def __generate_thumbnails(self):
+        from PIL import Image
+        while True:
+            item = self.thumbnail_queue.get()
+            if item is None:
+                break
+            digest, stored_path = item
+            try:
+                if not os.path.exists(self.thumbnail_dir):
+                    os.makedirs(self.thumbnail_dir)
+                thumbnail_path = os.path.join(self.thumbnail_dir, "%s.jpeg" % os.path.splitext(digest)[0])
+                with Image.open(stored_path) as img:
+                    img.draft("RGB", THUMBNAIL_SIZE)
+                    img = img.convert("RGB")
+                    img.thumbnail(THUMBNAIL_SIZE)
+                    img.save(thumbnail_path)
+                with self.lock:
+                    self.thumbnail_paths[digest] = thumbnail_path
+            except Exception as e:
+                self.logger.warning("Generating the thumbnail of %s failed: %s" % (stored_path, e))
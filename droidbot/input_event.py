@@ -1,11 +1,15 @@
+import hashlib
 import json
 import os
 import random
 import time
+import weakref
 from abc import abstractmethod
 import logging
 from . import utils
 from .intent import Intent
+from .event_store import EVENTS_FILE_NAME
+from .tracer import traced, IO_CATEGORY
 import typing
 if typing.TYPE_CHECKING:
     from .device_hm import DeviceHM
@@ -14,6 +18,11 @@ if typing.TYPE_CHECKING:
     from .app import App
     from .app_hm import AppHM
 
+# Digest size in bytes of the compact key identifying an event in a state
+EVENT_KEY_SIZE = 8
+# event -> {(state_str, cluster_str): event key}, kept out of the events so that they serialize as before
+_event_key_memo = weakref.WeakKeyDictionary()
+
 POSSIBLE_KEYS = [
     "BACK",
     "MENU",
@@ -95,6 +104,13 @@ class InvalidEventException(Exception):
     pass
 
 
+def get_event_str_key(event_str):
+    """
+    get the compact key of an event from its event str, see InputEvent.get_event_key
+    """
+    return hashlib.blake2b(event_str.encode("utf-8"), digest_size=EVENT_KEY_SIZE).hexdigest()
+
+
 class InputEvent(object):
     """
     The base class of all events
@@ -104,6 +120,11 @@ class InputEvent(object):
         self.log_lines = None
         
 
+    def __setattr__(self, key, value):
+        # the memoized keys are stale once the event changes, e.g. the text of a SetTextEvent
+        _event_key_memo.pop(self, None)
+        object.__setattr__(self, key, value)
+
     def to_dict(self):
         return self.__dict__
 
@@ -159,11 +180,34 @@ class InputEvent(object):
             return ExitEvent(event_dict=event_dict)
         elif event_type == KEY_SpawnEvent:
             return SpawnEvent(event_dict=event_dict)
+        elif event_type == KEY_KillAppEvent:
+            return KillAppEvent(event_dict=event_dict)
 
     @abstractmethod
     def get_event_str(self, state):
         pass
 
+    def get_event_key(self, state, cluster_str=None):
+        """
+        get a compact fixed-width key identifying this event in the given state
+        the key is memoized on the event, use get_event_str for a human-readable description
+        :param state: DeviceState
+        :param cluster_str: if given, identify the event in the cluster of near-identical states instead of the state
+        :return: str, hex digest of the event str
+        """
+        memo = _event_key_memo.get(self)
+        if memo is None:
+            memo = _event_key_memo[self] = {}
+        memo_key = (state.state_str, cluster_str)
+        if memo_key in memo:
+            return memo[memo_key]
+        event_str = self.get_event_str(state)
+        if cluster_str is not None:
+            event_str = event_str.replace(state.state_str, cluster_str)
+        event_key = get_event_str_key(event_str)
+        memo[memo_key] = event_key
+        return event_key
+
     def get_views(self):
         return []
 
@@ -208,6 +252,7 @@ class EventLog(object):
             "event_str": self.event_str
         }
 
+    @traced("event save", IO_CATEGORY)
     def save2dir(self, output_dir=None):
         # Save event
         if output_dir is None:
@@ -216,12 +261,19 @@ class EventLog(object):
             else:
                 output_dir = os.path.join(self.device.output_dir, "events")
         try:
+            event_dict = self.to_dict()
+            if self.device.run_store is not None:
+                self.device.run_store.add_event(event_dict)
+                return
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             event_json_file_path = "%s/event_%s.json" % (output_dir, self.tag)
             event_json_file = open(event_json_file_path, "w")
-            json.dump(self.to_dict(), event_json_file, indent=2)
+            json.dump(event_dict, event_json_file, indent=2)
             event_json_file.close()
+            # the same record in the events file, which is read at once when replaying the run
+            with open(os.path.join(output_dir, EVENTS_FILE_NAME), "a") as events_file:
+                events_file.write(json.dumps(event_dict) + "\n")
         except Exception as e:
             self.device.logger.warning("Saving event to dir failed.")
             self.device.logger.warning(e)
@@ -3,7 +3,9 @@ import logging
 import subprocess
 import time
 
-from .input_event import EventLog
+from .input_event import EventLog, IntentEvent, KillAppEvent
+from .tracer import traced
+from .utg import NEAR_DUPLICATE_THRESHOLD
 from .input_policy import (
     UtgBasedInputPolicy, UtgNaiveSearchPolicy, UtgGreedySearchPolicy,
     UtgReplayPolicy, ManualPolicy, RandomPolicy,
@@ -34,7 +36,11 @@ class InputManager(object):
     def __init__(self, device, app, policy_name, random_input,
                  event_count, event_interval,
                  script_path=None, profiling_method=None, master=None,
-                 replay_output=None):
+                 replay_output=None, resume_dir=None, text_cache_dir=None,
+                 warm_start_dir=None, text_encoder="bert", inference_backend="eager", inference_threads=None,
+                 pipeline=False, replay_fast_forward=False, replay_checkpoint_interval=None,
+                 detect_crashes=False, train_interval=10, background_training=True,
+                 train_iterations=10, train_time_budget=None, near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD):
         """
         manage input event sent to the target device
         :param device: instance of Device
@@ -55,8 +61,26 @@ class InputManager(object):
         self.event_count = event_count
         self.event_interval = event_interval
         self.replay_output = replay_output
+        self.resume_dir = resume_dir
+        self.text_cache_dir = text_cache_dir
+        self.warm_start_dir = warm_start_dir
+        self.text_encoder = text_encoder
+        self.inference_backend = inference_backend
+        self.inference_threads = inference_threads
+        self.pipeline = pipeline
+        self.replay_fast_forward = replay_fast_forward
+        self.replay_checkpoint_interval = replay_checkpoint_interval
+        self.train_interval = train_interval
+        self.background_training = background_training
+        self.train_iterations = train_iterations
+        self.train_time_budget = train_time_budget
+        self.near_duplicate_threshold = near_duplicate_threshold
 
         self.monkey = None
+        self.crash_detector = None
+        if detect_crashes:
+            from .crash_detector import CrashDetector
+            self.crash_detector = CrashDetector(device, app)
 
         if script_path is not None:
             f = open(script_path, 'r')
@@ -80,12 +104,21 @@ class InputManager(object):
             input_policy = UtgGreedySearchPolicy(device, app, self.random_input, self.policy_name)
         elif self.policy_name == POLICY_MEMORY_GUIDED:
             from .input_policy2 import MemoryGuidedPolicy
-            input_policy = MemoryGuidedPolicy(device, app, self.random_input)
+            input_policy = MemoryGuidedPolicy(device, app, self.random_input, text_cache_dir=self.text_cache_dir,
+                                              text_encoder=self.text_encoder,
+                                              inference_backend=self.inference_backend,
+                                              inference_threads=self.inference_threads,
+                                              warm_start_dir=self.warm_start_dir,
+                                              train_interval=self.train_interval,
+                                              background_training=self.background_training,
+                                              train_iterations=self.train_iterations,
+                                              train_time_budget=self.train_time_budget)
         elif self.policy_name == POLICY_LLM_GUIDED:
             from .input_policy3 import LLM_Guided_Policy
             input_policy = LLM_Guided_Policy(device, app, self.random_input)
         elif self.policy_name == POLICY_REPLAY:
-            input_policy = UtgReplayPolicy(device, app, self.replay_output)
+            input_policy = UtgReplayPolicy(device, app, self.replay_output, fast_forward=self.replay_fast_forward,
+                                           checkpoint_interval=self.replay_checkpoint_interval)
         elif self.policy_name == POLICY_MANUAL:
             input_policy = ManualPolicy(device, app)
         else:
@@ -94,25 +127,84 @@ class InputManager(object):
         if isinstance(input_policy, UtgBasedInputPolicy):
             input_policy.script = self.script
             input_policy.master = master
+            input_policy.utg.set_near_duplicate_threshold(self.near_duplicate_threshold)
+            if self.resume_dir is not None:
+                input_policy.utg.resume(self.resume_dir)
         return input_policy
 
-    def add_event(self, event:"InputEvent"):
+    def add_event(self, event:"InputEvent", capture_states=True):
         """
         add one event to the event list
         :param event: the event to be added, should be subclass of AppEvent
+        :param capture_states: whether to capture and record the states before and after the event
         :return:
         """
         if event is None:
             return
         self.events.append(event)
+        self.expect_kill(event)
+
+        if not capture_states:
+            # fast-forward replay, the policy checks the position itself
+            self.device.send_event(event)
+            self.wait_event_interval(self.event_interval)
+            if self.crash_detector is not None and self.crash_detector.has_crash():
+                self.restart_after_crash(event_str=str(event))
+            return
 
         event_log = EventLog(self.device, self.app, event, self.profiling_method)
         event_log.start()
-        while True:
+        interval_start_time = time.perf_counter()
+        if self.pipeline and self.policy is not None:
+            # prepare the next decision while the device settles
+            self.policy.speculate(event)
+        self.wait_event_interval(max(0.0, self.event_interval - (time.perf_counter() - interval_start_time)))
+        while self.device.pause_sending_event:
             time.sleep(self.event_interval)
-            if not self.device.pause_sending_event:
-                break
         event_log.stop()
+        if self.crash_detector is not None and self.crash_detector.has_crash():
+            from_state_str = event_log.from_state.state_str if event_log.from_state is not None else None
+            self.restart_after_crash(event_str=event_log.event_str, state_str=from_state_str)
+
+    def expect_kill(self, event:"InputEvent"):
+        """
+        tell the crash detector when the app is killed on purpose, so that its death is not a crash
+        """
+        if self.crash_detector is not None and isinstance(event, KillAppEvent):
+            self.crash_detector.expect_kill()
+
+    @traced("settle wait")
+    def wait_event_interval(self, interval):
+        """
+        wait for the device to settle after an event, stopping early if the app crashes
+        """
+        if self.crash_detector is not None:
+            self.crash_detector.wait(interval)
+        else:
+            time.sleep(interval)
+
+    def restart_after_crash(self, event_str=None, state_str=None):
+        """
+        record the crashes the event triggered and restart the app at once
+        :param event_str: the event sent before the crash
+        :param state_str: the state the event was sent in
+        """
+        for crash in self.crash_detector.pop_crashes():
+            self.crash_detector.save_crash(crash, event_str=event_str, state_str=state_str)
+        self.logger.info("Restarting the app after a crash")
+        if self.policy is not None:
+            self.policy.on_app_crash()
+        # the restart is logged like the other events, so that it is in the output and replayed
+        for event in [KillAppEvent(app=self.app), IntentEvent(self.app.get_start_intent())]:
+            self.events.append(event)
+            self.expect_kill(event)
+            event_log = EventLog(self.device, self.app, event, self.profiling_method)
+            event_log.start()
+            time.sleep(self.event_interval)
+            event_log.stop()
+        # the crashes detected during the restart, e.g. when the app crashes at launch
+        for crash in self.crash_detector.pop_crashes():
+            self.crash_detector.save_crash(crash, event_str=event_log.event_str)
 
     def start(self):
         """
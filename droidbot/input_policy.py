@@ -2,11 +2,15 @@ import sys
 import json
 import logging
 import random
+import threading
 import time
 from abc import abstractmethod
 
 from .input_event import InputEvent, KeyEvent, IntentEvent, TouchEvent, ManualEvent, SetTextEvent, KillAppEvent
+from .intent import Intent
 from .utg import UTG
+from .event_store import ReplayEventStore
+from .tracer import tracer
 
 import typing
 if typing.TYPE_CHECKING:
@@ -15,6 +19,7 @@ if typing.TYPE_CHECKING:
     from .device_hm import DeviceHM
     from .app import App
     from .app_hm import AppHM
+    from .device_state import DeviceState
 
 # Max number of restarts
 MAX_NUM_RESTARTS = 5
@@ -23,6 +28,8 @@ MAX_NUM_STEPS_OUTSIDE = 5
 MAX_NUM_STEPS_OUTSIDE_KILL = 10
 # Max number of replay tries
 MAX_REPLY_TRIES = 5
+# Max number of events sent between two position checks in fast-forward replay
+DEFAULT_REPLAY_CHECKPOINT_INTERVAL = 10
 
 # Some input event flags
 EVENT_FLAG_STARTED = "+started"
@@ -62,6 +69,8 @@ class InputPolicy(object):
         self.app = app
         self.action_count = 0
         self.master = None
+        # the fixed wait after each event, set by the input manager
+        self.event_interval = 0
 
         self.cache_time = time.perf_counter()
 
@@ -70,6 +79,7 @@ class InputPolicy(object):
         start producing events
         :param input_manager: instance of InputManager
         """
+        self.event_interval = input_manager.event_interval
         self.action_count = 0
         while input_manager.enabled and self.action_count < input_manager.event_count:
             try:
@@ -79,11 +89,12 @@ class InputPolicy(object):
                 #     event = KeyEvent(name="HOME")
                 # elif self.action_count == 1 and self.master is None:
                 #     event = IntentEvent(self.app.get_start_intent())
-                if self.action_count == 0 and self.master is None:
-                    event = KillAppEvent(app=self.app)
-                else:
-                    event = self.generate_event()
-                input_manager.add_event(event)
+                with tracer.step(self.action_count):
+                    if self.action_count == 0 and self.master is None:
+                        event = KillAppEvent(app=self.app)
+                    else:
+                        event = self.generate_event()
+                    input_manager.add_event(event)
 
                 self.logger.debug("Input event cost time {:3f}s".format((current_time := time.perf_counter()) - self.cache_time))
                 self.cache_time = current_time
@@ -110,6 +121,20 @@ class InputPolicy(object):
         """
         pass
 
+    def speculate(self, event:"InputEvent"):
+        """
+        called right after an event is sent, while the device settles,
+        to prepare the next decision ahead of time
+        @param event: the event just sent
+        """
+        pass
+
+    def on_app_crash(self):
+        """
+        called when the app crashed after the last event and has been restarted
+        """
+        pass
+
 
 class NoneInputPolicy(InputPolicy):
     """
@@ -141,6 +166,8 @@ class UtgBasedInputPolicy(InputPolicy):
         self.last_event = None
         self.last_state = None
         self.current_state = None
+        self.last_event_time = None
+        self.speculation_thread = None
         self.utg = UTG(device=device, app=app, random_input=random_input)
         self.script_event_idx = 0
         if self.device.humanoid is not None:
@@ -156,6 +183,8 @@ class UtgBasedInputPolicy(InputPolicy):
 
         # Get current device state
         self.current_state = self.device.get_current_state()
+        # the policy is only updated once the speculation on the previous event is done
+        self.wait_speculation()
         if self.current_state is None:
             import time
             time.sleep(5)
@@ -186,7 +215,8 @@ class UtgBasedInputPolicy(InputPolicy):
                 self.script_event_idx = 1
 
         if event is None:
-            event = self.generate_event_based_on_utg()
+            with tracer.span("policy decision"):
+                event = self.generate_event_based_on_utg()
 
         # update last events for humanoid
         if self.device.humanoid is not None:
@@ -196,10 +226,15 @@ class UtgBasedInputPolicy(InputPolicy):
 
         self.last_state = self.current_state
         self.last_event = event
+        self.last_event_time = time.perf_counter()
         return event
 
     def __update_utg(self):
-        self.utg.add_transition(self.last_event, self.last_state, self.current_state)
+        # wall-clock cost of the last event, from generating it to getting the state it led to,
+        # without the fixed wait after it
+        cost = max(0.0, time.perf_counter() - self.last_event_time - self.event_interval) \
+            if self.last_event_time is not None else None
+        self.utg.add_transition(self.last_event, self.last_state, self.current_state, cost=cost)
 
     @abstractmethod
     def generate_event_based_on_utg(self):
@@ -209,6 +244,48 @@ class UtgBasedInputPolicy(InputPolicy):
         """
         pass
 
+    def speculate(self, event:"InputEvent"):
+        """
+        predict the state the event leads to from the UTG, and prepare the decision for it in the background,
+        overlapping with the device settling and the next state capture
+        """
+        if event is None or self.last_state is None or self.speculation_thread is not None:
+            return
+        if type(self).speculate_on_state is UtgBasedInputPolicy.speculate_on_state:
+            # nothing to prepare
+            return
+        predicted_state = self.utg.get_expected_next_state(self.last_state, event)
+        if predicted_state is None:
+            return
+        self.speculation_thread = threading.Thread(target=self.__speculate, args=(predicted_state,),
+                                                   name="Speculation", daemon=True)
+        self.speculation_thread.start()
+
+    def __speculate(self, predicted_state:"DeviceState"):
+        try:
+            self.speculate_on_state(predicted_state)
+        except Exception as e:
+            self.logger.warning("speculation failed: %s" % e)
+
+    def wait_speculation(self):
+        if self.speculation_thread is not None:
+            self.speculation_thread.join()
+            self.speculation_thread = None
+
+    def on_app_crash(self):
+        # the state after the last event is a restart, not an effect of the event
+        self.wait_speculation()
+        self.last_state = None
+
+    def speculate_on_state(self, state:"DeviceState"):
+        """
+        prepare the decision for a predicted state
+        it runs in another thread while the policy is idle, and must not change
+        what the policy does if the prediction is wrong
+        :param state: DeviceState, the predicted state
+        """
+        pass
+
 
 class RandomPolicy(UtgBasedInputPolicy):
     def __init__(self, device, app, random_input):
@@ -586,16 +663,17 @@ class UtgReplayPolicy(InputPolicy):
     Replay DroidBot output generated by UTG policy
     """
 
-    def __init__(self, device, app, replay_output):
+    def __init__(self, device, app, replay_output, fast_forward=False, checkpoint_interval=None):
         super(UtgReplayPolicy, self).__init__(device, app)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.replay_output = replay_output
+        self.fast_forward = fast_forward
+        self.checkpoint_interval = checkpoint_interval if checkpoint_interval is not None \
+            else DEFAULT_REPLAY_CHECKPOINT_INTERVAL
+        self.num_unchecked_events = 0
+        self.num_resyncs = 0
 
-        import os
-        event_dir = os.path.join(replay_output, "events")
-        self.event_paths = sorted([os.path.join(event_dir, x) for x in
-                                   next(os.walk(event_dir))[2]
-                                   if x.endswith(".json")])
+        self.event_store = ReplayEventStore(replay_output)
         # skip HOME and start app intent
         self.device = device
         self.app = app
@@ -611,8 +689,7 @@ class UtgReplayPolicy(InputPolicy):
         generate an event based on replay_output
         @return: InputEvent
         """
-        import time
-        while self.event_idx < len(self.event_paths) and \
+        while self.event_idx < len(self.event_store) and \
               self.num_replay_tries < MAX_REPLY_TRIES:
             self.num_replay_tries += 1
             current_state = self.device.get_current_state()
@@ -621,40 +698,91 @@ class UtgReplayPolicy(InputPolicy):
                 self.num_replay_tries = 0
                 return KeyEvent(name="BACK")
 
-            curr_event_idx = self.event_idx
+            self.current_state = current_state
             self.__update_utg()
-            while curr_event_idx < len(self.event_paths):
-                event_path = self.event_paths[curr_event_idx]
-                with open(event_path, "r") as f:
-                    curr_event_idx += 1
-
-                    try:
-                        event_dict = json.load(f)
-                    except Exception as e:
-                        self.logger.info("Loading %s failed" % event_path)
-                        continue
-
-                    if event_dict["start_state"] != current_state.state_str:
-                        continue
-                    if not self.device.is_foreground(self.app):
-                        # if current app is in background, bring it to foreground
-                        component = self.app.get_package_name()
-                        if self.app.get_main_activity():
-                            component += "/%s" % self.app.get_main_activity()
-                        return IntentEvent(Intent(suffix=component))
-                    
-                    self.logger.info("Replaying %s" % event_path)
-                    self.event_idx = curr_event_idx
-                    self.num_replay_tries = 0
-                    # return InputEvent.from_dict(event_dict["event"])
-                    event = InputEvent.from_dict(event_dict["event"])
-                    self.last_state = self.current_state
-                    self.last_event = event
-                    return event                    
+            event_idx = self.event_store.find(current_state.state_str, self.event_idx)
+            if event_idx is not None:
+                if not self.device.is_foreground(self.app):
+                    # if current app is in background, bring it to foreground
+                    component = self.app.get_package_name()
+                    if self.app.get_main_activity():
+                        component += "/%s" % self.app.get_main_activity()
+                    return IntentEvent(Intent(suffix=component))
+
+                self.logger.info("Replaying %s" % self.event_store.get_name(event_idx))
+                self.event_idx = event_idx + 1
+                self.num_replay_tries = 0
+                event = InputEvent.from_dict(self.event_store.get(event_idx)["event"])
+                self.last_state = self.current_state
+                self.last_event = event
+                return event
 
             time.sleep(5)
 
         # raise InputInterruptedException("No more record can be replayed.")
+
+    def start(self, input_manager:"InputManager"):
+        """
+        replay the events, fast-forwarding if enabled
+        :param input_manager: instance of InputManager
+        """
+        if not self.fast_forward:
+            return super(UtgReplayPolicy, self).start(input_manager)
+        self.event_interval = input_manager.event_interval
+        self.action_count = 0
+        # the first event restarts the app and the first replayed event resynchronizes, both with full captures
+        self.num_unchecked_events = self.checkpoint_interval
+        while input_manager.enabled and self.action_count < input_manager.event_count \
+                and self.event_idx < len(self.event_store):
+            try:
+                with tracer.step(self.action_count):
+                    if self.action_count == 0 and self.master is None:
+                        input_manager.add_event(KillAppEvent(app=self.app))
+                    elif self.__is_position_confirmed():
+                        event = InputEvent.from_dict(self.event_store.get(self.event_idx)["event"])
+                        self.logger.info("Fast-forwarding %s" % self.event_store.get_name(self.event_idx))
+                        self.event_idx += 1
+                        self.num_unchecked_events += 1
+                        input_manager.add_event(event, capture_states=False)
+                    else:
+                        # lost the position, replay one step with a full capture to find it again
+                        self.num_resyncs += 1
+                        self.logger.info("Fast-forward replay lost the position, resynchronizing (%d so far)"
+                                         % self.num_resyncs)
+                        event = self.generate_event()
+                        if event is None:
+                            break
+                        input_manager.add_event(event)
+                        self.num_unchecked_events = 0
+            except KeyboardInterrupt:
+                break
+            except InputInterruptedException as e:
+                self.logger.warning("stop sending events: %s" % e)
+                break
+            except Exception as e:
+                self.logger.warning("exception during sending events: %s" % e)
+                import traceback
+                traceback.print_exc()
+                continue
+            self.action_count += 1
+
+    def on_app_crash(self):
+        # the app restarted, the position is checked before the next fast-forwarded event
+        self.num_unchecked_events = self.checkpoint_interval
+
+    def __is_position_confirmed(self):
+        """
+        check that the device is in the start state of the next recorded event,
+        by comparing the layout only at checkpoints and where the record is uncertain
+        """
+        if self.num_unchecked_events < self.checkpoint_interval and not self.event_store.is_uncertain(self.event_idx):
+            return True
+        layout_state = self.device.get_layout_state()
+        if layout_state is None or layout_state.state_str != self.event_store.get(self.event_idx)["start_state"]:
+            return False
+        self.num_unchecked_events = 0
+        return True
+
     def __update_utg(self):
         self.utg.add_transition(self.last_event, self.last_state, self.current_state)
 
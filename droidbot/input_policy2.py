@@ -1,8 +1,11 @@
 import logging
 import collections
 import copy
+import hashlib
 import logging
+import os
 import random
+import threading
 import time
 import math
 
@@ -27,6 +30,84 @@ MAX_NUM_STEPS_OUTSIDE = 3
 MAX_NUM_STEPS_OUTSIDE_KILL = 5
 MAX_NAV_STEPS = 10
 
+# Train the model every this many actions
+TRAIN_INTERVAL = 10
+# Optimizer iterations per training round
+TRAIN_ITERATIONS = 10
+# Max seconds per training round, None for no limit
+TRAIN_TIME_BUDGET = None
+# Train in a background thread, so that exploration keeps going with the previous model
+BACKGROUND_TRAINING = True
+# Max number of states re-embedded in one forward pass after the model is updated
+REEMBED_BATCH_SIZE = 32
+# Checkpoint of the model and the known transitions, written to the output dir after each training round
+MEMORY_CHECKPOINT_FILE_NAME = 'memory_checkpoint.pt'
+
+# Max number of text embeddings kept in memory
+TEXT_CACHE_SIZE = 10000
+# Max number of texts encoded in one forward pass
+TEXT_BATCH_SIZE = 64
+
+# Size of the hashed character n-gram text embeddings
+HASH_EMBED_SIZE = 256
+# Lengths of the character n-grams hashed into the text embeddings
+HASH_NGRAM_SIZES = (1, 2, 3)
+# Number of signed dimensions each n-gram is projected to
+HASH_NUM_PROJECTIONS = 4
+
+# How the embedding models run on CPU: eager PyTorch,
+# int8 dynamic quantization of the linear layers, or torch.compile
+INFERENCE_BACKENDS = ['eager', 'int8', 'compile']
+INFERENCE_BACKEND = 'eager'
+# Number of intra-op threads used by torch, None to keep the torch default
+INFERENCE_THREADS = None
+
+
+VIEW_META_KEYS = [
+    'is_password', 'visible', 'enabled', 'checked', 'selected',
+    'clickable', 'long_clickable', 'checkable', 'editable', 'scrollable'
+]
+
+
+def get_view_features(state, views):
+    """
+    extract the features of all views in a state
+    :return: meta, an array of shape (len(views), 12) with the flags
+             [is_parent, is_text, is_password, visible, enabled, checked, selected,
+              clickable, long_clickable, checkable, editable, scrollable] as 1/-1,
+             and bounds, an array of shape (len(views), 4) with [l, t, r, b] normalized by the screen size
+    """
+    flags = np.array([
+        [bool(view.get('children')), bool(view.get('text'))] + [bool(view.get(key)) for key in VIEW_META_KEYS]
+        for view in views
+    ], dtype=bool).reshape(len(views), 2 + len(VIEW_META_KEYS))
+    meta = np.where(flags, 1, -1).astype(np.float32)
+    bounds = np.array([
+        view['bounds'] if 'bounds' in view else [[0, 0], [0, 0]]
+        for view in views
+    ], dtype=np.float32).reshape(len(views), 4)
+    bounds /= np.array([state.width, state.height, state.width, state.height], dtype=np.float32)
+    return meta, bounds
+
+
+def optimize_for_inference(module, backend):
+    """
+    prepare a module for CPU inference
+    the module is modified in place and must not be trained afterwards
+    :param module: nn.Module
+    :param backend: one of INFERENCE_BACKENDS
+    :return: the module to call for inference
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"unknown inference backend: {backend}")
+    module.eval()
+    if backend == 'int8':
+        return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    if backend == 'compile':
+        # the compiled graphs are cached by torch, so compiling a copy with new weights is cheap
+        return torch.compile(module, dynamic=True)
+    return module
+
 
 class UIEmbedLSTM(nn.Module):
     def __init__(self):
@@ -46,41 +127,18 @@ class UIEmbedLSTM(nn.Module):
         # self.fc = nn.Linear(input_size, output_size)
 
     def encode_state(self, state, views):
-        return torch.stack([self._encode_view(state, view) for view in views])
-
-    def _encode_view(self, state, view):
-        # print(view)
-        view_children = view['children'] if 'children' in view else []
-        is_parent = 1 if len(view_children) > 0 else -1
-        view_text = view['text'] if 'text' in view else None
-        is_text = 1 if view_text and len(view_text) > 0 else -1
-        enabled = 1 if 'enabled' in view and view['enabled'] else -1
-        visible = 1 if 'visible' in view and view['visible'] else -1
-        clickable = 1 if 'clickable' in view and view['clickable'] else -1
-        long_clickable = 1 if 'long_clickable' in view and view['long_clickable'] else -1
-        checkable = 1 if 'checkable' in view and view['checkable'] else -1
-        checked = 1 if 'checked' in view and view['checked'] else -1
-        selected = 1 if 'selected' in view and view['selected'] else -1
-        editable = 1 if 'editable' in view and view['editable'] else -1
-        is_password = 1 if 'is_password' in view and view['is_password'] else -1
-        scrollable = 1 if 'scrollable' in view and view['scrollable'] else -1
-        screen_w = state.width
-        screen_h = state.height
-        [[l,t], [r,b]] = view['bounds'] if 'bounds' in view else [[0,0], [0,0]]
-        l, r, t, b = l/screen_w, r/screen_w, t/screen_h, b/screen_h
-        view_w = abs(l - r)
-        view_h = abs(t - b)
+        meta, bounds = get_view_features(state, views)
+        l, t, r, b = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+        view_w = np.abs(l - r)
+        view_h = np.abs(t - b)
         size = view_w * view_h
-        wh_ratio = view_w / (view_h + 0.0001)
-        wh_ratio = min(wh_ratio, 10)
-        text_emb = self.text_encoder.encode(view_text)
-        encoding = np.concatenate([np.array([
-            is_parent, is_text, is_password, visible,
-            l, r, t, b, size, wh_ratio,
-            enabled, checked, selected,
-            clickable, long_clickable, checkable, editable, scrollable
-        ]), text_emb])
-        return torch.Tensor(encoding)
+        wh_ratio = np.minimum(view_w / (view_h + 0.0001), 10)
+        view_texts = [view['text'] if 'text' in view else None for view in views]
+        text_emb = self.text_encoder.encode_batch(view_texts)
+        encoding = np.concatenate([
+            meta[:, :4], np.stack([l, r, t, b, size, wh_ratio], axis=1), meta[:, 4:], text_emb
+        ], axis=1)
+        return torch.from_numpy(encoding.astype(np.float32))
 
     def forward(self, state_encs):
         state_encs = pad_sequence(state_encs, batch_first=True)
@@ -90,33 +148,163 @@ class UIEmbedLSTM(nn.Module):
 
 
 class TextEncoder:
-    def __init__(self, method='spacy'):
+    """
+    Encode view texts into vectors, with pretrained BERT or spaCy models,
+    or with hashed character n-grams ('hash'), which need no download and no training.
+    The texts are deduplicated and encoded in batches, and the embeddings are kept in a LRU cache,
+    plus an optional on-disk cache shared between runs.
+    """
+
+    def __init__(self, method='spacy', cache_size=TEXT_CACHE_SIZE, cache_dir=None, batch_size=TEXT_BATCH_SIZE,
+                 backend=INFERENCE_BACKEND):
+        self.logger = logging.getLogger(self.__class__.__name__)
         self.method = method
         self.embed_size = -1
+        self.batch_size = batch_size
+        self.backend = backend
         if method == 'spacy':
             import spacy
             self.nlp = spacy.load("en_core_web_md")
             self.embed_size = 300
         if method == 'bert':
             from transformers import BertTokenizer, BertModel
-            from torch.nn import TransformerEncoder, TransformerEncoderLayer
             self.tokenizer = BertTokenizer.from_pretrained('bert-base-multilingual-cased')
             self.text_encoder = BertModel.from_pretrained('bert-base-multilingual-cased')
+            self.text_encoder = optimize_for_inference(self.text_encoder, backend)
             self.embed_size = 768
+        if method == 'hash':
+            self.embed_size = HASH_EMBED_SIZE
+        if self.embed_size < 0:
+            raise ValueError(f"unknown text encoding method: {method}")
+
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.disk_cache = None
+        if cache_dir is not None:
+            # quantized embeddings are not mixed with the full precision ones
+            cache_method = f'{self.method}_int8' if backend == 'int8' else self.method
+            self.disk_cache = TextEmbeddingDiskCache(cache_dir, cache_method, self.embed_size)
 
     def encode(self, text):
-        if not text:
-            return np.zeros(self.embed_size)
+        return self.encode_batch([text])[0]
+
+    def encode_batch(self, texts):
+        """
+        encode a list of texts
+        :param texts: list of str, empty texts are encoded as zeros
+        :return: numpy array of shape (len(texts), embed_size)
+        """
+        embs = np.zeros((len(texts), self.embed_size), dtype=np.float32)
+        missing_texts = []
+        for text in set(texts):
+            if not text or text in self.cache:
+                continue
+            missing_texts.append(text)
+        if missing_texts and self.disk_cache is not None:
+            for text, emb in self.disk_cache.get_many(missing_texts).items():
+                self.__cache(text, emb)
+            missing_texts = [text for text in missing_texts if text not in self.cache]
+        if missing_texts:
+            new_embs = {}
+            for i in range(0, len(missing_texts), self.batch_size):
+                batch = missing_texts[i:i + self.batch_size]
+                for text, emb in zip(batch, self.__encode_uncached(batch)):
+                    new_embs[text] = emb
+            if self.disk_cache is not None:
+                self.disk_cache.put_many(new_embs)
+            for text, emb in new_embs.items():
+                self.__cache(text, emb)
+        for i, text in enumerate(texts):
+            if not text:
+                continue
+            # texts of the same state may evict each other if the cache is smaller than the state
+            emb = self.cache.get(text)
+            if emb is None:
+                emb = self.__encode_uncached([text])[0]
+            else:
+                self.cache.move_to_end(text)
+            embs[i] = emb
+        return embs
+
+    def __cache(self, text, emb):
+        self.cache[text] = emb
+        self.cache.move_to_end(text)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def __encode_uncached(self, texts):
         if self.method == 'spacy':
-            doc = self.nlp(text)
-            return doc.vector
+            return np.stack([doc.vector for doc in self.nlp.pipe(texts)]).astype(np.float32)
         if self.method == 'bert':
-            encoding = self.tokenizer([text], return_tensors='pt', padding=True, truncation=True)
-            input_ids = encoding['input_ids']
-            attention_mask = encoding['attention_mask']
-            text_encoder_out = self.text_encoder(input_ids, attention_mask=attention_mask)
-            text_emb = text_encoder_out['pooler_output'][0]
-            return text_emb.detach().cpu().numpy()
+            encoding = self.tokenizer(texts, return_tensors='pt', padding=True, truncation=True)
+            with torch.inference_mode():
+                text_encoder_out = self.text_encoder(encoding['input_ids'], attention_mask=encoding['attention_mask'])
+            return text_encoder_out['pooler_output'].cpu().numpy().astype(np.float32)
+        if self.method == 'hash':
+            return np.stack([self.__hash_encode(text) for text in texts])
+
+    def __hash_encode(self, text):
+        # each n-gram adds +1/-1 to a few dimensions picked by its hash, i.e. a sparse random projection
+        # of the n-gram counts that is computed without storing the projection matrix
+        emb = np.zeros(self.embed_size, dtype=np.float32)
+        padded_text = f' {text} '
+        for n in HASH_NGRAM_SIZES:
+            for i in range(len(padded_text) - n + 1):
+                digest = hashlib.blake2b(padded_text[i:i + n].encode('utf-8'), digest_size=4 * HASH_NUM_PROJECTIONS).digest()
+                for k in range(HASH_NUM_PROJECTIONS):
+                    h = int.from_bytes(digest[4 * k:4 * k + 4], 'big')
+                    emb[(h >> 1) % self.embed_size] += 1 if h & 1 else -1
+        norm = np.linalg.norm(emb)
+        return emb / norm if norm > 0 else emb
+
+
+class TextEmbeddingDiskCache:
+    """
+    Persistent cache of text embeddings, stored as a SQLite database keyed by the hash of the text.
+    """
+
+    def __init__(self, cache_dir, method, embed_size):
+        import sqlite3
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.method = method
+        self.embed_size = embed_size
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.db_path = os.path.join(cache_dir, f"text_emb_{method}.db")
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS text_emb (text_hash TEXT PRIMARY KEY, emb BLOB NOT NULL)")
+        self.conn.commit()
+
+    @staticmethod
+    def __get_text_hash(text):
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get_many(self, texts):
+        """
+        :return: dict from text to embedding, for the texts found in the cache
+        """
+        hash2text = {self.__get_text_hash(text): text for text in texts}
+        hashes = list(hash2text.keys())
+        results = {}
+        # keep the number of parameters under the SQLite limit
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            rows = self.conn.execute("SELECT text_hash, emb FROM text_emb WHERE text_hash IN (%s)"
+                                     % ",".join("?" * len(batch)), batch).fetchall()
+            for text_hash, emb in rows:
+                emb = np.frombuffer(emb, dtype=np.float32)
+                if emb.shape[0] == self.embed_size:
+                    results[hash2text[text_hash]] = emb
+        return results
+
+    def put_many(self, text2emb):
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO text_emb VALUES (?, ?)",
+                                      [(self.__get_text_hash(text), np.asarray(emb, dtype=np.float32).tobytes())
+                                       for text, emb in text2emb.items()])
+        except Exception as e:
+            self.logger.warning(f"failed to write text embedding cache: {e}")
 
 
 class BertLayerNorm(nn.Module):
@@ -185,13 +373,14 @@ class AbsolutePositionalEncoding(nn.Module):
 
 class UIEmbedTransformer(nn.Module):
 
-    def __init__(self, nhid=64, nhead=2, nlayers=2, dropout=0.8):
+    def __init__(self, nhid=64, nhead=2, nlayers=2, dropout=0.8, text_cache_dir=None, text_encoder='bert',
+                 inference_backend=INFERENCE_BACKEND):
         super().__init__()
         self.model_type = 'Transformer'
         # nhid must be divided by 8 if using sinusoidal positional encoding
         from torch.nn import TransformerEncoder, TransformerEncoderLayer
         self.pos_max = 128
-        self.text_encoder = TextEncoder(method='bert')
+        self.text_encoder = TextEncoder(method=text_encoder, cache_dir=text_cache_dir, backend=inference_backend)
         dim_feedforward = 256
         encoder_layers = TransformerEncoderLayer(nhid, nhead, dim_feedforward, dropout)
         self.transformer_encoder = TransformerEncoder(encoder_layers, nlayers)
@@ -208,89 +397,87 @@ class UIEmbedTransformer(nn.Module):
         return output
 
     def encode_state(self, state, views):
-        meta_enc = torch.stack([self._encode_view_meta(state, view) for view in views])
-        pos_enc = torch.stack([self._encode_view_pos(state, view) for view in views])
-        text_enc = torch.stack([self._encode_view_text(state, view) for view in views])
+        meta, bounds = get_view_features(state, views)
+        meta_enc = torch.from_numpy(meta)
+        pos_enc = torch.from_numpy(self._quantize_bounds(bounds))
+        view_texts = [view['text'] if 'text' in view else None for view in views]
+        text_enc = torch.from_numpy(self.text_encoder.encode_batch(view_texts))
         return meta_enc, pos_enc, text_enc
 
     def encode_state_batch(self, state_encs):
-        embs = []
-        for state_enc in state_encs:
-            meta_enc, pos_enc, text_enc = state_enc
-            # pos_enc = self.pos_encoder(src)
-            meta_emb = self.meta2hid(meta_enc)
-            pos_emb = self.pos2hid(pos_enc)
-            text_emb = self.text2hid(text_enc)
-            # emb = torch.cat([meta_emb, pos_emb, text_emb], dim=1)
-            emb = meta_emb + pos_emb + text_emb
-            emb = self.layer_norm(emb)
-            emb = self.dropout(emb)
-            embs.append(emb)
-        embs_pad = pad_sequence(embs, batch_first=False)
-        attn_mask = embs_pad.sum(axis=2).t() == 0
+        # embed the views of all states at once, then split them back into a padded batch
+        lengths = [state_enc[0].size(0) for state_enc in state_encs]
+        meta_enc = torch.cat([state_enc[0] for state_enc in state_encs])
+        pos_enc = torch.cat([state_enc[1] for state_enc in state_encs])
+        text_enc = torch.cat([state_enc[2] for state_enc in state_encs])
+        meta_emb = self.meta2hid(meta_enc)
+        pos_emb = self.pos2hid(pos_enc)
+        text_emb = self.text2hid(text_enc)
+        emb = meta_emb + pos_emb + text_emb
+        emb = self.layer_norm(emb)
+        emb = self.dropout(emb)
+        embs_pad = pad_sequence(torch.split(emb, lengths), batch_first=False)
+        attn_mask = torch.arange(embs_pad.size(0)).unsqueeze(0) >= torch.tensor(lengths).unsqueeze(1)
         return embs_pad, attn_mask
 
-    def _encode_view_meta(self, state, view):
-        # print(view)
-        view_children = view['children'] if 'children' in view else []
-        is_parent = 1 if len(view_children) > 0 else -1
-        view_text = view['text'] if 'text' in view else None
-        is_text = 1 if view_text and len(view_text) > 0 else -1
-        enabled = 1 if 'enabled' in view and view['enabled'] else -1
-        visible = 1 if 'visible' in view and view['visible'] else -1
-        clickable = 1 if 'clickable' in view and view['clickable'] else -1
-        long_clickable = 1 if 'long_clickable' in view and view['long_clickable'] else -1
-        checkable = 1 if 'checkable' in view and view['checkable'] else -1
-        checked = 1 if 'checked' in view and view['checked'] else -1
-        selected = 1 if 'selected' in view and view['selected'] else -1
-        editable = 1 if 'editable' in view and view['editable'] else -1
-        is_password = 1 if 'is_password' in view and view['is_password'] else -1
-        scrollable = 1 if 'scrollable' in view and view['scrollable'] else -1
-        meta_enc = np.array([
-            is_parent, is_text, is_password, visible,
-            enabled, checked, selected,
-            clickable, long_clickable, checkable, editable, scrollable
-        ])
-        return torch.Tensor(meta_enc)
-
-    def _encode_view_pos(self, state, view):
-        screen_w = state.width
-        screen_h = state.height
-        [[l,t], [r,b]] = view['bounds'] if 'bounds' in view else [[0,0], [0,0]]
-        l, r, t, b = l/screen_w, r/screen_w, t/screen_h, b/screen_h
-        if l > r:
-            tmp = l
-            l = r
-            r = tmp
-        if t > b:
-            tmp = t
-            t = b
-            b = tmp
-        l = max(0, min(1, l))
-        r = max(0, min(1, r))
-        t = max(0, min(1, t))
-        b = max(0, min(1, b))
-
-        pos_max = self.pos_max - 1
-        l, r, t, b = int(pos_max*l), int(pos_max*r), int(pos_max*t), int(pos_max*b)
-        w = abs(l - r)
-        h = abs(t - b)
-        return torch.LongTensor(np.array([l, r, t, b, w, h]))
-
-    def _encode_view_text(self, state, view):
-        view_text = view['text'] if 'text' in view else None
-        emb = self.text_encoder.encode(view_text)
-        return torch.Tensor(emb)
+    def _quantize_bounds(self, bounds):
+        """
+        quantize the normalized view bounds into [l, r, t, b, w, h] positions in [0, pos_max)
+        """
+        l = np.minimum(bounds[:, 0], bounds[:, 2])
+        r = np.maximum(bounds[:, 0], bounds[:, 2])
+        t = np.minimum(bounds[:, 1], bounds[:, 3])
+        b = np.maximum(bounds[:, 1], bounds[:, 3])
+        pos = np.clip(np.stack([l, r, t, b], axis=1), 0, 1)
+        pos = (pos * (self.pos_max - 1)).astype(np.int64)
+        w = np.abs(pos[:, 0] - pos[:, 1])
+        h = np.abs(pos[:, 2] - pos[:, 3])
+        return np.concatenate([pos, np.stack([w, h], axis=1)], axis=1)
 
 
 class Memory:
-    def __init__(self, utg, app):
+    def __init__(self, utg, app, text_cache_dir=None, background_training=BACKGROUND_TRAINING,
+                 train_iterations=TRAIN_ITERATIONS, train_time_budget=TRAIN_TIME_BUDGET,
+                 text_encoder='bert', inference_backend=INFERENCE_BACKEND, warm_start_dir=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
         self.utg = utg
         self.app = app
         self.known_states = collections.OrderedDict()
         self.known_transitions = collections.OrderedDict()
         self.known_structures = collections.OrderedDict()
-        self.model = UIEmbedTransformer()
+        # indexes of known_transitions, maintained by save_transition and forget_state
+        self.effect2actions = {}  # action_effect -> dict of action_str (ordered set)
+        self.state2actions = {}  # state_str -> set of the action_strs starting or ending in the state
+        self.model = UIEmbedTransformer(text_cache_dir=text_cache_dir, text_encoder=text_encoder,
+                                        inference_backend=inference_backend)
+        self.model.eval()
+        # the model used to embed states, an optimized copy of the model unless the backend is eager
+        self.inference_backend = inference_backend
+        self.inference_model = self.build_inference_model(self.model)
+
+        # the model serving the policy is replaced as a whole when new weights are published
+        self.lock = threading.RLock()
+        self.model_version = 0
+        self.model_publish_time = time.time()
+        self.model_num_transitions = 0  # number of transitions the published model was trained on
+
+        self.train_iterations = train_iterations
+        self.train_time_budget = train_time_budget
+        # the optimizer of self.model, used when training synchronously
+        self.optimizer = self.create_optimizer(self.model)
+
+        self.checkpoint_path = None
+        if utg.device.output_dir is not None:
+            self.checkpoint_path = os.path.join(utg.device.output_dir, MEMORY_CHECKPOINT_FILE_NAME)
+        self.checkpoint_state_dicts = {}
+        self.warm_started = False
+        if warm_start_dir is not None:
+            self.warm_started = self.warm_start(warm_start_dir)
+
+        self.trainer = None
+        if background_training:
+            self.trainer = ModelTrainer(self)
+            self.trainer.start()
 
     def _memorize_state(self, state):
         if state.get_app_activity_depth(self.app) != 0:
@@ -298,20 +485,28 @@ class Memory:
         if state.state_str not in self.known_states:
             views = state.views
             views_str = [view['view_str'] for view in views]
+            view_str2idx = {}
+            for view_idx, view_str in enumerate(views_str):
+                view_str2idx.setdefault(view_str, view_idx)
             state_enc = self.model.encode_state(state, views)
-            embedder = self.model
-            embedder.eval()
-            with torch.no_grad():
-                # state_encs = self.model.encode_state_batch([state_enc])
-                views_emb = self.model.forward([state_enc])
-                views_emb = views_emb.detach().cpu()[0]
-            self.known_states[state.state_str] = {
-                'state': state,
-                'views': views,
-                'views_str': views_str,
-                'state_enc': state_enc,
-                'views_emb': views_emb
-            }
+            with self.lock:
+                with torch.no_grad():
+                    views_emb = self.inference_model([state_enc])
+                    views_emb = views_emb.detach().cpu()[0]
+                self.known_states[state.state_str] = {
+                    'state': state,
+                    'views': views,
+                    'views_str': views_str,
+                    'view_str2idx': view_str2idx,
+                    'state_enc': state_enc,
+                    'views_emb': views_emb,
+                    'model_version': self.model_version,
+                    'restored': False
+                }
+        elif self.known_states[state.state_str]['restored']:
+            # a state restored from a checkpoint is reached again in this run
+            self.known_states[state.state_str]['state'] = state
+            self.known_states[state.state_str]['restored'] = False
         return self.known_states[state.state_str]
 
     def save_transition(self, action, from_state, to_state):
@@ -323,29 +518,58 @@ class Memory:
             return
         if action.view is None:
             return
-        action_str = action.get_event_str(state=from_state)
+        action_str = action.get_event_key(state=from_state)
         if action_str in self.known_transitions and self.known_transitions[action_str]['to_state'] == to_state:
             return
         if from_state_info is None:
             return
         view = action.view
-        view_idx = from_state_info['views_str'].index(view['view_str'])
+        view_idx = from_state_info['view_str2idx'][view['view_str']]
         action_target = ACTION_INEFFECTIVE \
-            if from_state.structure_str == to_state.structure_str \
-            else to_state.structure_str
+            if self.utg.get_cluster_str(from_state) == self.utg.get_cluster_str(to_state) \
+            else self.utg.get_cluster_str(to_state)
         # TODO decide how to represent the effect of an action
         # action_effect = f'{from_state.structure_str}->{action_target}'
         action_effect = action_target
-        self.known_transitions[action_str] = {
-            'from_state': from_state,
-            'to_state': to_state,
-            'action': action,
-            'view_idx': view_idx,
-            'action_effect': action_effect
-        }
+        with self.lock:
+            if action_str in self.known_transitions:
+                self.__unindex_transition(action_str)
+            self.known_transitions[action_str] = {
+                'from_state': from_state,
+                'to_state': to_state,
+                'action': action,
+                'view_idx': view_idx,
+                'action_effect': action_effect
+            }
+            self.__index_transition(action_str)
+
+    def __index_transition(self, action_str):
+        action_info = self.known_transitions[action_str]
+        self.effect2actions.setdefault(action_info['action_effect'], {})[action_str] = None
+        self.state2actions.setdefault(action_info['from_state'].state_str, set()).add(action_str)
+        self.state2actions.setdefault(action_info['to_state'].state_str, set()).add(action_str)
+
+    def __unindex_transition(self, action_str):
+        action_info = self.known_transitions[action_str]
+        action_effect = action_info['action_effect']
+        self.effect2actions[action_effect].pop(action_str, None)
+        if len(self.effect2actions[action_effect]) == 0:
+            self.effect2actions.pop(action_effect)
+        for state in [action_info['from_state'], action_info['to_state']]:
+            self.state2actions.get(state.state_str, set()).discard(action_str)
+
+    def forget_state(self, state_str):
+        """
+        forget a state and the known transitions starting or ending in it
+        """
+        with self.lock:
+            self.known_states.pop(state_str, None)
+            for action_str in list(self.state2actions.pop(state_str, [])):
+                self.__unindex_transition(action_str)
+                self.known_transitions.pop(action_str)
 
     def save_structure(self, state):
-        structure_str = state.structure_str
+        structure_str = self.utg.get_cluster_str(state)
         is_new_structure = False
         if structure_str not in self.known_structures:
             self.known_structures[structure_str] = []
@@ -353,59 +577,68 @@ class Memory:
         self.known_structures[structure_str].append(state)
         return is_new_structure
 
-    def _select_transitions_for_training(self, size):
-        if len(self.known_transitions) <= size:
-            return list(self.known_transitions.keys())
-        effect2actions = {}
-        for k,v in self.known_transitions.items():
-            action_effect = v['action_effect']
-            if action_effect not in effect2actions:
-                effect2actions[action_effect] = []
-            effect2actions[action_effect].append(k)
-        action_strs = []
-        action_probs = []
-        prob_per_effect = 1.0 / len(effect2actions)
-        for effect in effect2actions:
-            prob_per_action = prob_per_effect / len(effect2actions[effect])
-            for action_str in effect2actions[effect]:
-                action_strs.append(action_str)
-                action_probs.append(prob_per_action)
-        action_probs = np.array(action_probs) / sum(action_probs)
-        selected_actions = np.random.choice(action_strs, size=size, replace=False, p=action_probs)
-        return selected_actions
-
-    def encode_action_pairs(self, action_strs=None):
+    def _select_transitions_for_training(self, size, known_transitions=None, effect2actions=None):
+        if known_transitions is None:
+            known_transitions = self.known_transitions
+        if effect2actions is None:
+            effect2actions = self.effect2actions
+        if len(known_transitions) <= size:
+            return list(known_transitions.keys())
+        # every effect has the same probability, shared by its actions
+        action_strs = [action_str for action_strs in effect2actions.values() for action_str in action_strs]
+        effect_sizes = np.array([len(action_strs) for action_strs in effect2actions.values()])
+        action_probs = np.repeat(1.0 / (len(effect_sizes) * effect_sizes), effect_sizes)
+        action_probs = action_probs / action_probs.sum()
+        selected_idxs = np.random.choice(len(action_strs), size=size, replace=False, p=action_probs)
+        return [action_strs[i] for i in selected_idxs]
+
+    def encode_action_pairs(self, action_strs=None, known_transitions=None, state_encs_by_str=None):
+        """
+        :return: (state_encs, action_pairs), the encodings of the distinct states the actions start from,
+                 and a (n_pairs, 5) LongTensor of (state_idx1, view_idx1, state_idx2, view_idx2, effect_same)
+                 for every pair of actions
+        """
+        if known_transitions is None:
+            known_transitions = self.known_transitions
+        if state_encs_by_str is None:
+            state_encs_by_str = {k: v['state_enc'] for k, v in self.known_states.items()}
         if action_strs is None:
-            action_strs = list(self.known_transitions.keys())
-
-        state_strs = [self.known_transitions[action_str]['from_state'].state_str for action_str in action_strs]
-        state_encs = [self.known_states[state_str]['state_enc'] for state_str in state_strs]
-        action_pairs = []
-        for i, action_str1 in enumerate(action_strs):
-            state_str1 = self.known_transitions[action_str1]['from_state'].state_str
-            state_idx1 = state_strs.index(state_str1)
-            view_idx1 = self.known_transitions[action_str1]['view_idx']
-            for j, action_str2 in enumerate(action_strs[i+1:]):
-                state_str2 = self.known_transitions[action_str2]['from_state'].state_str
-                state_idx2 = state_strs.index(state_str2)
-                view_idx2 = self.known_transitions[action_str2]['view_idx']
-                action_effect1 = self.known_transitions[action_str1]['action_effect']
-                action_effect2 = self.known_transitions[action_str2]['action_effect']
-                # if action_effect1 == ACTION_INEFFECTIVE and action_effect2 == ACTION_INEFFECTIVE:
-                #     continue
-                effect_same = 1 if action_effect1 == action_effect2 else 0
-                action_pairs.append((state_idx1, view_idx1, state_idx2, view_idx2, effect_same))
+            action_strs = list(known_transitions.keys())
+
+        state_str2pos = {}
+        effect2id = {}
+        state_idxs = []
+        view_idxs = []
+        effect_ids = []
+        for action_str in action_strs:
+            action_info = known_transitions[action_str]
+            state_idxs.append(state_str2pos.setdefault(action_info['from_state'].state_str, len(state_str2pos)))
+            view_idxs.append(action_info['view_idx'])
+            effect_ids.append(effect2id.setdefault(action_info['action_effect'], len(effect2id)))
+        state_encs = [state_encs_by_str[state_str] for state_str in state_str2pos]
+        state_idxs = torch.tensor(state_idxs, dtype=torch.long)
+        view_idxs = torch.tensor(view_idxs, dtype=torch.long)
+        effect_ids = torch.tensor(effect_ids, dtype=torch.long)
+        idxs1, idxs2 = torch.triu_indices(len(action_strs), len(action_strs), offset=1)
+        effect_same = (effect_ids[idxs1] == effect_ids[idxs2]).long()
+        action_pairs = torch.stack([state_idxs[idxs1], view_idxs[idxs1], state_idxs[idxs2], view_idxs[idxs2],
+                                    effect_same], dim=1)
         return state_encs, action_pairs
     
-    def get_known_actions_emb(self):
+    def get_known_actions_emb(self, serving_model=None):
+        """
+        :param serving_model: (inference_model, model_version) as returned by get_serving_model,
+                              the current one by default
+        """
+        views_embs = self.get_views_embs(self.get_transition_state_strs(), serving_model)[0]
         actions_emb = []
         for action_str in self.known_transitions:
             action_info = self.known_transitions[action_str]
             state_str = action_info['from_state'].state_str
             view_idx = action_info['view_idx']
-            if state_str not in self.known_states:
+            if state_str not in views_embs:
                 continue
-            action_emb = self.known_states[state_str]['views_emb'][view_idx]
+            action_emb = views_embs[state_str][view_idx]
             actions_emb.append(action_emb)
         return torch.stack(actions_emb) if len(actions_emb) > 0 else None
 
@@ -417,47 +650,66 @@ class Memory:
         return f'{state_activity}-{view_sig}-{action_effect}'
 
     def train_model(self):
+        """
+        train the model on the known transitions, in the background if there is a trainer
+        """
         if len(self.known_transitions.keys()) < 2:
             return
+        snapshot = self.get_training_snapshot()
+        if self.trainer is not None:
+            self.trainer.submit(snapshot)
+            return
+        self.model.train()
+        try:
+            self.fit(self.model, *snapshot, optimizer=self.optimizer)
+        finally:
+            self.model.eval()
+        self.publish_model(self.model, len(snapshot[0]))
+        self.save_checkpoint(self.model, self.optimizer, snapshot[0])
 
-        embedder = self.model
-        optimizer = torch.optim.Adam(embedder.parameters(), lr=1e-3)
-        n_iterations = 10
+    def get_training_snapshot(self):
+        """
+        :return: (known_transitions, state_encs_by_str, effect2actions), copies that are not affected by later exploration
+        """
+        with self.lock:
+            known_transitions = collections.OrderedDict(self.known_transitions)
+            state_encs_by_str = {k: v['state_enc'] for k, v in self.known_states.items()}
+            effect2actions = {k: list(v) for k, v in self.effect2actions.items()}
+        return known_transitions, state_encs_by_str, effect2actions
+
+    @staticmethod
+    def create_optimizer(embedder):
+        return torch.optim.Adam(embedder.parameters(), lr=1e-3)
+
+    def fit(self, embedder, known_transitions, state_encs_by_str, effect2actions=None, optimizer=None):
+        """
+        run the optimizer iterations on a model, within the time budget
+        :param optimizer: the optimizer of the model, kept between rounds, a new one if None
+        """
+        if optimizer is None:
+            optimizer = self.create_optimizer(embedder)
+        round_start_time = time.time()
 
         def compute_loss(ele_embed, action_pairs):
-            pos_emb_u = []
-            pos_emb_v = []
-            neg_emb_u = []
-            neg_emb_v = []
-            for state_idx1, view_idx1, state_idx2, view_idx2, effect_same in action_pairs:
-                emb_u = ele_embed[state_idx1, view_idx1]
-                emb_v = ele_embed[state_idx2, view_idx2]
-                if effect_same:
-                    pos_emb_u.append(emb_u)
-                    pos_emb_v.append(emb_v)
-                else:
-                    neg_emb_u.append(emb_u)
-                    neg_emb_v.append(emb_v)
+            emb_u = ele_embed[action_pairs[:, 0], action_pairs[:, 1]]
+            emb_v = ele_embed[action_pairs[:, 2], action_pairs[:, 3]]
+            effect_same = action_pairs[:, 4].bool()
+            scores = torch.cosine_similarity(emb_u, emb_v)
 
             pos_score = 0
             neg_score = 0
-            if len(pos_emb_u) > 0 and len(pos_emb_v) > 0:
-                pos_emb_u = torch.stack(pos_emb_u)
-                pos_emb_v = torch.stack(pos_emb_v)
-                pos_score = torch.cosine_similarity(pos_emb_u, pos_emb_v)
-                pos_score = F.logsigmoid(pos_score).mean()
-            if len(neg_emb_u) > 0 and len(neg_emb_v) > 0:
-                neg_emb_u = torch.stack(neg_emb_u)
-                neg_emb_v = torch.stack(neg_emb_v)
-                neg_score = torch.cosine_similarity(neg_emb_u, neg_emb_v)
-                neg_score = F.logsigmoid(-neg_score).mean()
+            if effect_same.any():
+                pos_score = F.logsigmoid(scores[effect_same]).mean()
+            if not effect_same.all():
+                neg_score = F.logsigmoid(-scores[~effect_same]).mean()
             loss = -pos_score - neg_score
             return loss
 
         def train():
-            embedder.train()
-            action_strs = self._select_transitions_for_training(size=N_ACTIONS_TRAINING)
-            state_encs, action_pairs = self.encode_action_pairs(action_strs)
+            action_strs = self._select_transitions_for_training(size=N_ACTIONS_TRAINING,
+                                                                known_transitions=known_transitions,
+                                                                effect2actions=effect2actions)
+            state_encs, action_pairs = self.encode_action_pairs(action_strs, known_transitions, state_encs_by_str)
             ele_embed = embedder.forward(state_encs)
 
             loss = compute_loss(ele_embed, action_pairs)
@@ -466,35 +718,271 @@ class Memory:
             optimizer.step()
             return loss.item(), len(action_pairs)
 
-        for i in range(n_iterations):
+        for i in range(self.train_iterations):
+            if self.train_time_budget is not None and time.time() - round_start_time > self.train_time_budget:
+                self.logger.info(f'training stopped after {i} iterations, time budget exceeded')
+                break
             epoch_start_time = time.time()
             loss, n_pairs = train()
             elapsed = time.time() - epoch_start_time
             print(f'| iter: {i:3d} | time: {elapsed:6.2f}s | #pairs: {n_pairs:6d} | loss: {loss:8.4f}')
 
-        # update embedding
+    @staticmethod
+    def embed_states(embedder, state_encs_by_str, batch_size=REEMBED_BATCH_SIZE):
+        """
+        :return: dict from state_str to the view embeddings of the state
+        """
+        state_strs = list(state_encs_by_str.keys())
+        views_embs = {}
         with torch.no_grad():
             embedder.eval()
-            state_encs = [v['state_enc'] for k,v in self.known_states.items()]
-            # state_encs_pad = pad_sequence(state_encs, batch_first=True)
-            ele_embed = embedder(state_encs)
-            ele_embed = ele_embed.detach().cpu()
-            for i, (k,v) in enumerate(self.known_states.items()):
-                self.known_states[k]['views_emb'] = ele_embed[i]
-
-    def get_unexplored_actions(self, current_state):
+            for i in range(0, len(state_strs), batch_size):
+                batch_state_strs = state_strs[i:i + batch_size]
+                ele_embed = embedder([state_encs_by_str[state_str] for state_str in batch_state_strs])
+                ele_embed = ele_embed.detach().cpu()
+                for j, state_str in enumerate(batch_state_strs):
+                    views_embs[state_str] = ele_embed[j]
+        return views_embs
+
+    def build_inference_model(self, model):
+        if self.inference_backend == 'eager':
+            return model
+        return optimize_for_inference(copy_embedder(model), self.inference_backend)
+
+    def publish_model(self, model, num_transitions, inference_model=None):
+        """
+        replace the serving model
+        the view embeddings of the known states become stale, and are recomputed when they are used
+        :param model: the new model, in eval mode
+        :param num_transitions: number of transitions the model was trained on
+        :param inference_model: the optimized copy of the model, built here if not given
+        """
+        if inference_model is None:
+            inference_model = self.build_inference_model(model)
+        with self.lock:
+            self.model = model
+            self.inference_model = inference_model
+            self.model_version += 1
+            self.model_num_transitions = num_transitions
+            self.model_publish_time = time.time()
+
+    def get_serving_model(self):
+        """
+        :return: (inference_model, model_version), the model to use for a whole decision
+        """
+        with self.lock:
+            return self.inference_model, self.model_version
+
+    def get_views_embs(self, state_strs, serving_model=None, max_states=None):
+        """
+        get the view embeddings of the given states computed by one model version,
+        re-embedding the states whose embeddings were computed by another version
+        :param state_strs: iterable of state_str
+        :param serving_model: (inference_model, model_version) as returned by get_serving_model,
+                              the current one by default
+        :param max_states: max number of states to re-embed, no limit by default
+        :return: (dict of state_str -> views_emb, number of states re-embedded)
+        """
+        with self.lock:
+            model, model_version = serving_model if serving_model is not None \
+                else (self.inference_model, self.model_version)
+            views_embs = {}
+            stale_state_encs = {}
+            for state_str in state_strs:
+                state_info = self.known_states.get(state_str)
+                if state_info is None:
+                    continue
+                if state_info['model_version'] == model_version:
+                    views_embs[state_str] = state_info['views_emb']
+                elif max_states is None or len(stale_state_encs) < max_states:
+                    stale_state_encs[state_str] = state_info['state_enc']
+        if len(stale_state_encs) == 0:
+            return views_embs, 0
+        new_views_embs = self.embed_states(model, stale_state_encs)
+        with self.lock:
+            for state_str, views_emb in new_views_embs.items():
+                state_info = self.known_states.get(state_str)
+                # only store the embeddings of the states that are not forgotten or refreshed by a newer model
+                if state_info is None or state_info['model_version'] >= model_version:
+                    continue
+                state_info['views_emb'] = views_emb
+                state_info['model_version'] = model_version
+        views_embs.update(new_views_embs)
+        return views_embs, len(new_views_embs)
+
+    def refresh_views_embs(self, state_strs, max_states=None):
+        """
+        re-embed the given states whose view embeddings were computed by an older model
+        :param state_strs: iterable of state_str
+        :param max_states: max number of states to re-embed, no limit by default
+        :return: number of states re-embedded
+        """
+        return self.get_views_embs(state_strs, max_states=max_states)[1]
+
+    def get_transition_state_strs(self):
+        """
+        :return: the states the known transitions start from, whose embeddings are used to score every target
+        """
+        with self.lock:
+            return list(dict.fromkeys(action_info['from_state'].state_str
+                                      for action_info in self.known_transitions.values()))
+
+    def save_checkpoint(self, model, optimizer, known_transitions):
+        """
+        write the model, its optimizer and the known transitions to the output dir,
+        so that later runs of the same app can warm-start from them
+        """
+        if self.checkpoint_path is None:
+            return
+        transitions = []
+        state_dicts = {}
+        for action_str, action_info in known_transitions.items():
+            for state in [action_info['from_state'], action_info['to_state']]:
+                if state.state_str not in self.checkpoint_state_dicts:
+                    self.checkpoint_state_dicts[state.state_str] = state.to_dict()
+                state_dicts[state.state_str] = self.checkpoint_state_dicts[state.state_str]
+            transitions.append({
+                'action_str': action_str,
+                'from_state_str': action_info['from_state'].state_str,
+                'to_state_str': action_info['to_state'].state_str,
+                'action': action_info['action'].to_dict(),
+                'view_idx': action_info['view_idx'],
+                'action_effect': action_info['action_effect']
+            })
+        checkpoint = {
+            'package_name': self.app.package_name,
+            'app_hashes': list(self.app.hashes),
+            'text_encoder': model.text_encoder.method,
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'states': state_dicts,
+            'transitions': transitions
+        }
+        try:
+            # write to a temporary file first, so that a killed run never leaves a partial checkpoint
+            tmp_path = self.checkpoint_path + '.tmp'
+            torch.save(checkpoint, tmp_path)
+            os.replace(tmp_path, self.checkpoint_path)
+        except Exception as e:
+            self.logger.warning(f'failed to save the memory checkpoint: {e}')
+
+    def __find_checkpoints(self, warm_start_dir):
+        paths = [warm_start_dir] if os.path.isfile(warm_start_dir) else \
+            [os.path.join(warm_start_dir, MEMORY_CHECKPOINT_FILE_NAME)] + \
+            [os.path.join(warm_start_dir, name, MEMORY_CHECKPOINT_FILE_NAME) for name in sorted(os.listdir(warm_start_dir))]
+        paths = [path for path in paths if os.path.isfile(path) and path != self.checkpoint_path]
+        # the latest checkpoint first
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def warm_start(self, warm_start_dir):
+        """
+        load the latest checkpoint written by a previous run of the same app
+        :param warm_start_dir: a checkpoint file, the output dir of a previous run, or a dir of output dirs
+        :return: whether a checkpoint is loaded
+        """
+        from .device_state import DeviceState
+        from .input_event import InputEvent
+        if not os.path.exists(warm_start_dir):
+            self.logger.warning(f'{warm_start_dir} does not exist, starting from scratch')
+            return False
+        checkpoint = None
+        checkpoint_path = None
+        for checkpoint_path in self.__find_checkpoints(warm_start_dir):
+            try:
+                checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+            except Exception as e:
+                self.logger.warning(f'failed to load {checkpoint_path}: {e}')
+                continue
+            if checkpoint['package_name'] == self.app.package_name \
+                    and checkpoint['app_hashes'] == list(self.app.hashes) \
+                    and checkpoint['text_encoder'] == self.model.text_encoder.method:
+                break
+            checkpoint = None
+        if checkpoint is None:
+            self.logger.warning(f'no checkpoint of this app in {warm_start_dir}, starting from scratch')
+            return False
+
+        self.model.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        self.inference_model = self.build_inference_model(self.model)
+
+        # the restored states are used to train and to score actions, but are not exploration targets
+        # until they are reached in this run
+        states = {}
+        for state_str, state_dict in checkpoint['states'].items():
+            state = DeviceState.from_dict(self.utg.device, state_dict)
+            if self._memorize_state(state) is None:
+                continue
+            self.known_states[state_str]['restored'] = True
+            states[state_str] = state
+        with self.lock:
+            for transition in checkpoint['transitions']:
+                from_state = states.get(transition['from_state_str'])
+                to_state = states.get(transition['to_state_str'])
+                action = InputEvent.from_dict(transition['action'])
+                if from_state is None or to_state is None or action is None:
+                    continue
+                self.known_transitions[transition['action_str']] = {
+                    'from_state': from_state,
+                    'to_state': to_state,
+                    'action': action,
+                    'view_idx': transition['view_idx'],
+                    'action_effect': transition['action_effect']
+                }
+                self.__index_transition(transition['action_str'])
+        self.model_num_transitions = len(self.known_transitions)
+        self.logger.info(f'warm-started from {checkpoint_path}: '
+                         f'{len(states)} states, {len(self.known_transitions)} transitions')
+        return True
+
+    def get_model_staleness(self):
+        """
+        :return: dict with the version of the serving model, the number of transitions it has not been trained on,
+                 the seconds since it was published, and the number of states embedded by an older model
+        """
+        with self.lock:
+            num_stale_states = sum(1 for state_info in self.known_states.values()
+                                   if state_info['model_version'] != self.model_version)
+        return {
+            'model_version': self.model_version,
+            'transitions_behind': len(self.known_transitions) - self.model_num_transitions,
+            'seconds_since_publish': time.time() - self.model_publish_time,
+            'stale_states': num_stale_states
+        }
+
+    def is_new_state(self, state):
+        """
+        whether _memorize_state would add the state to the memory
+        """
+        return state.state_str not in self.known_states and state.get_app_activity_depth(self.app) == 0
+
+    def get_unexplored_actions(self, current_state, memorize=True):
+        """
+        :param memorize: whether to memorize current_state, otherwise its actions are considered as if it was
+                         memorized, without changing the memory
+        """
         action_strs = set()
         structure_strs = set()
-        self._memorize_state(current_state)
+        states = []
+        if memorize:
+            self._memorize_state(current_state)
+        elif self.is_new_state(current_state):
+            states.append(current_state)
         for state_str, state_info in reversed(self.known_states.items()):
-            state = state_info['state']
-            if state.structure_str in structure_strs:
+            if not memorize and state_str == current_state.state_str:
+                states.append(current_state)
+            elif not state_info['restored']:
+                states.append(state_info['state'])
+        for state in states:
+            # near-identical states share one cluster, so their actions are only considered once
+            cluster_str = self.utg.get_cluster_str(state)
+            if cluster_str in structure_strs:
                 continue
-            structure_strs.add(state.structure_str)
+            structure_strs.add(cluster_str)
             for action in state.get_possible_input():
                 if not isinstance(action, TouchEvent):
                     continue
-                action_str = action.get_event_str(state=state)
+                action_str = action.get_event_key(state=state)
                 if action_str in action_strs:
                     continue
                 if self.utg.is_event_explored(action, state):
@@ -502,31 +990,140 @@ class Memory:
                 action_strs.add(action_str)
                 yield state, action
 
-    def get_action_emb(self, state, action):
+    def embed_state(self, state, serving_model=None):
+        """
+        embed the views of a state without memorizing it
+        :return: views_emb
+        """
+        model, model_version = serving_model if serving_model is not None else self.get_serving_model()
+        state_enc = self.model.encode_state(state, state.views)
+        return self.embed_states(model, {state.state_str: state_enc})[state.state_str]
+
+    def get_action_emb(self, state, action, views_embs=None):
+        """
+        :param views_embs: dict of state_str -> views_emb returned by get_views_embs, to use the embeddings
+                           of one model version, the current embeddings of the state by default
+        """
         state_str = state.state_str
+        if views_embs is None:
+            views_embs = self.get_views_embs([state_str])[0]
         view_str = action.view['view_str']
-        view_idx = self.known_states[state_str]['views_str'].index(view_str)
-        action_emb = self.known_states[state_str]['views_emb'][view_idx]
+        state_info = self.known_states.get(state_str)
+        if state_info is not None:
+            view_idx = state_info['view_str2idx'][view_str]
+        else:
+            # a state that is not memorized, e.g. a predicted one
+            view_idx = [view['view_str'] for view in state.views].index(view_str)
+        action_emb = views_embs[state_str][view_idx]
         return action_emb
 
 
+def copy_embedder(embedder):
+    """
+    copy the weights of a UI embedder, sharing its text encoder (which is not trained) with the copy
+    """
+    return copy.deepcopy(embedder, memo={id(embedder.text_encoder): embedder.text_encoder})
+
+
+class ModelTrainer(threading.Thread):
+    """
+    Train a copy of the memory's model in the background on snapshots of the memory,
+    and publish the new weights to the memory when a round is done.
+    Snapshots submitted while a round is running are coalesced, only the latest one is used.
+    Between rounds, the stale embeddings of the states used for scoring are refreshed in bounded batches.
+    """
+
+    def __init__(self, memory):
+        super().__init__(name="ModelTrainer", daemon=True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.memory = memory
+        self.model = copy_embedder(memory.model)
+        self.optimizer = memory.create_optimizer(self.model)
+        # continue with the optimizer state of the memory, which may be restored from a checkpoint
+        self.optimizer.load_state_dict(memory.optimizer.state_dict())
+        self.condition = threading.Condition()
+        self.pending_snapshot = None
+
+        self.num_rounds = 0
+        self.num_coalesced = 0
+        self.last_round_time = None
+
+    def submit(self, snapshot):
+        with self.condition:
+            if self.pending_snapshot is not None:
+                self.num_coalesced += 1
+            self.pending_snapshot = snapshot
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending_snapshot is None:
+                    self.condition.wait()
+                snapshot = self.pending_snapshot
+                self.pending_snapshot = None
+            known_transitions = snapshot[0]
+            try:
+                round_start_time = time.time()
+                self.model.train()
+                self.memory.fit(self.model, *snapshot, optimizer=self.optimizer)
+                published_model = copy_embedder(self.model)
+                published_model.eval()
+                inference_model = self.memory.build_inference_model(published_model)
+                self.memory.publish_model(published_model, len(known_transitions), inference_model)
+                self.num_rounds += 1
+                self.last_round_time = time.time() - round_start_time
+                self.logger.info(f'published model v{self.memory.model_version} trained on '
+                                 f'{len(known_transitions)} transitions in {self.last_round_time:.2f}s '
+                                 f'({self.num_coalesced} requests coalesced so far)')
+                self.memory.save_checkpoint(self.model, self.optimizer, known_transitions)
+            except Exception as e:
+                self.logger.warning(f'background training failed: {e}')
+                import traceback
+                traceback.print_exc()
+            self.refresh_views_embs()
+
+    def refresh_views_embs(self):
+        # stop as soon as there is a new snapshot to train on
+        while self.pending_snapshot is None:
+            state_strs = self.memory.get_transition_state_strs()
+            if self.memory.refresh_views_embs(state_strs, max_states=REEMBED_BATCH_SIZE) == 0:
+                break
+
+
 class MemoryGuidedPolicy(UtgBasedInputPolicy):
-    def __init__(self, device, app, random_input):
+    def __init__(self, device, app, random_input, text_cache_dir=None, text_encoder='bert',
+                 inference_backend=INFERENCE_BACKEND, inference_threads=INFERENCE_THREADS, warm_start_dir=None,
+                 train_interval=TRAIN_INTERVAL, background_training=BACKGROUND_TRAINING,
+                 train_iterations=TRAIN_ITERATIONS, train_time_budget=TRAIN_TIME_BUDGET):
         super(MemoryGuidedPolicy, self).__init__(device, app, random_input)
         self.logger = logging.getLogger(self.__class__.__name__)
 
-        self.memory = Memory(utg=self.utg, app=self.app)
-        self.num_actions_train = 10
+        if inference_threads is not None:
+            torch.set_num_threads(inference_threads)
+        self.memory = Memory(utg=self.utg, app=self.app, text_cache_dir=text_cache_dir,
+                             background_training=background_training, train_iterations=train_iterations,
+                             train_time_budget=train_time_budget, text_encoder=text_encoder,
+                             inference_backend=inference_backend, warm_start_dir=warm_start_dir)
+        self.num_actions_train = train_interval
 
         self._nav_steps = []
         self._num_steps_outside = 0
 
+        # (decision fingerprint, pick_target result) prepared for the predicted next state
+        self._speculated_target = None
+        self.num_speculation_hits = 0
+        self.num_speculation_misses = 0
+        # the log records read up to the last step
+        self.last_log_seq = 0
+
     def generate_event_based_on_utg(self):
         """
         generate an event based on current UTG
         @return: InputEvent
         """
         current_state = self.current_state
+        speculated_target, self._speculated_target = self._speculated_target, None
         try:
             self.memory.save_transition(self.last_event, self.last_state, current_state)
         except Exception as e:
@@ -535,6 +1132,7 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
             traceback.print_exc()
         if self.action_count % self.num_actions_train == 0:
             self.memory.train_model()
+            self.logger.debug(f'model staleness: {self.memory.get_model_staleness()}')
         # self.logger.info(f'we have {len(self.memory.known_transitions)} transitions now')
 
         if self.last_event is not None:
@@ -576,10 +1174,11 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
             self.logger.info("it is a new structure, going back")
             return KeyEvent(name="BACK")
 
-        if self.action_count >= self.num_actions_train \
+        # a warm-started memory can guide the exploration from the start
+        if (self.action_count >= self.num_actions_train or self.memory.warm_started) \
                 and len(self._nav_steps) == 0 \
                 and np.random.uniform() > RANDOM_EXPLORE_PROB:
-            (target_state, target_action), candidates = self.pick_target(current_state)
+            (target_state, target_action), candidates = self.__pick_target(current_state, speculated_target)
             if target_state:
                 # perform target action or navigate to target action
                 if target_state.state_str == current_state.state_str:
@@ -597,31 +1196,74 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
         random.shuffle(possible_events)
         return possible_events[0]
 
-    def pick_target(self, current_state):
-        state_action_pairs = list(self.memory.get_unexplored_actions(current_state))
+    def speculate_on_state(self, state):
+        if len(self._nav_steps) > 0:
+            # the next step follows the navigation, no target is picked
+            return
+        # the predicted state may be wrong, so the memory is only read
+        self._speculated_target = (self.__get_decision_fingerprint(state), self.pick_target(state, memorize=False))
+
+    def __get_decision_fingerprint(self, state):
+        # what pick_target depends on, apart from the embeddings of a model version,
+        # counting the state as memorized since the actual step memorizes it before picking the target
+        num_known_states = len(self.memory.known_states) + int(self.memory.is_new_state(state))
+        return (state.state_str, self.memory.model_version, num_known_states, len(self.memory.known_transitions),
+                len(self.utg.effective_event_keys), len(self.utg.ineffective_event_keys),
+                len(self.utg.explored_cluster_event_keys))
+
+    def __pick_target(self, current_state, speculated_target):
+        if speculated_target is not None:
+            fingerprint, target = speculated_target
+            if fingerprint == self.__get_decision_fingerprint(current_state):
+                self.num_speculation_hits += 1
+                self.logger.info(f"using the speculated target "
+                                 f"({self.num_speculation_hits} hits, {self.num_speculation_misses} misses)")
+                return target
+            self.num_speculation_misses += 1
+        return self.pick_target(current_state)
+
+    def pick_target(self, current_state, memorize=True):
+        """
+        :param memorize: whether to memorize current_state, False to leave the memory unchanged
+        """
+        state_action_pairs = list(self.memory.get_unexplored_actions(current_state, memorize=memorize))
         best_target = None, None
-        best_score = -np.inf
-        known_actions_emb = self.memory.get_known_actions_emb()
+        if len(state_action_pairs) == 0:
+            return best_target, state_action_pairs
+        # all the embeddings compared are computed by the same model, even if a new one is published meanwhile
+        serving_model = self.memory.get_serving_model()
+        known_actions_emb = self.memory.get_known_actions_emb(serving_model)
         if known_actions_emb is None:
             return best_target, state_action_pairs
+        # re-embed the stale candidate states in batches rather than one by one
+        views_embs = self.memory.get_views_embs(dict.fromkeys(state.state_str for state, action in state_action_pairs),
+                                                serving_model)[0]
+        for state, action in state_action_pairs:
+            if state.state_str not in views_embs:
+                views_embs[state.state_str] = self.memory.embed_state(state, serving_model)
+        # score each candidate by its max cosine similarity to the known actions, the less similar the better
+        actions_emb = torch.stack([self.memory.get_action_emb(state, action, views_embs)
+                                   for state, action in state_action_pairs])
+        similarities = F.normalize(actions_emb, dim=1) @ F.normalize(known_actions_emb, dim=1).t()
+        max_sims, max_sim_idxs = similarities.max(1)
+        scores = -max_sims
+        # encourage actions in current state
+        in_current_state = torch.tensor([state.state_str == current_state.state_str
+                                         for state, action in state_action_pairs])
+        scores = scores + CLOSER_ACTION_ENCOURAGEMENT * in_current_state
+        best_idx = int(scores.argmax())
+        best_target = state_action_pairs[best_idx]
         if DEBUG:
-            known_actions_str = [Memory.action_info_str(v) for k, v in self.memory.known_transitions.items()]
-        scores = []
-        for i, (state, action) in enumerate(state_action_pairs):
-            action_emb = self.memory.get_action_emb(state, action)
-            similarities = torch.cosine_similarity(action_emb.repeat((known_actions_emb.size(0), 1)), known_actions_emb)
-            max_sim, max_sim_idx = similarities.max(0)
-            score = -max_sim
-            if state.state_str == current_state.state_str:
-                score += CLOSER_ACTION_ENCOURAGEMENT        # encourage actions in current state
-            if DEBUG:
-                action_info_str = f'{state.foreground_activity}-{action.view["signature"]}'
-                scores.append((i, score, action_info_str, similarities, action_emb))
-            if score > best_score:
-                best_score = score
-                best_target = state, action
+            state, action = best_target
+            self.logger.debug(f'target {state.foreground_activity}-{action.view["signature"]}, '
+                              f'score {float(scores[best_idx]):.4f}')
         return best_target, state_action_pairs
 
+    def on_app_crash(self):
+        super().on_app_crash()
+        # the navigation started from a state that is gone
+        self._nav_steps = []
+
     def navigate(self, current_state):
         if self._nav_steps and len(self._nav_steps) > 0:
             nav_state, nav_action = self._nav_steps[0]
@@ -637,13 +1279,23 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
     def _get_nav_action(self, current_state, nav_state, nav_action):
         # get the action similar to nav_action in current state
         try:
-            if current_state.structure_str != nav_state.structure_str:
+            if self.utg.get_cluster_str(current_state) != self.utg.get_cluster_str(nav_state):
                 return None
             if not isinstance(nav_action, UIEvent):
                 return nav_action
             nav_view = nav_action.view
-            nav_view_idx = nav_state.views.index(nav_view)
-            new_view = current_state.views[nav_view_idx]
+            if current_state.structure_str == nav_state.structure_str:
+                nav_view_idx = nav_state.views.index(nav_view)
+                new_view = current_state.views[nav_view_idx]
+            else:
+                # near-identical structure, the views are not aligned, so match the view by its signature
+                new_view = None
+                for view in current_state.views:
+                    if view.get('signature') == nav_view.get('signature'):
+                        new_view = view
+                        break
+                if new_view is None:
+                    return None
             new_action = copy.deepcopy(nav_action)
             new_action.view = new_view
             return new_action
@@ -652,46 +1304,88 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
             return nav_action
 
     def parse_log_lines(self):
-        log_lines = self.device.logcat.get_recent_lines()
-        filtered_lines = []
+        log_buffer = self.device.hilog.log_buffer if self.device.is_harmonyos else self.device.logcat.log_buffer
+        since_seq, self.last_log_seq = self.last_log_seq, log_buffer.get_seq()
         app_pid = self.device.get_app_pid(self.app)
         # print(f'current app_pid: {app_pid}')
-        for line in log_lines:
-            try:
-                seps = line.split()
-                if int(seps[2]) == app_pid:
-                    filtered_lines.append(line)
-            except:
-                pass
-        return filtered_lines
+        if app_pid is None:
+            return []
+        return [record.to_line() for record in log_buffer.query(pid=app_pid, since_seq=since_seq)
+                if record.seq < self.last_log_seq]
 
     def get_shortest_nav_steps(self, current_state, target_state, target_action):
-        normal_nav_steps = self.utg.get_G2_nav_steps(current_state, target_state)
-        restart_nav_steps = self.utg.get_G2_nav_steps(self.utg.first_state, target_state)
-        normal_nav_steps_len = len(normal_nav_steps) if normal_nav_steps else MAX_NAV_STEPS
-        restart_nav_steps_len = len(restart_nav_steps) + 1 if restart_nav_steps else MAX_NAV_STEPS
-        if normal_nav_steps_len >= MAX_NAV_STEPS and restart_nav_steps_len >= MAX_NAV_STEPS:
+        nav_steps, nav_cost = self.utg.get_cheapest_G2_nav_steps(current_state, target_state,
+                                                                 restart_event=KillAppEvent(app=self.app),
+                                                                 max_steps=MAX_NAV_STEPS)
+        if nav_steps is None:
             self.logger.warning(f'cannot find a path to {target_state.structure_str} {target_state.foreground_activity}')
-            target_state_str = target_state.state_str
             # forget the unavailable state
-            self.memory.known_states.pop(target_state_str)
-            action_strs_to_remove = []
-            for action_str in self.memory.known_transitions:
-                action_from_state = self.memory.known_transitions[action_str]['from_state']
-                action_to_state = self.memory.known_transitions[action_str]['to_state']
-                if action_from_state.state_str == target_state_str or action_to_state.state_str == target_state_str:
-                    action_strs_to_remove.append(action_str)
-            for action_str in action_strs_to_remove:
-                self.memory.known_transitions.pop(action_str)
+            self.memory.forget_state(target_state.state_str)
             return None
-        # elif normal_nav_steps_len > restart_nav_steps_len:  # prefer shortest path
-        elif normal_nav_steps_len >= MAX_NAV_STEPS:  # prefer normal navigation
-            nav_steps = [(current_state, KillAppEvent(app=self.app))] + restart_nav_steps
-        else:
-            nav_steps = normal_nav_steps
+        self.logger.info(f"navigating in {len(nav_steps)} steps, expected cost {nav_cost:.2f}s")
         return nav_steps + [(target_state, target_action)]
 
 
+def benchmark_inference(output_dir, backends=INFERENCE_BACKENDS, num_states=100, inference_threads=None,
+                        text_encoder='bert'):
+    """
+    compare the inference backends on the states recorded in a droidbot output dir,
+    measuring the time to memorize a state (text encoding and embedding) and the drift of the
+    view embeddings from the eager model
+    :param output_dir: the output dir of a previous run, with a UTG database
+    :param backends: the backends to compare, eager is always the reference
+    :param num_states: max number of states to embed
+    :param inference_threads: number of intra-op threads, the torch default if None
+    :param text_encoder: the text encoding method
+    :return: dict from backend to dict of ms_per_state, mean_drift and max_drift
+    """
+    from .device_state import DeviceState
+    from .utg_db import UTGDatabase
+    if inference_threads is not None:
+        torch.set_num_threads(inference_threads)
+    db = UTGDatabase(UTGDatabase.get_db_path(output_dir))
+    states = [DeviceState.from_dict(None, state_dict) for state_dict in db.get_state_dicts()[:num_states]]
+    db.close()
+    if len(states) == 0:
+        raise ValueError(f"no states recorded in {output_dir}")
+
+    backends = ['eager'] + [backend for backend in backends if backend != 'eager']
+    reference_embs = None
+    results = {}
+    for backend in backends:
+        # the same seed gives every backend the same initial weights
+        torch.manual_seed(0)
+        model = UIEmbedTransformer(text_encoder=text_encoder, inference_backend=backend)
+        model.eval()
+        inference_model = optimize_for_inference(copy_embedder(model), backend) if backend != 'eager' else model
+        # warm up, so that the compilation is not measured
+        with torch.no_grad():
+            inference_model([model.encode_state(states[0], states[0].views)])
+        model.text_encoder.cache.clear()
+
+        embs = []
+        start_time = time.perf_counter()
+        for state in states:
+            state_enc = model.encode_state(state, state.views)
+            with torch.no_grad():
+                embs.append(inference_model([state_enc])[0])
+        elapsed = time.perf_counter() - start_time
+
+        if reference_embs is None:
+            reference_embs = embs
+        drifts = torch.cat([1 - torch.cosine_similarity(emb, reference_emb, dim=-1)
+                            for emb, reference_emb in zip(embs, reference_embs)])
+        results[backend] = {
+            'ms_per_state': elapsed * 1000 / len(states),
+            'mean_drift': float(drifts.mean()),
+            'max_drift': float(drifts.max())
+        }
+        print(f'| {backend:8s} | {results[backend]["ms_per_state"]:8.2f} ms/state '
+              f'| speedup {results["eager"]["ms_per_state"] / results[backend]["ms_per_state"]:5.2f}x '
+              f'| drift mean {results[backend]["mean_drift"]:.5f} max {results[backend]["max_drift"]:.5f} |')
+    return results
+
+
 # class InputPolicy2(object):
 #     """
 #     This class is responsible for generating events to stimulate more app behaviour
@@ -746,3 +1440,14 @@ class MemoryGuidedPolicy(UtgBasedInputPolicy):
 #     def start_episode(self):
 #         pass
 
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the inference backends of the UI embedder.")
+    parser.add_argument("output_dir", help="output dir of a previous droidbot run")
+    parser.add_argument("-backends", nargs="+", default=INFERENCE_BACKENDS, choices=INFERENCE_BACKENDS)
+    parser.add_argument("-n", type=int, default=100, dest="num_states", help="max number of states to embed")
+    parser.add_argument("-threads", type=int, default=None, dest="inference_threads")
+    parser.add_argument("-text_encoder", default="bert", choices=["bert", "spacy", "hash"])
+    opts = parser.parse_args()
+    benchmark_inference(opts.output_dir, opts.backends, opts.num_states, opts.inference_threads, opts.text_encoder)
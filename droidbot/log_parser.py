@@ -0,0 +1,199 @@
+import array
+import bisect
+import collections
+import os
+import threading
+from datetime import datetime
+
+# Max number of bytes read from a log process at once
+LOG_READ_SIZE = 64 * 1024
+# Default number of parsed records kept in a LogBuffer
+DEFAULT_LOG_BUFFER_SIZE = 50000
+
+
+class LogRecord(collections.namedtuple("LogRecord", ["seq", "time", "pid", "tid", "level", "tag", "content"])):
+    __slots__ = ()
+
+    def to_line(self):
+        return "%s %d %d %s %s: %s" % (self.time, self.pid, self.tid, self.level, self.tag, self.content)
+
+
+def iter_log_blocks(fd):
+    """
+    read the output of a log process in blocks
+    :param fd: file descriptor of the output
+    :return: iterator of (data, lines), the raw bytes read and the complete lines they end, without line breaks
+    """
+    partial_line = b""
+    while True:
+        try:
+            data = os.read(fd, LOG_READ_SIZE)
+        except OSError:
+            break
+        if not data:
+            break
+        lines = (partial_line + data).split(b"\n")
+        # the last item is the beginning of a line that is not read yet
+        partial_line = lines.pop()
+        if lines:
+            lines = b"\n".join(lines).decode("utf-8", errors="replace").replace("\r", "").split("\n")
+        yield data, lines
+    if partial_line:
+        yield b"", [partial_line.decode("utf-8", errors="replace").replace("\r", "")]
+
+
+def split_log_line(line):
+    """
+    split a line in the threadtime format of logcat, which hilog also uses:
+    "MM-DD HH:MM:SS.mmm PID TID LEVEL TAG: CONTENT"
+    :return: (time, pid, tid, level, tag, content), time as "MM-DD HH:MM:SS.mmm", or None if the line is not a log
+    """
+    fields = line.split(None, 5)
+    if len(fields) < 6 or len(fields[4]) != 1:
+        return None
+    tag, sep, content = fields[5].partition(":")
+    if not sep:
+        return None
+    try:
+        return "%s %s" % (fields[0], fields[1]), int(fields[2]), int(fields[3]), fields[4], tag.strip(), content.lstrip()
+    except ValueError:
+        return None
+
+
+def parse_log_time(log_time, year=None):
+    """
+    parse the time of a log line
+    :param log_time: "MM-DD HH:MM:SS.mmm", as returned by split_log_line
+    :param year: the year of the log, the current year by default
+    :return: datetime
+    """
+    if year is None:
+        year = datetime.today().year
+    try:
+        return datetime(year, int(log_time[0:2]), int(log_time[3:5]), int(log_time[6:8]), int(log_time[9:11]),
+                        int(log_time[12:14]), int(log_time[15:21].ljust(6, "0")))
+    except ValueError:
+        return datetime.strptime("%s-%s" % (year, log_time), "%Y-%m-%d %H:%M:%S.%f")
+
+
+class LogBuffer(object):
+    """
+    Ring buffer of parsed log records, stored column by column and indexed by pid and tag,
+    so that the records of a process or a tag in a range of time are found without scanning the log.
+    Each record has a sequence number, which callers keep to read the records since a step.
+    The times are kept as "MM-DD HH:MM:SS.mmm" strings, which sort like the times, and only parsed on demand.
+    """
+
+    def __init__(self, capacity=DEFAULT_LOG_BUFFER_SIZE):
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.times = [None] * capacity
+        self.pids = array.array("i", [0]) * capacity
+        self.tids = array.array("i", [0]) * capacity
+        self.levels = [None] * capacity
+        self.tags = [None] * capacity
+        self.contents = [None] * capacity
+        # the sequence number of the next record
+        self.num_records = 0
+        self.pid_index = {}
+        self.tag_index = {}
+        # functions called with the new records after each batch of lines
+        self.listeners = []
+
+    def __len__(self):
+        return min(self.num_records, self.capacity)
+
+    def get_seq(self):
+        return self.num_records
+
+    def get_first_seq(self):
+        return max(0, self.num_records - self.capacity)
+
+    def add_listener(self, listener):
+        """
+        register a function to call with the list of new LogRecords, in the thread reading the log
+        """
+        self.listeners.append(listener)
+
+    def add_lines(self, lines):
+        """
+        parse log lines and add the valid ones
+        :param lines: list of str
+        """
+        with self.lock:
+            start_seq = self.num_records
+            for line in lines:
+                fields = split_log_line(line)
+                if fields is None:
+                    continue
+                seq = self.num_records
+                i = seq % self.capacity
+                log_time, pid, tid, level, tag, content = fields
+                self.times[i] = log_time
+                self.pids[i] = pid
+                self.tids[i] = tid
+                self.levels[i] = level
+                self.tags[i] = tag
+                self.contents[i] = content
+                self.pid_index.setdefault(pid, []).append(seq)
+                self.tag_index.setdefault(tag, []).append(seq)
+                self.num_records += 1
+                if self.num_records % self.capacity == 0:
+                    self.__prune_indexes()
+            new_records = [self.__get_record(seq) for seq in range(max(start_seq, self.get_first_seq()),
+                                                                   self.num_records)] if self.listeners else None
+        if new_records:
+            for listener in self.listeners:
+                listener(new_records)
+
+    def __prune_indexes(self):
+        # drop the sequence numbers that left the ring buffer
+        first_seq = self.get_first_seq()
+        for index in [self.pid_index, self.tag_index]:
+            for key in list(index.keys()):
+                seqs = index[key]
+                n = bisect.bisect_left(seqs, first_seq)
+                if n == len(seqs):
+                    del index[key]
+                elif n > 0:
+                    index[key] = seqs[n:]
+
+    def __get_record(self, seq):
+        i = seq % self.capacity
+        return LogRecord(seq, self.times[i], self.pids[i], self.tids[i], self.levels[i], self.tags[i],
+                         self.contents[i])
+
+    def query(self, pid=None, tag=None, since_seq=0, start_time=None, end_time=None, levels=None):
+        """
+        find the records matching all the given conditions
+        :param pid: int, the pid of the process
+        :param tag: str, the tag of the records
+        :param since_seq: the min sequence number, e.g. returned by get_seq at a previous step
+        :param start_time: "MM-DD HH:MM:SS.mmm", the min time
+        :param end_time: "MM-DD HH:MM:SS.mmm", the max time
+        :param levels: str of the levels to keep, e.g. "EF"
+        :return: list of LogRecord, in the order of the log
+        """
+        with self.lock:
+            since_seq = max(since_seq, self.get_first_seq())
+            if pid is not None or tag is not None:
+                candidates = None
+                for index, key in [(self.pid_index, pid), (self.tag_index, tag)]:
+                    if key is None:
+                        continue
+                    seqs = index.get(key, [])
+                    seqs = seqs[bisect.bisect_left(seqs, since_seq):]
+                    candidates = seqs if candidates is None else sorted(set(candidates).intersection(seqs))
+            else:
+                candidates = range(since_seq, self.num_records)
+            records = []
+            for seq in candidates:
+                i = seq % self.capacity
+                if levels is not None and self.levels[i] not in levels:
+                    continue
+                if start_time is not None and self.times[i] < start_time:
+                    continue
+                if end_time is not None and self.times[i] > end_time:
+                    continue
+                records.append(self.__get_record(seq))
+            return records
@@ -5,12 +5,64 @@ import logging
 #import analysis
 import subprocess
 import os, threading
+import queue
+import collections
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "scripts")
+# Hook events are sent from the app in batches, flushed every MONITOR_BATCH_INTERVAL ms
+# or as soon as MONITOR_BATCH_SIZE events are buffered. A batch size of 1 sends each call at once.
+MONITOR_BATCH_INTERVAL = 200
+MONITOR_BATCH_SIZE = 64
+# Max number of hook events kept until they are consumed
+MAX_MONITOR_EVENTS = 100000
+
+# Prepended to the hook scripts: send() buffers the payloads of the hooks with the time of the call,
+# and the buffer is sent as one ["BATCH", now, [[time, payload], ...]] message.
+BATCH_SCRIPT_TEMPLATE = """
+var __droidbotSend = send;
+var __droidbotBatch = [];
+function __droidbotFlush() {
+    if (__droidbotBatch.length > 0) {
+        var batch = __droidbotBatch;
+        __droidbotBatch = [];
+        __droidbotSend(["BATCH", Date.now(), batch]);
+    }
+}
+send = function(payload, data) {
+    if (data !== undefined) {
+        __droidbotFlush();
+        __droidbotSend(payload, data);
+        return;
+    }
+    __droidbotBatch.push([Date.now(), payload]);
+    if (__droidbotBatch.length >= %(batch_size)d) {
+        __droidbotFlush();
+    }
+};
+setInterval(__droidbotFlush, %(batch_interval)d);
+"""
+
+
+class APIEvent(collections.namedtuple("APIEvent", ["time", "kind", "api", "stack"])):
+    """
+    A call of a hooked API. time is in the time.monotonic() clock, kind is "SENSITIVE" or "INTERESTED".
+    """
+    __slots__ = ()
+
 
 class Monitor(object):
     """
         this class monitor the sensitive api
         """
-    def __init__(self):
+    # the source of the hook scripts and their compiled bytecode, shared by the monitors
+    script_sources = {}
+    compiled_scripts = {}
+
+    def __init__(self, batch_interval=MONITOR_BATCH_INTERVAL, batch_size=MONITOR_BATCH_SIZE):
+        """
+        :param batch_interval: max number of ms a hook event is buffered in the app before it is sent
+        :param batch_size: max number of hook events sent at once, 1 to send each event at once
+        """
         self.packageName = None
         self.device = None
         self.sensitive_api = list()
@@ -24,6 +76,12 @@ class Monitor(object):
         self.first_trigger = None
         self.first_trigger_time = 0
         self.trigger_number = 0
+        self.start_time = None
+        self.batch_interval = batch_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # APIEvents, for the consumers waiting for the hooked calls
+        self.event_queue = queue.Queue(maxsize=MAX_MONITOR_EVENTS)
 
     def set_up(self):
         self._setLogPath()
@@ -47,28 +105,90 @@ class Monitor(object):
                             filemode="w")
 
     def _build_monitor_script(self, dir, topdown=True):
-        script = ""
-        for root, dirs, files in os.walk(dir, topdown):
-            for name in files:
-                script += open(os.path.join(root, name)).read()
+        """
+        concatenate the hook scripts, read once per directory
+        """
+        script = Monitor.script_sources.get(dir)
+        if script is None:
+            script = ""
+            for root, dirs, files in os.walk(dir, topdown):
+                dirs.sort()
+                for name in sorted(files):
+                    with open(os.path.join(root, name)) as f:
+                        script += f.read() + "\n"
+            Monitor.script_sources[dir] = script
+        if self.batch_size > 1:
+            script = BATCH_SCRIPT_TEMPLATE % {"batch_size": self.batch_size,
+                                              "batch_interval": self.batch_interval} + script
         return script
 
+    def _create_script(self, session, script_content):
+        """
+        create the script from its bytecode, compiled at the first call
+        """
+        if not hasattr(session, "compile_script"):
+            # frida is too old to compile scripts
+            return session.create_script(script_content)
+        script_bytes = Monitor.compiled_scripts.get(script_content)
+        if script_bytes is None:
+            script_bytes = session.compile_script(script_content)
+            Monitor.compiled_scripts[script_content] = script_bytes
+        return session.create_script_from_bytes(script_bytes)
 
-    def _on_message(self, message):
+    def _on_message(self, message, data=None):
         if message['type'] == 'send':
             msg = message['payload']
-            if msg[0] == "SENSITIVE":
+            receive_time = time.monotonic()
+            if isinstance(msg, list) and len(msg) == 3 and msg[0] == "BATCH":
+                # the calls are dated by the clock of the app, relatively to the time the batch was sent
+                send_time = msg[1]
+                for call_time, payload in msg[2]:
+                    self._add_event(receive_time - max(0, send_time - call_time) / 1000.0, payload)
+            else:
+                self._add_event(receive_time, msg)
+        elif message['type'] == 'error':
+            logging.info(message['stack'])
+
+    def _add_event(self, event_time, payload):
+        if not isinstance(payload, list) or len(payload) < 3:
+            self.logger.debug(payload)
+            return
+        event = APIEvent(event_time, payload[0], payload[1], payload[2])
+        with self.lock:
+            if event.kind == "SENSITIVE":
                 if self.first_trigger is None:
-                    self.first_trigger_time = time.clock - self.start_time
+                    self.first_trigger_time = event_time - self.start_time if self.start_time is not None else 0
                     self.first_trigger = True
-                self.sensitive_api.append(msg[1])
+                self.sensitive_api.append(event.api)
                 self.trigger_number += 1
             else:
-                self.interested_api.append(msg[1])
-            self.method_stack.append(msg[2])
-            # logging.info(message['payload'])
-        elif message['type'] == 'error':
-            logging.info(message['stack'])
+                self.interested_api.append(event.api)
+            self.method_stack.append(event.stack)
+        try:
+            self.event_queue.put_nowait(event)
+        except queue.Full:
+            # nobody consumes the events, drop the oldest one
+            try:
+                self.event_queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.event_queue.put_nowait(event)
+
+    def get_events(self, timeout=None):
+        """
+        get the hooked calls since the last call, waiting for one if there is none
+        :param timeout: max number of seconds to wait, None to wait until a call
+        :return: list of APIEvent, empty if the timeout expired
+        """
+        try:
+            events = [self.event_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                events.append(self.event_queue.get_nowait())
+            except queue.Empty:
+                return events
 
     def _start_server(self):
         task = threading.Thread(target=self._startServer)
@@ -86,6 +206,7 @@ class Monitor(object):
             self.device = frida.get_usb_device()
             self.pid = self.device.spawn([packageName])
             self.session = self.device.attach(self.pid)
+            self.session.on("detached", self._on_detached)
         except Exception as e:
             self.logger.error("[ERROR]: %s" % str(e))
             self.logger.info("waiting for process")
@@ -95,37 +216,43 @@ class Monitor(object):
         self.logger.info("successfully attached to app")
         return
 
+    def _on_detached(self, reason, *args):
+        # the app died or frida lost it, check_env attaches again
+        self.logger.info("detached from app: %s" % reason)
+        self.attached = False
+        self.pid = None
+
     def _detach(self, session):
-        session.detach()
+        if session is not None:
+            session.detach()
         self.attached = False
 
     def _load_script(self, session, pid):
         if self.attached:
-            script_dir = os.path.join(".", "droidbot", "resources", "scripts")
-            script_content = self._build_monitor_script(script_dir)
-            script = session.create_script(script_content)
+            script_content = self._build_monitor_script(SCRIPTS_DIR)
+            script = self._create_script(session, script_content)
             script.on("message", self._on_message)
             script.load()
             self.device.resume(pid)
-            self.start_time = time.clock()
+            self.start_time = time.monotonic()
 
     def _getPid(self):
-        cmd = "adb shell ps | grep " + self.packageName
-        result = os.popen(cmd)
-        if result is not None:
+        if self.attached:
+            # the session tells when the app dies
             return self.pid
-        else:
-            cmd = "frida-ps -U"
-            temp_pid = None
-            result = os.popen(cmd)
-            for i in result.readlines():
-                if self.packageName != None and self.packageName in i:
-                    temp_pid = i.split("  ")[0]
+        temp_pid = None
+        if self.device is None:
+            return None
+        try:
+            for process in self.device.enumerate_processes():
+                if self.packageName is not None and process.name.split(":")[0] == self.packageName:
+                    temp_pid = process.pid
                     break
-                else:
-                    temp_pid = None
-                    print("Process not found")
-            self.pid = temp_pid
+        except Exception as e:
+            self.logger.warning("listing the processes failed: %s" % e)
+        if temp_pid is None:
+            print("Process not found")
+        self.pid = temp_pid
         #self.notify()
         return self.pid
 
@@ -151,8 +278,10 @@ class Monitor(object):
             self.logger.warning("error waiting for device")
 
     def check_env(self):
-        self._getPid()
+        if self.attached:
+            return
         self._getDevice()
+        self._getPid()
         if not self.device:
             self._wait_for_devices()
             self.set_up()
@@ -167,18 +296,21 @@ class Monitor(object):
             return
 
     def get_sensitive_api(self):
-        temp_state = self.sensitive_api
-        self.sensitive_api = list()
+        with self.lock:
+            temp_state = self.sensitive_api
+            self.sensitive_api = list()
         return temp_state
 
     def get_interested_api(self):
-        temp_state = self.interested_api
-        self.interested_api = list()
+        with self.lock:
+            temp_state = self.interested_api
+            self.interested_api = list()
         return temp_state
 
     def get_method_stack_api(self):
-        temp_state = self.method_stack
-        self.method_stack = list()
+        with self.lock:
+            temp_state = self.method_stack
+            self.method_stack = list()
         return temp_state
 
     def get_first_trigger_time(self):
@@ -188,6 +320,6 @@ class Monitor(object):
         return self.trigger_number
 
     def stop(self):
-        self.detach(self.session)
+        self._detach(self.session)
         print("stop monitor...")
         return
\ No newline at end of file
@@ -112,9 +112,9 @@ function getEdgeDetails(edgeId) {
   edgeInfo = "<h2>Transition Details</h2><hr/>\n";
   fromState = getNode(selectedEdge.from);
   toState = getNode(selectedEdge.to);
-  edgeInfo += "<img class=\"col-md-5\" src=\"" + fromState.image + "\">\n"
+  edgeInfo += "<img class=\"col-md-5\" src=\"" + (fromState.screenshot || fromState.image) + "\">\n"
   edgeInfo += "<div class=\"col-md-2 text-center\">TO</div>\n"
-  edgeInfo += "<img class=\"col-md-5\" src=\"" + toState.image + "\">\n"
+  edgeInfo += "<img class=\"col-md-5\" src=\"" + (toState.screenshot || toState.image) + "\">\n"
   edgeInfo += "<table class=\"table table-striped\">\n"
   edgeInfo += "<tr class=\"active\"><th colspan=\"4\"><h4>Events</h4></th></tr>\n";
 
@@ -139,7 +139,7 @@ function getEdgeDetails(edgeId) {
 function getNodeDetails(nodeId) {
   var selectedNode = getNode(nodeId);
   stateInfo = "<h2>State Details</h2><hr/>\n";
-  stateInfo += "<img class=\"col-md-5\" src=\"" + selectedNode.image + "\">"
+  stateInfo += "<img class=\"col-md-5\" src=\"" + (selectedNode.screenshot || selectedNode.image) + "\">"
   stateInfo += "<div class=\"col-md-7\">" + selectedNode.title + "</div>";
   return stateInfo;
 }
@@ -150,7 +150,7 @@ function getClusterDetails(clusterId) {
   for (var i = 0; i < nodeIds.length; i++) {
     var selectedNode = getNode(nodeIds[i]);
     clusterInfo += "<div class=\"row\">\n"
-    clusterInfo += "<img class=\"col-md-5\" src=\"" + selectedNode.image + "\">"
+    clusterInfo += "<img class=\"col-md-5\" src=\"" + (selectedNode.screenshot || selectedNode.image) + "\">"
     clusterInfo += "<div class=\"col-md-7\">" + selectedNode.title + "</div>";
     clusterInfo += "</div><br />"
   }
@@ -167,7 +167,8 @@ class TestEnv(gym.Env):
         self.monitor.set_up()
         while self.running:
             self.monitor.check_env()
-            time.sleep(5)
+            # wake up at the hooked calls instead of polling
+            self.monitor.get_events(timeout=5)
             self.sensitive_behaviors += self.monitor.get_sensitive_api()
             self.executed_APIs = self.monitor.get_interested_api()
             pass
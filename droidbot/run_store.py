@@ -0,0 +1,252 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import zlib
+
+import typing
+if typing.TYPE_CHECKING:
+    from .device_state import DeviceState
+
+RUN_STORE_FILE_NAME = "run.db"
+# The report files copied along when exporting to another dir
+REPORT_FILE_NAMES = ["index.html", "utg.js", "stylesheets"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS states (
+    tag TEXT PRIMARY KEY,
+    state_str TEXT NOT NULL,
+    state_json BLOB NOT NULL,
+    screenshot_path TEXT,
+    screenshot_digest TEXT
+);
+CREATE TABLE IF NOT EXISTS events (
+    tag TEXT NOT NULL,
+    start_state TEXT,
+    stop_state TEXT,
+    event_str TEXT,
+    event_json BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS views (
+    view_path TEXT PRIMARY KEY,
+    screenshot_digest TEXT NOT NULL,
+    bounds TEXT NOT NULL
+);
+"""
+
+
+class RunStore(object):
+    """
+    All the records of a run in one SQLite database, instead of a file per state, event and view image.
+    States and events are stored as compressed JSON, screenshots once per distinct content,
+    and view images as the bounds to crop from a screenshot.
+    The legacy output layout read by the HTML report is written by export.
+    """
+
+    def __init__(self, db_path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db_path = db_path
+        self.run_dir = os.path.dirname(os.path.abspath(db_path))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        # the screenshots known by the paths they will be exported to, to store the views without hashing them again
+        self.screenshot_digests = {}
+        self.view_paths = set()
+        for screenshot_path, digest in self.conn.execute(
+                "SELECT screenshot_path, screenshot_digest FROM states WHERE screenshot_digest IS NOT NULL"):
+            self.screenshot_digests[screenshot_path] = digest
+        for row in self.conn.execute("SELECT view_path FROM views"):
+            self.view_paths.add(row[0])
+
+    @staticmethod
+    def get_db_path(output_dir):
+        return os.path.join(output_dir, RUN_STORE_FILE_NAME)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def __pack(obj):
+        return zlib.compress(json.dumps(obj).encode("utf-8"))
+
+    @staticmethod
+    def __unpack(data):
+        return json.loads(zlib.decompress(data).decode("utf-8"))
+
+    def __get_key(self, file_path):
+        # the files are recorded by their path relative to the output dir
+        return os.path.relpath(file_path, self.run_dir)
+
+    def __add_blob(self, file_path):
+        """
+        store the content of a file once
+        :return: the digest of the content
+        """
+        with open(file_path, "rb") as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        self.conn.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?)", (digest, sqlite3.Binary(data)))
+        return digest
+
+    def add_state(self, state:"DeviceState", screenshot_path):
+        """
+        record a state and its screenshot
+        :param state: DeviceState, with the screenshot it was captured with
+        :param screenshot_path: the path to export the screenshot to
+        """
+        screenshot_path = self.__get_key(screenshot_path)
+        with self.lock, self.conn:
+            digest = None
+            if state.screenshot_path is not None and os.path.exists(state.screenshot_path):
+                digest = self.__add_blob(state.screenshot_path)
+                self.screenshot_digests[screenshot_path] = digest
+            self.conn.execute("INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?)",
+                              (state.tag, state.state_str, self.__pack(state.to_dict()), screenshot_path, digest))
+
+    def add_event(self, event_dict):
+        """
+        record an event, as produced by EventLog.to_dict
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT INTO events VALUES (?, ?, ?, ?, ?)",
+                              (event_dict.get("tag"), event_dict.get("start_state"), event_dict.get("stop_state"),
+                               event_dict.get("event_str"), self.__pack(event_dict)))
+
+    def has_view(self, view_path):
+        return self.__get_key(view_path) in self.view_paths
+
+    def add_view(self, view_path, screenshot_path, bounds):
+        """
+        record the image of a view, to be cropped from the screenshot when exporting
+        :param view_path: the path to export the view image to
+        :param screenshot_path: the screenshot of the state the view is in, either recorded by add_state
+               or a file on disk
+        :param bounds: the bounds of the view
+        """
+        view_path = self.__get_key(view_path)
+        with self.lock, self.conn:
+            if view_path in self.view_paths:
+                return
+            digest = self.screenshot_digests.get(self.__get_key(screenshot_path))
+            if digest is None:
+                digest = self.__add_blob(screenshot_path)
+            self.conn.execute("INSERT OR IGNORE INTO views VALUES (?, ?, ?)",
+                              (view_path, digest, json.dumps(bounds)))
+            self.view_paths.add(view_path)
+
+    def get_event_dicts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT event_json FROM events ORDER BY rowid").fetchall()
+        return [self.__unpack(row[0]) for row in rows]
+
+    def get_blob(self, digest):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM blobs WHERE digest = ?", (digest,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def export(self, output_dir):
+        """
+        write the records in the legacy layout of an output dir:
+        states/state_<tag>.json with the screenshots, events/event_<tag>.json with events.jsonl, and views/
+        :param output_dir: the dir to export to
+        """
+        from .event_store import EVENTS_FILE_NAME
+
+        with self.lock:
+            state_rows = self.conn.execute("SELECT tag, state_json, screenshot_path, screenshot_digest FROM states "
+                                           "ORDER BY rowid").fetchall()
+            event_rows = self.conn.execute("SELECT tag, event_json FROM events ORDER BY rowid").fetchall()
+            view_rows = self.conn.execute("SELECT view_path, screenshot_digest, bounds FROM views "
+                                          "ORDER BY screenshot_digest").fetchall()
+
+        states_dir = os.path.join(output_dir, "states")
+        os.makedirs(states_dir, exist_ok=True)
+        for tag, state_json, screenshot_path, digest in state_rows:
+            with open(os.path.join(states_dir, "state_%s.json" % tag), "w") as f:
+                json.dump(self.__unpack(state_json), f, indent=2)
+            if digest is not None:
+                with open(os.path.join(output_dir, screenshot_path), "wb") as f:
+                    f.write(self.get_blob(digest))
+
+        events_dir = os.path.join(output_dir, "events")
+        os.makedirs(events_dir, exist_ok=True)
+        with open(os.path.join(events_dir, EVENTS_FILE_NAME), "w") as events_file:
+            for tag, event_json in event_rows:
+                event_dict = self.__unpack(event_json)
+                with open(os.path.join(events_dir, "event_%s.json" % tag), "w") as f:
+                    json.dump(event_dict, f, indent=2)
+                events_file.write(json.dumps(event_dict) + "\n")
+
+        if view_rows:
+            from PIL import Image
+            os.makedirs(os.path.join(output_dir, "views"), exist_ok=True)
+            # the views are sorted by screenshot, so that each screenshot is decoded once
+            original_img = None
+            original_digest = None
+            for view_path, digest, bounds in view_rows:
+                try:
+                    if digest != original_digest:
+                        original_img = Image.open(io.BytesIO(self.get_blob(digest)))
+                        original_img.load()
+                        original_digest = digest
+                    view_bound = json.loads(bounds)
+                    view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
+                                                  min(original_img.height - 1, max(0, view_bound[0][1])),
+                                                  min(original_img.width, max(0, view_bound[1][0])),
+                                                  min(original_img.height, max(0, view_bound[1][1]))))
+                    view_img.convert("RGB").save(os.path.join(output_dir, view_path))
+                except Exception as e:
+                    self.logger.warning("Exporting %s failed: %s" % (view_path, e))
+
+        if os.path.abspath(output_dir) != self.run_dir:
+            for file_name in REPORT_FILE_NAMES:
+                src_path = os.path.join(self.run_dir, file_name)
+                dst_path = os.path.join(output_dir, file_name)
+                if os.path.isdir(src_path):
+                    shutil.copytree(src_path, dst_path, dirs_exist_ok=True)
+                elif os.path.exists(src_path):
+                    shutil.copy(src_path, dst_path)
+        self.logger.info("Exported %d states, %d events and %d views to %s"
+                         % (len(state_rows), len(event_rows), len(view_rows), output_dir))
+
+
+def export_run(run_dir, output_dir=None):
+    """
+    export the run store of an output dir to the legacy layout
+    :param run_dir: the output dir of a run recorded with a run store
+    :param output_dir: the dir to export to, the run's output dir by default
+    """
+    db_path = RunStore.get_db_path(run_dir)
+    if not os.path.exists(db_path):
+        raise ValueError("No run store found in %s" % run_dir)
+    run_store = RunStore(db_path)
+    try:
+        run_store.export(output_dir if output_dir is not None else run_dir)
+    finally:
+        run_store.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export the run store of a DroidBot output dir "
+                                                 "to the layout read by the HTML report.")
+    parser.add_argument("-d", action="store", dest="run_dir", required=True,
+                        help="The output dir of the run.")
+    parser.add_argument("-o", action="store", dest="output_dir",
+                        help="The dir to export to. Default: the output dir of the run.")
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    export_run(opts.run_dir, opts.output_dir)
@@ -5,6 +5,8 @@ import os
 from . import input_manager
 from . import input_policy
 from . import env_manager
+from .adapter import process_monitor
+from . import utg
 from .droidbot import DroidBot
 from .droidmaster import DroidMaster
 from .utils import get_yml_config, identify_device_serial, load_yml_args, check_package
@@ -192,12 +194,162 @@ def parse_args():
         dest="replay_output",
         help="The droidbot output directory being replayed.",
     )
+    parser.add_argument(
+        "-replay_fast_forward",
+        action="store_true",
+        dest="replay_fast_forward",
+        help="Send the replayed events back to back without capturing the states, checking the position with "
+             "the screen layout only at checkpoints and where the recorded run was not deterministic.",
+    )
+    parser.add_argument(
+        "-replay_checkpoint_interval",
+        action="store",
+        dest="replay_checkpoint_interval",
+        type=int,
+        help="Max number of events sent between two position checks in fast-forward replay. Default: 10.",
+    )
+    parser.add_argument(
+        "-resume",
+        action="store",
+        dest="resume_dir",
+        help="Resume exploration from the UTG recorded in a previous droidbot output directory.",
+    )
+    parser.add_argument(
+        "-pipeline",
+        action="store_true",
+        dest="pipeline",
+        help="Pipelined steps: while the device settles after an event, prepare the decision for the state "
+             "the event is expected to lead to, and use it if the prediction is right (utg based policies only).",
+    )
+    parser.add_argument(
+        "-text_cache_dir",
+        action="store",
+        dest="text_cache_dir",
+        help="Directory of the on-disk text embedding cache shared between runs (memory_guided policy only).",
+    )
+    parser.add_argument(
+        "-warm_start",
+        action="store",
+        dest="warm_start_dir",
+        help="Warm-start the model of the memory_guided policy from the checkpoint of a previous run of the same app. "
+             "Either the output dir of the previous run, or a dir of output dirs, in which the latest matching "
+             "checkpoint is used.",
+    )
+    parser.add_argument(
+        "-text_encoder",
+        action="store",
+        dest="text_encoder",
+        default="bert",
+        choices=["bert", "spacy", "hash"],
+        help="How view texts are embedded (memory_guided policy only): pretrained BERT, spaCy vectors, "
+             "or hashed character n-grams, which need no download. Default: bert.",
+    )
+    parser.add_argument(
+        "-inference_backend",
+        action="store",
+        dest="inference_backend",
+        default="eager",
+        choices=["eager", "int8", "compile"],
+        help="How the embedding models run on CPU (memory_guided policy only): "
+             "eager PyTorch, int8 dynamic quantization, or torch.compile. Default: eager.",
+    )
+    parser.add_argument(
+        "-inference_threads",
+        action="store",
+        dest="inference_threads",
+        type=int,
+        help="Number of intra-op threads used by the embedding models (memory_guided policy only).",
+    )
+    parser.add_argument(
+        "-train_interval",
+        action="store",
+        dest="train_interval",
+        type=int,
+        default=10,
+        help="Train the model every this many events (memory_guided policy only). Default: 10.",
+    )
+    parser.add_argument(
+        "-train_iterations",
+        action="store",
+        dest="train_iterations",
+        type=int,
+        default=10,
+        help="Optimizer iterations per training round (memory_guided policy only). Default: 10.",
+    )
+    parser.add_argument(
+        "-train_time_budget",
+        action="store",
+        dest="train_time_budget",
+        type=float,
+        help="Max seconds per training round (memory_guided policy only). Default: no limit.",
+    )
+    parser.add_argument(
+        "-sync_training",
+        action="store_false",
+        dest="background_training",
+        help="Train the model in the exploration thread instead of a background thread "
+             "(memory_guided policy only).",
+    )
+    parser.add_argument(
+        "-near_duplicate_threshold",
+        action="store",
+        dest="near_duplicate_threshold",
+        type=float,
+        default=utg.NEAR_DUPLICATE_THRESHOLD,
+        help="Similarity of the view structures above which near-duplicate states share one node of the "
+             "clustered UTG. 1 to only cluster the states with the same structure. Default: %s"
+             % utg.NEAR_DUPLICATE_THRESHOLD,
+    )
     parser.add_argument(
         "-log",
         action="store_true",
         dest="save_log",
         help="Save the device log while testing. Can be found in the report directory (Logcat in Android and Hilog in HarmonyOS",
     )
+    parser.add_argument(
+        "-hilog_app_only",
+        action="store_true",
+        dest="hilog_app_only",
+        help="Only read the hilog of the app (HarmonyOS only), filtered on its pid on the device. "
+             "The logs of the crash reporters are kept with -detect_crashes.",
+    )
+    parser.add_argument(
+        "-detect_crashes",
+        action="store_true",
+        dest="detect_crashes",
+        help="Watch the device log for crashes, ANRs/app freezes and deaths of the app, restart the app as soon as "
+             "one is detected, and record them with the triggering events in crashes.jsonl.",
+    )
+    parser.add_argument(
+        "-run_store",
+        action="store_true",
+        dest="run_store",
+        help="Record the states, events and view images in one database (run.db) instead of a file for each. "
+             "Export it to the report layout with: python -m droidbot.run_store -d <output_dir>",
+    )
+    parser.add_argument(
+        "-perceptual_dedup",
+        action="store_true",
+        dest="perceptual_dedup",
+        help="Store the screenshots that only differ by a few pixels once, using a perceptual hash "
+             "instead of the exact content.",
+    )
+    parser.add_argument(
+        "-process_refresh_interval",
+        action="store",
+        dest="process_refresh_interval",
+        type=float,
+        default=process_monitor.DEFAULT_PROCESS_REFRESH_INTERVAL,
+        help="Seconds between two refreshes of the process table of the device, used to find the pid of the app. "
+             "Default: %s" % process_monitor.DEFAULT_PROCESS_REFRESH_INTERVAL,
+    )
+    parser.add_argument(
+        "-trace",
+        action="store_true",
+        dest="trace",
+        help="Time each stage of the exploration (device commands, layout, state, UTG, policy, events, I/O). "
+             "A Chrome trace (trace.json) and a summary (trace_summary.json) are written to the output dir.",
+    )
     parser.add_argument(
         "-is_harmonyos",
         action="store_true",
@@ -286,8 +438,28 @@ def main():
             humanoid=opts.humanoid,
             ignore_ad=opts.ignore_ad,
             replay_output=opts.replay_output,
+            resume_dir=opts.resume_dir,
+            text_cache_dir=opts.text_cache_dir,
+            warm_start_dir=opts.warm_start_dir,
+            text_encoder=opts.text_encoder,
+            inference_backend=opts.inference_backend,
+            inference_threads=opts.inference_threads,
+            train_interval=opts.train_interval,
+            background_training=opts.background_training,
+            train_iterations=opts.train_iterations,
+            train_time_budget=opts.train_time_budget,
+            near_duplicate_threshold=opts.near_duplicate_threshold,
+            pipeline=opts.pipeline,
+            replay_fast_forward=opts.replay_fast_forward,
+            replay_checkpoint_interval=opts.replay_checkpoint_interval,
+            detect_crashes=opts.detect_crashes,
             is_harmonyos=opts.is_harmonyos,
             save_log=opts.save_log,
+            run_store=opts.run_store,
+            perceptual_dedup=opts.perceptual_dedup,
+            hilog_app_only=opts.hilog_app_only,
+            process_refresh_interval=opts.process_refresh_interval,
+            trace=opts.trace,
         )
         droidbot.start()
     return
@@ -0,0 +1,96 @@
+import hashlib
+import random
+
+# Number of hash permutations in a MinHash sketch
+MINHASH_NUM_PERM = 64
+# Number of LSH bands, each band covers MINHASH_NUM_PERM / LSH_NUM_BANDS permutations
+LSH_NUM_BANDS = 16
+# Default Jaccard similarity above which two element sets are near-duplicates
+DEFAULT_SIMILARITY_THRESHOLD = 0.9
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+class MinHashLSHIndex(object):
+    """
+    Near-duplicate index over element sets (e.g. the view signatures of states).
+    Each set is sketched with MinHash, and the sketches are split into bands for LSH,
+    so that finding the similar sets only compares against the sets sharing a band.
+    """
+
+    def __init__(self, threshold=DEFAULT_SIMILARITY_THRESHOLD, num_perm=MINHASH_NUM_PERM, num_bands=LSH_NUM_BANDS,
+                 seed=1):
+        if num_perm % num_bands != 0:
+            raise ValueError("num_perm must be a multiple of num_bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.num_bands = num_bands
+        self.band_size = num_perm // num_bands
+        rand = random.Random(seed)
+        self.permutations = [(rand.randrange(1, MERSENNE_PRIME), rand.randrange(0, MERSENNE_PRIME))
+                             for _ in range(num_perm)]
+        self.sketches = {}
+        self.buckets = {}
+
+    def __contains__(self, key):
+        return key in self.sketches
+
+    def __len__(self):
+        return len(self.sketches)
+
+    def sketch(self, elements):
+        """
+        compute the MinHash sketch of a set of strings
+        :param elements: iterable of str
+        :return: tuple of num_perm ints
+        """
+        hashes = [int.from_bytes(hashlib.blake2b(element.encode("utf-8"), digest_size=4).digest(), "big")
+                  for element in set(elements)]
+        if not hashes:
+            return tuple([MAX_HASH] * self.num_perm)
+        return tuple(min(((a * h + b) % MERSENNE_PRIME) & MAX_HASH for h in hashes)
+                     for a, b in self.permutations)
+
+    def __get_bands(self, sketch):
+        return [(i, sketch[i * self.band_size:(i + 1) * self.band_size]) for i in range(self.num_bands)]
+
+    def add(self, key, elements):
+        """
+        add a set to the index
+        :param key: hashable key of the set
+        :param elements: iterable of str
+        """
+        if key in self.sketches:
+            return
+        sketch = self.sketch(elements)
+        self.sketches[key] = sketch
+        for band in self.__get_bands(sketch):
+            self.buckets.setdefault(band, []).append(key)
+
+    def similarity(self, sketch1, sketch2):
+        """
+        estimate the Jaccard similarity of two sketched sets
+        """
+        return sum(1 for h1, h2 in zip(sketch1, sketch2) if h1 == h2) / self.num_perm
+
+    def query(self, elements, threshold=None):
+        """
+        find the known sets similar to the given set
+        :param elements: iterable of str
+        :param threshold: min estimated Jaccard similarity, the threshold of the index by default
+        :return: list of (key, similarity), the most similar first
+        """
+        if threshold is None:
+            threshold = self.threshold
+        sketch = self.sketch(elements)
+        candidates = set()
+        for band in self.__get_bands(sketch):
+            candidates.update(self.buckets.get(band, []))
+        results = []
+        for key in candidates:
+            similarity = self.similarity(sketch, self.sketches[key])
+            if similarity >= threshold:
+                results.append((key, similarity))
+        results.sort(key=lambda x: -x[1])
+        return results
@@ -0,0 +1,191 @@
+import collections
+import json
+import logging
+import os
+import random
+
+import typing
+if typing.TYPE_CHECKING:
+    from .device_state import DeviceState
+    from .device import Device
+    from .device_hm import DeviceHM
+    from .utg_db import UTGDatabase
+
+# Max number of full DeviceState objects kept in memory
+DEFAULT_MAX_CACHED_STATES = 100
+# Max number of sample states kept for each structure cluster
+MAX_CLUSTER_SAMPLES = 10
+
+
+class StateSummary(object):
+    """
+    The small part of a DeviceState that the UTG needs for every known state.
+    """
+    __slots__ = ["state_str", "structure_str", "foreground_activity", "activity_stack",
+                 "pagePath", "tag", "screenshot_path", "search_content", "possible_event_keys",
+                 "possible_cluster_event_keys"]
+
+    def __init__(self, state:"DeviceState", cluster_str=None):
+        self.state_str = state.state_str
+        self.structure_str = state.structure_str
+        self.foreground_activity = state.foreground_activity
+        self.activity_stack = state.activity_stack
+        self.pagePath = state.pagePath
+        self.tag = state.tag
+        self.screenshot_path = state.screenshot_path
+        self.search_content = state.search_content
+        self.possible_event_keys = [event.get_event_key(state) for event in state.get_possible_input()]
+        self.possible_cluster_event_keys = [event.get_event_key(state, cluster_str) for event in state.get_possible_input()] \
+            if cluster_str is not None else None
+
+    def get_app_activity_depth(self, app):
+        """
+        Get the depth of the app's activity in the activity stack
+        :param app: App
+        :return: the depth of app's activity, -1 for not found
+        """
+        depth = 0
+        for activity_str in self.activity_stack:
+            if not activity_str:
+                return -1
+            if app.package_name in activity_str:
+                return depth
+            depth += 1
+        return -1
+
+
+class StateCluster(object):
+    """
+    A reservoir sample of the distinct states sharing one structure_str.
+    """
+
+    def __init__(self, max_samples=MAX_CLUSTER_SAMPLES):
+        self.max_samples = max_samples
+        self.num_states = 0
+        self.state_strs = []
+
+    def add(self, state_str):
+        self.num_states += 1
+        if len(self.state_strs) < self.max_samples:
+            self.state_strs.append(state_str)
+            return
+        i = random.randrange(self.num_states)
+        if i < self.max_samples:
+            self.state_strs[i] = state_str
+
+    def __len__(self):
+        return len(self.state_strs)
+
+
+class StateStore(object):
+    """
+    Memory-bounded store of the states in a UTG.
+    A StateSummary is kept for every state, while full states are kept in a LRU cache.
+    Evicted states are loaded back on demand from the UTG database if there is one,
+    otherwise they are spilled to <output_dir>/state_store.
+    """
+
+    def __init__(self, device:typing.Union["Device", "DeviceHM"], max_cached_states=DEFAULT_MAX_CACHED_STATES,
+                 db:"UTGDatabase"=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device = device
+        self.max_cached_states = max_cached_states
+        self.db = db
+
+        self.summaries = {}
+        self.cache = collections.OrderedDict()
+        self.spilled_state_strs = set()
+
+        self.store_dir = None
+        if db is None and device.output_dir is not None:
+            self.store_dir = os.path.join(device.output_dir, "state_store")
+        elif db is None:
+            self.logger.info("No output dir, all states will be kept in memory.")
+
+    def __contains__(self, state_str):
+        return state_str in self.summaries
+
+    def __len__(self):
+        return len(self.summaries)
+
+    def add(self, state:"DeviceState", cluster_str=None):
+        """
+        add a state to the store, or refresh its cached copy
+        :param state: DeviceState
+        :param cluster_str: the cluster of near-identical states the state belongs to
+        :return: StateSummary of the state
+        """
+        if state.state_str not in self.summaries:
+            self.summaries[state.state_str] = StateSummary(state, cluster_str)
+        self.__cache(state)
+        return self.summaries[state.state_str]
+
+    def get_summary(self, state_str) -> StateSummary:
+        return self.summaries.get(state_str)
+
+    def get(self, state_str) -> "DeviceState":
+        """
+        get the full state, loading it from disk if it has been evicted
+        :param state_str: str
+        :return: DeviceState, or None if the state is unknown
+        """
+        if state_str in self.cache:
+            self.cache.move_to_end(state_str)
+            return self.cache[state_str]
+        if state_str not in self.spilled_state_strs:
+            return None
+        state = self.__load(state_str)
+        if state is not None:
+            self.__cache(state)
+        return state
+
+    def __cache(self, state:"DeviceState"):
+        self.cache[state.state_str] = state
+        self.cache.move_to_end(state.state_str)
+        if self.store_dir is None and self.db is None:
+            return
+        while len(self.cache) > self.max_cached_states:
+            evicted_state_str, evicted_state = self.cache.popitem(last=False)
+            if evicted_state_str in self.spilled_state_strs:
+                continue
+            if not self.__spill(evicted_state):
+                # keep the state in memory rather than losing it
+                self.cache[evicted_state_str] = evicted_state
+                break
+
+    def __get_path(self, state_str):
+        return os.path.join(self.store_dir, "%s.json" % state_str)
+
+    def __spill(self, state:"DeviceState"):
+        if self.db is not None:
+            # the UTG has already written the state to the database
+            self.spilled_state_strs.add(state.state_str)
+            return True
+        try:
+            if not os.path.exists(self.store_dir):
+                os.makedirs(self.store_dir)
+            state_dict = state.to_dict()
+            state_dict["screenshot_path"] = state.screenshot_path
+            with open(self.__get_path(state.state_str), "w") as f:
+                json.dump(state_dict, f)
+            self.spilled_state_strs.add(state.state_str)
+            return True
+        except Exception as e:
+            self.logger.warning("Failed to spill state %s: %s" % (state.state_str, e))
+            return False
+
+    def __load(self, state_str):
+        from .device_state import DeviceState
+        try:
+            if self.db is not None:
+                state_dict = self.db.get_state_dict(state_str)
+            else:
+                with open(self.__get_path(state_str), "r") as f:
+                    state_dict = json.load(f)
+        except Exception as e:
+            self.logger.warning("Failed to load state %s: %s" % (state_str, e))
+            return None
+        if state_dict is None:
+            return None
+        return DeviceState.from_dict(self.device, state_dict,
+                                     screenshot_path=state_dict.get("screenshot_path"))
@@ -0,0 +1,275 @@
+import collections
+import functools
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+TRACE_FILE_NAME = "trace.json"
+TRACE_SUMMARY_FILE_NAME = "trace_summary.json"
+# Max number of spans kept for the trace file, the oldest ones are dropped first
+MAX_TRACE_EVENTS = 1000000
+# Number of histogram buckets per doubling of the duration, i.e. about 19% of resolution
+HISTOGRAM_BUCKETS_PER_OCTAVE = 4
+
+# Categories of the spans. The spans of the device category are round trips with the device.
+STAGE_CATEGORY = "stage"
+DEVICE_CATEGORY = "device"
+IO_CATEGORY = "io"
+STEP_CATEGORY = "step"
+ROUND_TRIPS_STAT_NAME = "device round trips per step"
+
+
+class Histogram(object):
+    """
+    Log-scale histogram of durations (or counts), cheap to update at every span
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.Counter()
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[int(math.floor(math.log2(value) * HISTOGRAM_BUCKETS_PER_OCTAVE)) if value > 0 else None] += 1
+
+    def get_percentile(self, percentile):
+        """
+        :param percentile: float in [0, 100]
+        :return: the upper bound of the bucket the percentile is in, at most the max value
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * percentile / 100.0
+        seen = self.buckets.get(None, 0)
+        if seen >= rank:
+            return 0.0
+        for bucket in sorted(k for k in self.buckets if k is not None):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(self.max, 2 ** ((bucket + 1) / HISTOGRAM_BUCKETS_PER_OCTAVE))
+        return self.max
+
+    def to_dict(self, scale=1.0):
+        return {
+            "count": self.count,
+            "total": round(self.total * scale, 3),
+            "mean": round(self.total * scale / self.count, 3) if self.count else 0.0,
+            "p50": round(self.get_percentile(50) * scale, 3),
+            "p90": round(self.get_percentile(90) * scale, 3),
+            "p99": round(self.get_percentile(99) * scale, 3),
+            "max": round(self.max * scale, 3)
+        }
+
+
+class _NullSpan(object):
+    """
+    The span returned while tracing is disabled, which does nothing
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set_arg(self, key, value):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """
+    A timed stage, used as a context manager
+    """
+    __slots__ = ["tracer", "name", "cat", "args", "start_ns", "num_round_trips"]
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start_ns = 0
+        self.num_round_trips = 0
+
+    def __enter__(self):
+        if self.cat == STEP_CATEGORY:
+            self.num_round_trips = self.tracer.num_round_trips
+        self.start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.tracer.add_span(self, time.perf_counter_ns())
+        return False
+
+    def set_arg(self, key, value):
+        if self.args is None:
+            self.args = {}
+        self.args[key] = value
+
+
+class Tracer(object):
+    """
+    Records how long each stage of the exploration takes: the adb/hdc commands, layout receive and parse,
+    state build, UTG update, policy decision, event send, settle wait and artifact I/O.
+    The spans are aggregated into per-stage histograms, with the number of device round trips per step,
+    and written as a Chrome trace (chrome://tracing, ui.perfetto.dev) and a summary when closed.
+    While disabled, a span costs one attribute check.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.enabled = False
+        self.output_dir = None
+        self.lock = threading.Lock()
+        self.events = collections.deque(maxlen=MAX_TRACE_EVENTS)
+        self.histograms = {}
+        self.round_trip_histogram = Histogram()
+        # the number of device round trips since enabled, read at the beginning and end of each step
+        self.num_round_trips = 0
+        self.start_ns = 0
+        self.thread_names = {}
+
+    def enable(self, output_dir=None):
+        """
+        start recording spans
+        :param output_dir: the directory the trace and summary are written to when closed, None not to write them
+        """
+        self.output_dir = output_dir
+        self.start_ns = time.perf_counter_ns()
+        self.enabled = True
+
+    def span(self, name, cat=STAGE_CATEGORY, **args):
+        """
+        time a stage: `with tracer.span("layout parse"): ...`
+        :param name: the name of the stage, the spans of the same name share a histogram
+        :param cat: the category of the stage, DEVICE_CATEGORY for the round trips with the device
+        :param args: shown with the span in the trace
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, cat, args or None)
+
+    def step(self, step_id=None):
+        """
+        time one step of the exploration, counting the device round trips in it
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, "step", STEP_CATEGORY, {"step": step_id} if step_id is not None else None)
+
+    def add_span(self, span, end_ns):
+        duration_ns = end_ns - span.start_ns
+        thread = threading.current_thread()
+        with self.lock:
+            if span.cat == DEVICE_CATEGORY:
+                self.num_round_trips += 1
+            elif span.cat == STEP_CATEGORY:
+                num_round_trips = self.num_round_trips - span.num_round_trips
+                self.round_trip_histogram.add(num_round_trips)
+                span.set_arg("round_trips", num_round_trips)
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = (span.cat, Histogram())
+            histogram[1].add(duration_ns / 1000.0)
+            if thread.ident not in self.thread_names:
+                self.thread_names[thread.ident] = thread.name
+            event = {
+                "name": span.name,
+                "cat": span.cat,
+                "ph": "X",
+                "ts": (span.start_ns - self.start_ns) / 1000.0,
+                "dur": duration_ns / 1000.0,
+                "pid": os.getpid(),
+                "tid": thread.ident
+            }
+            if span.args:
+                event["args"] = span.args
+            self.events.append(event)
+
+    def get_summary(self):
+        """
+        :return: dict, the histograms of the stages in ms and of the device round trips per step
+        """
+        with self.lock:
+            stages = {}
+            for name, (cat, histogram) in sorted(self.histograms.items(), key=lambda x: -x[1][1].total):
+                stage = histogram.to_dict(scale=0.001)
+                stage["category"] = cat
+                stages[name] = stage
+            return {
+                "unit": "ms",
+                "stages": stages,
+                ROUND_TRIPS_STAT_NAME: self.round_trip_histogram.to_dict()
+            }
+
+    def close(self):
+        """
+        stop recording, write the trace and the summary, and log the slowest stages
+        """
+        if not self.enabled:
+            return
+        self.enabled = False
+        summary = self.get_summary()
+        for name, stage in list(summary["stages"].items())[:10]:
+            self.logger.info("%s: %d x %.1fms (p90 %.1fms, total %.1fs)" %
+                             (name, stage["count"], stage["mean"], stage["p90"], stage["total"] / 1000))
+        round_trips = summary[ROUND_TRIPS_STAT_NAME]
+        if round_trips["count"]:
+            self.logger.info("%s: %.1f on average, %d at most" %
+                             (ROUND_TRIPS_STAT_NAME, round_trips["mean"], round_trips["max"]))
+        if self.output_dir is None:
+            return
+        try:
+            with self.lock:
+                trace_events = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                                 "args": {"name": thread_name}} for tid, thread_name in self.thread_names.items()]
+                trace_events.extend(self.events)
+            with open(os.path.join(self.output_dir, TRACE_FILE_NAME), "w") as f:
+                json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+            with open(os.path.join(self.output_dir, TRACE_SUMMARY_FILE_NAME), "w") as f:
+                json.dump(summary, f, indent=2)
+        except Exception as e:
+            self.logger.warning("Saving the trace failed: %s" % e)
+
+
+# the tracer of the run, enabled by DroidBot
+tracer = Tracer()
+
+
+def traced(name, cat=STAGE_CATEGORY):
+    """
+    decorator timing each call of a function as a span of the tracer
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with Span(tracer, name, cat, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_argv_class(args):
+    """
+    the class of a command in the trace, e.g. "shell screencap" for ["shell", "screencap", "-p", path]
+    :param args: list of the arguments after the adb/hdc executable and serial
+    """
+    words = " ".join(str(arg) for arg in args).split()
+    if not words:
+        return ""
+    if words[0] in ("shell", "file") and len(words) > 1:
+        return "%s %s" % (words[0], os.path.basename(words[1].strip("'\"")))
+    return words[0]
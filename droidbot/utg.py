@@ -3,8 +3,14 @@ import json
 import os
 import random
 import datetime
+import collections
 import networkx as nx
 
+from .state_store import StateStore, StateCluster
+from .state_index import MinHashLSHIndex
+from .utg_db import UTGDatabase
+from .tracer import traced, IO_CATEGORY
+
 import typing
 if typing.TYPE_CHECKING:
     from .device_state import DeviceState
@@ -14,35 +20,66 @@ if typing.TYPE_CHECKING:
     from .app import App
     from .app_hm import AppHM
 
+# Max number of recent transitions kept in memory
+MAX_RECENT_TRANSITIONS = 100
+# Cost in seconds assumed for an event type that has not been measured yet
+DEFAULT_EVENT_COST = 1.0
+# Cost in seconds assumed for killing and cold-starting the app before it has been measured
+DEFAULT_RESTART_COST = 5.0
+# Jaccard similarity of the content-free view signatures above which structures are merged into one G2 cluster,
+# None or 1.0 to only cluster states with the same structure_str
+NEAR_DUPLICATE_THRESHOLD = 0.9
+
 
 class UTG(object):
     """
     UI transition graph
     """
 
-    def __init__(self, device:typing.Union["Device", "DeviceHM"], app:typing.Union["App", "AppHM"], random_input):
+    def __init__(self, device:typing.Union["Device", "DeviceHM"], app:typing.Union["App", "AppHM"], random_input,
+                 near_duplicate_threshold=NEAR_DUPLICATE_THRESHOLD):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.device = device
         self.app = app
         self.random_input = random_input
 
         self.G = nx.DiGraph()
-        self.G2 = nx.DiGraph()  # graph with same-structure states clustered
-
-        self.transitions = []
-        self.effective_event_strs = set()
-        self.ineffective_event_strs = set()
+        self.G2 = nx.DiGraph()  # graph with same-structure or near-duplicate states clustered
+        self.near_duplicate_threshold = None
+        self.structure_clusters = {}  # structure_str -> cluster_str, the key of the G2 node
+        self.structure_indexes = {}  # (foreground_activity, pagePath) -> MinHashLSHIndex of structures
+        self.set_near_duplicate_threshold(near_duplicate_threshold)
+        self.db = None
+        if device.output_dir is not None:
+            self.db = UTGDatabase(UTGDatabase.get_db_path(device.output_dir))
+        self.state_store = StateStore(device=device, db=self.db)
+
+        self.transitions = collections.deque(maxlen=MAX_RECENT_TRANSITIONS)
+        self.__num_transitions = 0
+        # explored events are identified by their compact keys, see InputEvent.get_event_key
+        self.effective_event_keys = set()
+        self.ineffective_event_keys = set()
+        # keys of the events explored in each cluster of near-identical states
+        self.explored_cluster_event_keys = set()
         self.explored_state_strs = set()
         self.reached_state_strs = set()
         self.reached_activities = set()
         self.num_input_events:int = 0
 
+        # measured wall-clock cost and outcome of the events, used to weight navigation
+        self.event_attempts = collections.Counter()  # event_key -> number of times the event was sent
+        self.event_type_costs = {}  # event_type -> (total cost, number of measurements)
+
         # if it's harmonyOS, record the reached pages
         if self.device.is_harmonyos:
             self.reached_pages = set()
 
         self.first_state = None
         self.last_state = None
+        # the last transition starting the app: (state_str before, start intent event, launch state_str),
+        # where a restart lands
+        self.launch_transition = None
+        self.start_intent_cmd = None
 
         self.start_time = datetime.datetime.now()
 
@@ -56,13 +93,87 @@ class UTG(object):
 
     @property
     def effective_event_count(self):
-        return len(self.effective_event_strs)
+        return len(self.effective_event_keys)
 
     @property
     def num_transitions(self):
-        return len(self.transitions)
+        return self.__num_transitions
+
+    def get_state(self, state_str) -> "DeviceState":
+        """
+        get a known state by its state_str, loading it from the state store if needed
+        """
+        return self.state_store.get(state_str)
+
+    def get_expected_next_state(self, state:"DeviceState", event:"InputEvent"):
+        """
+        predict the state an event leads to, from what the event did before in the state
+        :return: DeviceState, or None if the event has not been tried in the state
+        """
+        if state.state_str not in self.G.nodes():
+            return None
+        event_key = event.get_event_key(state)
+        if event_key in self.ineffective_event_keys:
+            return state
+        best_state_str, best_num_hits = None, 0
+        for to_state_str, edge in self.G[state.state_str].items():
+            event_info = edge["events"].get(event_key)
+            if event_info is not None and event_info["num_hits"] > best_num_hits:
+                best_state_str, best_num_hits = to_state_str, event_info["num_hits"]
+        return self.get_state(best_state_str) if best_state_str is not None else None
+
+    def set_near_duplicate_threshold(self, threshold):
+        """
+        set the similarity above which structures are merged into one G2 cluster, before any state is added
+        :param threshold: float, None or at least 1.0 to disable merging
+        """
+        if self.structure_clusters:
+            self.logger.warning("The near-duplicate threshold cannot be changed once states are clustered.")
+            return
+        self.near_duplicate_threshold = threshold if threshold is not None and threshold < 1.0 else None
 
-    def add_transition(self, event:"InputEvent", old_state:"DeviceState", new_state:"DeviceState"):
+    def get_cluster_str(self, state:"DeviceState"):
+        """
+        get the key of the G2 node of a state, i.e. the structure_str of the first structure in its cluster
+        """
+        return self.structure_clusters.get(state.structure_str, state.structure_str)
+
+    def get_similar_structure_strs(self, state:"DeviceState", threshold=None):
+        """
+        find the known structures near-identical to the structure of a state
+        :param threshold: min Jaccard similarity, near_duplicate_threshold by default
+        :return: list of (structure_str, similarity), the most similar first
+        """
+        index = self.structure_indexes.get((state.foreground_activity, state.pagePath))
+        if index is None:
+            return []
+        if threshold is None:
+            threshold = self.near_duplicate_threshold if self.near_duplicate_threshold is not None else 1.0
+        return index.query(state.get_content_free_view_signatures(), threshold=threshold)
+
+    def __assign_cluster(self, state:"DeviceState"):
+        if state.structure_str in self.structure_clusters:
+            return
+        cluster_str = state.structure_str
+        if self.near_duplicate_threshold is not None:
+            partition = (state.foreground_activity, state.pagePath)
+            if partition not in self.structure_indexes:
+                self.structure_indexes[partition] = MinHashLSHIndex(threshold=self.near_duplicate_threshold)
+            index = self.structure_indexes[partition]
+            view_signatures = state.get_content_free_view_signatures()
+            similar_structure_strs = index.query(view_signatures)
+            if similar_structure_strs:
+                cluster_str = self.structure_clusters[similar_structure_strs[0][0]]
+                self.logger.debug("Structure %s merged into cluster %s (similarity %.2f)"
+                                  % (state.structure_str, cluster_str, similar_structure_strs[0][1]))
+            index.add(state.structure_str, view_signatures)
+        self.structure_clusters[state.structure_str] = cluster_str
+
+    @traced("utg update")
+    def add_transition(self, event:"InputEvent", old_state:"DeviceState", new_state:"DeviceState", cost=None):
+        """
+        :param cost: measured wall-clock seconds from sending the event to getting new_state, None if unknown
+        """
         self.add_node(old_state)
         self.add_node(new_state)
 
@@ -70,34 +181,65 @@ class UTG(object):
         if not old_state or not new_state:
             return
 
-        event_str = event.get_event_str(old_state)
-        self.transitions.append((old_state, event, new_state))
+        event_key = event.get_event_key(old_state)
+        self.transitions.append((old_state.state_str, event_key, new_state.state_str))
+        self.__num_transitions += 1
+        self.event_attempts[event_key] += 1
+        cluster_event_key = event.get_event_key(old_state, self.get_cluster_str(old_state))
+        self.explored_cluster_event_keys.add(cluster_event_key)
+        if cost is not None:
+            total_cost, num_costs = self.event_type_costs.get(event.event_type, (0.0, 0))
+            self.event_type_costs[event.event_type] = (total_cost + cost, num_costs + 1)
 
         if old_state.state_str == new_state.state_str:
-            self.ineffective_event_strs.add(event_str)
+            self.ineffective_event_keys.add(event_key)
             # delete the transitions including the event from utg
             for new_state_str in self.G[old_state.state_str]:
-                if event_str in self.G[old_state.state_str][new_state_str]["events"]:
-                    self.G[old_state.state_str][new_state_str]["events"].pop(event_str)
-            if event_str in self.effective_event_strs:
-                self.effective_event_strs.remove(event_str)
+                if event_key in self.G[old_state.state_str][new_state_str]["events"]:
+                    self.G[old_state.state_str][new_state_str]["events"].pop(event_key)
+            if event_key in self.effective_event_keys:
+                self.effective_event_keys.remove(event_key)
+            if self.db is not None:
+                self.db.add_ineffective_event(old_state.state_str, event_key, cluster_event_key)
             return
 
-        self.effective_event_strs.add(event_str)
+        self.effective_event_keys.add(event_key)
+        if self.is_start_intent(event):
+            self.launch_transition = (old_state.state_str, event, new_state.state_str)
 
         if (old_state.state_str, new_state.state_str) not in self.G.edges():
             self.G.add_edge(old_state.state_str, new_state.state_str, events={})
-        self.G[old_state.state_str][new_state.state_str]["events"][event_str] = {
-            "event": event,
-            "id": self.effective_event_count
-        }
-
-        if (old_state.structure_str, new_state.structure_str) not in self.G2.edges():
-            self.G2.add_edge(old_state.structure_str, new_state.structure_str, events={})
-        self.G2[old_state.structure_str][new_state.structure_str]["events"][event_str] = {
-            "event": event,
-            "id": self.effective_event_count
-        }
+        edge_events = self.G[old_state.state_str][new_state.state_str]["events"]
+        if event_key in edge_events:
+            event_info = edge_events[event_key]
+        else:
+            # the readable event str is only kept for the report
+            event_info = {
+                "event": event,
+                "event_str": event.get_event_str(old_state),
+                "id": self.effective_event_count,
+                "cost": None,
+                "num_hits": 0
+            }
+            edge_events[event_key] = event_info
+        event_info["num_hits"] += 1
+        if cost is not None:
+            # running mean of the measured cost
+            if event_info["cost"] is None:
+                event_info["cost"] = cost
+            else:
+                event_info["cost"] += (cost - event_info["cost"]) / event_info["num_hits"]
+
+        old_cluster_str = self.get_cluster_str(old_state)
+        new_cluster_str = self.get_cluster_str(new_state)
+        if (old_cluster_str, new_cluster_str) not in self.G2.edges():
+            self.G2.add_edge(old_cluster_str, new_cluster_str, events={})
+        self.G2[old_cluster_str][new_cluster_str]["events"][event_key] = event_info
+
+        if self.db is not None:
+            self.db.add_transition(old_state.state_str, new_state.state_str, event_key, event_info["event_str"],
+                                   event_info["id"], event, event_info["cost"], event_info["num_hits"],
+                                   cluster_event_key)
 
         self.last_state = new_state
 
@@ -108,38 +250,152 @@ class UTG(object):
             self.__output_utg()
 
     def remove_transition(self, event:"InputEvent", old_state:"DeviceState", new_state:"DeviceState"):
-        event_str = event.get_event_str(old_state)
+        event_key = event.get_event_key(old_state)
         if (old_state.state_str, new_state.state_str) in self.G.edges():
             events = self.G[old_state.state_str][new_state.state_str]["events"]
-            if event_str in events.keys():
-                events.pop(event_str)
+            if event_key in events.keys():
+                events.pop(event_key)
             if len(events) == 0:
                 self.G.remove_edge(old_state.state_str, new_state.state_str)
-        if (old_state.structure_str, new_state.structure_str) in self.G2.edges():
-            events = self.G2[old_state.structure_str][new_state.structure_str]["events"]
-            if event_str in events.keys():
-                events.pop(event_str)
+        old_cluster_str = self.get_cluster_str(old_state)
+        new_cluster_str = self.get_cluster_str(new_state)
+        if (old_cluster_str, new_cluster_str) in self.G2.edges():
+            events = self.G2[old_cluster_str][new_cluster_str]["events"]
+            if event_key in events.keys():
+                events.pop(event_key)
             if len(events) == 0:
-                self.G2.remove_edge(old_state.structure_str, new_state.structure_str)
+                self.G2.remove_edge(old_cluster_str, new_cluster_str)
+        if self.db is not None:
+            self.db.remove_transition(old_state.state_str, new_state.state_str, event_key)
 
     def add_node(self, state:"DeviceState"):
         if not state:
             return
         if state.state_str not in self.G.nodes():
             state.save2dir()
-            self.G.add_node(state.state_str, state=state)
-            if self.first_state is None:
-                self.first_state = state
+            if self.db is not None:
+                self.db.add_state(state)
+            self.__add_new_node(state)
+        else:
+            self.state_store.add(state)
+
+        self.__update_reached(state)
+
+    def __add_new_node(self, state:"DeviceState"):
+        self.__assign_cluster(state)
+        cluster_str = self.get_cluster_str(state)
+        self.G.add_node(state.state_str, summary=self.state_store.add(state, cluster_str))
+        if self.first_state is None:
+            self.first_state = state
+            if self.db is not None:
+                self.db.set_meta("first_state_str", state.state_str)
 
-        if state.structure_str not in self.G2.nodes():
-            self.G2.add_node(state.structure_str, states=[])
-        self.G2.nodes[state.structure_str]['states'].append(state)
+        if cluster_str not in self.G2.nodes():
+            self.G2.add_node(cluster_str, states=StateCluster())
+        self.G2.nodes[cluster_str]['states'].add(state.state_str)
 
+    def __update_reached(self, state:"DeviceState"):
         if state.foreground_activity:
             if state.foreground_activity.startswith(self.app.package_name):
                 self.reached_activities.add(state.foreground_activity)
                 self.reached_pages.add(state.pagePath)
 
+    def resume(self, resume_dir):
+        """
+        Rebuild the UTG recorded in the database of a previous run,
+        so that a killed or interrupted run can continue from its frontier.
+        :param resume_dir: the output dir of the previous run
+        """
+        from .device_state import DeviceState
+        from .input_event import InputEvent, get_event_str_key
+
+        db_path = UTGDatabase.get_db_path(resume_dir)
+        if not os.path.exists(db_path):
+            self.logger.warning("No UTG database found in %s, starting from scratch." % resume_dir)
+            return
+        if self.db is not None and os.path.abspath(db_path) == os.path.abspath(self.db.db_path):
+            resume_db = self.db
+        else:
+            resume_db = UTGDatabase(db_path)
+        # copy the records to the current database if resuming into another output dir
+        copy_to_db = self.db if resume_db is not self.db else None
+
+        for state_dict in resume_db.get_state_dicts():
+            state = DeviceState.from_dict(self.device, state_dict,
+                                          screenshot_path=state_dict.get("screenshot_path"))
+            if state.state_str in self.G.nodes():
+                continue
+            if copy_to_db is not None:
+                state.save2dir()
+                copy_to_db.add_state(state)
+            self.__add_new_node(state)
+            self.__update_reached(state)
+
+        first_state_str = resume_db.get_meta("first_state_str")
+        if first_state_str in self.G.nodes():
+            self.first_state = self.get_state(first_state_str)
+            if copy_to_db is not None:
+                copy_to_db.set_meta("first_state_str", first_state_str)
+
+        effective_event_keys, ineffective_event_keys = resume_db.get_explored_events()
+        self.effective_event_keys.update(effective_event_keys)
+        self.ineffective_event_keys.update(ineffective_event_keys)
+        if copy_to_db is not None:
+            copy_to_db.add_explored_events(effective_event_keys, True)
+            copy_to_db.add_explored_events(ineffective_event_keys, False)
+        # the events explored in near-identical states, so that they are not explored again after resuming
+        explored_cluster_event_keys = resume_db.get_explored_cluster_event_keys()
+        self.explored_cluster_event_keys.update(explored_cluster_event_keys)
+        if copy_to_db is not None:
+            copy_to_db.add_explored_cluster_events(explored_cluster_event_keys)
+
+        num_edges = 0
+        for from_state_str, to_state_str, event_key, event_str, event_id, event_dict, cost, num_hits \
+                in resume_db.get_transitions():
+            if from_state_str not in self.G.nodes() or to_state_str not in self.G.nodes():
+                continue
+            event = InputEvent.from_dict(event_dict)
+            if event is None:
+                continue
+            event_info = {"event": event, "event_str": event_str, "id": event_id, "cost": cost, "num_hits": num_hits}
+            self.event_attempts[event_key] += num_hits
+            if self.is_start_intent(event):
+                self.launch_transition = (from_state_str, event, to_state_str)
+            if (from_state_str, to_state_str) not in self.G.edges():
+                self.G.add_edge(from_state_str, to_state_str, events={})
+            self.G[from_state_str][to_state_str]["events"][event_key] = event_info
+            from_cluster_str = self.get_cluster_str(self.G.nodes[from_state_str]["summary"])
+            to_cluster_str = self.get_cluster_str(self.G.nodes[to_state_str]["summary"])
+            if (from_cluster_str, to_cluster_str) not in self.G2.edges():
+                self.G2.add_edge(from_cluster_str, to_cluster_str, events={})
+            self.G2[from_cluster_str][to_cluster_str]["events"][event_key] = event_info
+            # databases written before the cluster keys were recorded only have them for the transitions
+            cluster_event_key = get_event_str_key(event_str.replace(from_state_str, from_cluster_str))
+            self.explored_cluster_event_keys.add(cluster_event_key)
+            if copy_to_db is not None:
+                copy_to_db.add_transition(from_state_str, to_state_str, event_key, event_str, event_id, event,
+                                          cost, num_hits, cluster_event_key)
+            num_edges += 1
+
+        if resume_db is not self.db:
+            resume_db.close()
+
+        # recompute the frontier from the rebuilt graph
+        num_frontier_states = 0
+        for state_str in self.G.nodes():
+            if not self.is_state_explored(self.G.nodes[state_str]["summary"]):
+                num_frontier_states += 1
+        self.logger.info("Resumed UTG from %s: %d states, %d transitions, %d explored events, %d frontier states."
+                         % (resume_dir, len(self.G.nodes()), num_edges,
+                            len(self.effective_event_keys) + len(self.ineffective_event_keys), num_frontier_states))
+
+    def __get_node_image(self, screenshot_path):
+        # the graph of the report loads faster with thumbnails
+        image_store = self.device.image_store
+        thumbnail_path = image_store.get_thumbnail_path(screenshot_path) if image_store is not None else None
+        return os.path.relpath(thumbnail_path or screenshot_path, self.device.output_dir)
+
+    @traced("utg output", IO_CATEGORY)
     def __output_utg(self):
         """
         Output current UTG to a js file
@@ -159,7 +415,7 @@ class UTG(object):
         utg_nodes = []
         utg_edges = []
         for state_str in self.G.nodes():
-            state:"DeviceState" = self.G.nodes[state_str]["state"]
+            state = self.G.nodes[state_str]["summary"]
             package_name = state.foreground_activity.split("/")[0] if state.foreground_activity else ""
             activity_name = state.foreground_activity.split("/")[1] if state.foreground_activity else ""
             short_activity_name = activity_name.split(".")[-1] if activity_name else ""
@@ -174,7 +430,8 @@ class UTG(object):
             utg_node = {
                 "id": state_str,
                 "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+                "image": self.__get_node_image(state.screenshot_path),
+                "screenshot": os.path.relpath(state.screenshot_path, self.device.output_dir),
                 "label": short_activity_name,
                 # "group": state.foreground_activity,
                 "package": package_name,
@@ -203,8 +460,8 @@ class UTG(object):
             event_short_descs = []
             event_list = []
 
-            for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
-                event_short_descs.append((event_info["id"], event_str))
+            for event_info in sorted(events.values(), key=lambda x: x["id"]):
+                event_short_descs.append((event_info["id"], event_info["event_str"]))
                 
                 if not self.device.is_harmonyos:
                     if self.device.adapters[self.device.minicap]:
@@ -217,7 +474,7 @@ class UTG(object):
                     view_images = ["views/view_" + view["view_str"] + ".jpeg"
                                     for view in event_info["event"].get_views()]
                 event_list.append({
-                    "event_str": event_str,
+                    "event_str": event_info["event_str"],
                     "event_id": event_info["id"],
                     "event_type": event_info["event"].event_type,
                     "view_images": view_images
@@ -244,7 +501,7 @@ class UTG(object):
 
             "num_nodes": len(utg_nodes),
             "num_edges": len(utg_edges),
-            "num_effective_events": len(self.effective_event_strs),
+            "num_effective_events": len(self.effective_event_keys),
             "num_reached_activities": len(self.reached_activities),
             "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
             "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
@@ -265,6 +522,7 @@ class UTG(object):
         utg_file.write(utg_json)
         utg_file.close()
     
+    @traced("utg output", IO_CATEGORY)
     def __output_utg_hm(self):
         """
         Output current UTG to a js file
@@ -284,7 +542,7 @@ class UTG(object):
         utg_nodes = []
         utg_edges = []
         for state_str in self.G.nodes():
-            state:"DeviceState" = self.G.nodes[state_str]["state"]
+            state = self.G.nodes[state_str]["summary"]
             bundle_name = state.foreground_activity.split("/")[0] if state.foreground_activity else ""
             ability_name = state.foreground_activity.split("/")[1] if state.foreground_activity else ""
             short_ability_name = ability_name.split(".")[-1] if ability_name else ""
@@ -301,7 +559,8 @@ class UTG(object):
             utg_node = {
                 "id": state_str,
                 "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+                "image": self.__get_node_image(state.screenshot_path),
+                "screenshot": os.path.relpath(state.screenshot_path, self.device.output_dir),
                 "label": short_ability_name,
                 # "group": state.foreground_activity,
                 "package": bundle_name,
@@ -330,8 +589,8 @@ class UTG(object):
             event_short_descs = []
             event_list = []
 
-            for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
-                event_short_descs.append((event_info["id"], event_str))
+            for event_info in sorted(events.values(), key=lambda x: x["id"]):
+                event_short_descs.append((event_info["id"], event_info["event_str"]))
                 
                 if not self.device.is_harmonyos:
                     if self.device.adapters[self.device.minicap]:
@@ -344,7 +603,7 @@ class UTG(object):
                     view_images = ["views/view_" + view["view_str"] + ".jpeg"
                                     for view in event_info["event"].get_views()]
                 event_list.append({
-                    "event_str": event_str,
+                    "event_str": event_info["event_str"],
                     "event_id": event_info["id"],
                     "event_type": event_info["event"].event_type,
                     "view_images": view_images
@@ -371,7 +630,7 @@ class UTG(object):
 
             "num_nodes": len(utg_nodes),
             "num_edges": len(utg_edges),
-            "num_effective_events": len(self.effective_event_strs),
+            "num_effective_events": len(self.effective_event_keys),
             "num_reached_abilities": len(self.reached_activities),
             "num_reached_pages": len(self.reached_pages),
             "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -395,15 +654,29 @@ class UTG(object):
         utg_file.write(utg_json)
         utg_file.close()
 
+    def __is_event_key_explored(self, event_key, cluster_event_key):
+        return event_key in self.effective_event_keys or event_key in self.ineffective_event_keys \
+            or cluster_event_key in self.explored_cluster_event_keys
+
     def is_event_explored(self, event:"InputEvent", state:"DeviceState"):
-        event_str = event.get_event_str(state)
-        return event_str in self.effective_event_strs or event_str in self.ineffective_event_strs
+        """
+        check whether an event has been tried in the state, or in a near-identical state
+        """
+        return self.__is_event_key_explored(event.get_event_key(state),
+                                            event.get_event_key(state, self.get_cluster_str(state)))
 
     def is_state_explored(self, state:"DeviceState"):
         if state.state_str in self.explored_state_strs:
             return True
-        for possible_event in state.get_possible_input():
-            if not self.is_event_explored(possible_event, state):
+        summary = self.state_store.get_summary(state.state_str)
+        if summary is not None:
+            possible_event_keys = zip(summary.possible_event_keys, summary.possible_cluster_event_keys)
+        else:
+            cluster_str = self.get_cluster_str(state)
+            possible_event_keys = [(event.get_event_key(state), event.get_event_key(state, cluster_str))
+                                   for event in state.get_possible_input()]
+        for event_key, cluster_event_key in possible_event_keys:
+            if not self.__is_event_key_explored(event_key, cluster_event_key):
                 return False
         self.explored_state_strs.add(state.state_str)
         return True
@@ -415,30 +688,89 @@ class UTG(object):
         return False
 
     def get_reachable_states(self, current_state:"DeviceState"):
+        """
+        get the summaries of the states reachable from current_state
+        use get_state to load a full state when its views are needed
+        """
         reachable_states = []
         for target_state_str in nx.descendants(self.G, current_state.state_str):
-            target_state = self.G.nodes[target_state_str]["state"]
+            target_state = self.G.nodes[target_state_str]["summary"]
             reachable_states.append(target_state)
         return reachable_states
 
+    def get_event_type_cost(self, event_type):
+        """
+        get the mean measured cost of an event type
+        """
+        if event_type not in self.event_type_costs:
+            return DEFAULT_EVENT_COST
+        total_cost, num_costs = self.event_type_costs[event_type]
+        return total_cost / num_costs
+
+    def get_event_cost(self, event_key, event_info):
+        """
+        get the expected cost of taking an edge event, i.e. its mean cost divided by its success rate
+        :param event_key: the key of the event
+        :param event_info: the event info stored in the edge
+        """
+        cost = event_info["cost"]
+        if cost is None:
+            cost = self.get_event_type_cost(event_info["event"].event_type)
+        num_hits = event_info["num_hits"]
+        num_attempts = max(self.event_attempts[event_key], num_hits, 1)
+        return cost * num_attempts / max(num_hits, 1)
+
+    def get_restart_cost(self):
+        """
+        get the cost of killing the app and starting it again
+        """
+        from .input_event import KEY_KillAppEvent, KEY_IntentEvent
+        if KEY_KillAppEvent not in self.event_type_costs or KEY_IntentEvent not in self.event_type_costs:
+            return DEFAULT_RESTART_COST
+        return self.get_event_type_cost(KEY_KillAppEvent) + self.get_event_type_cost(KEY_IntentEvent)
+
+    def is_start_intent(self, event:"InputEvent"):
+        """
+        whether an event is the intent starting the app
+        """
+        from .input_event import KEY_IntentEvent
+        if event.event_type != KEY_IntentEvent:
+            return False
+        if self.start_intent_cmd is None:
+            self.start_intent_cmd = self.app.get_start_intent().get_cmd()
+        return event.intent == self.start_intent_cmd
+
+    def __get_cheapest_event_key(self, edge):
+        edge_event_keys = list(edge["events"].keys())
+        if self.random_input:
+            random.shuffle(edge_event_keys)
+        return min(edge_event_keys, key=lambda event_key: self.get_event_cost(event_key, edge["events"][event_key]))
+
+    def __edge_weight(self, u, v, edge):
+        if not edge["events"]:
+            # hide the edges without events
+            return None
+        return min(self.get_event_cost(event_key, event_info) for event_key, event_info in edge["events"].items())
+
     def get_navigation_steps(self, from_state:"DeviceState", to_state:"DeviceState"):
+        """
+        get the (state summary, event) steps of the cheapest path between two states
+        """
         if from_state is None or to_state is None:
             return None
         try:
             steps = []
             from_state_str = from_state.state_str
             to_state_str = to_state.state_str
-            state_strs = nx.shortest_path(G=self.G, source=from_state_str, target=to_state_str)
+            state_strs = nx.dijkstra_path(G=self.G, source=from_state_str, target=to_state_str,
+                                          weight=self.__edge_weight)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 self.logger.warning(f"Error getting path from {from_state_str} to {to_state_str}")
             start_state_str = state_strs[0]
             for state_str in state_strs[1:]:
                 edge = self.G[start_state_str][state_str]
-                edge_event_strs = list(edge["events"].keys())
-                if self.random_input:
-                    random.shuffle(edge_event_strs)
-                start_state = self.G.nodes[start_state_str]['state']
-                event = edge["events"][edge_event_strs[0]]["event"]
+                start_state = self.G.nodes[start_state_str]['summary']
+                event = edge["events"][self.__get_cheapest_event_key(edge)]["event"]
                 steps.append((start_state, event))
                 start_state_str = state_str
             return steps
@@ -461,37 +793,71 @@ class UTG(object):
     #     return simple_nav_steps
 
     def get_G2_nav_steps(self, from_state:"DeviceState", to_state:"DeviceState"):
+        nav_steps, nav_cost = self.__get_G2_nav_steps_and_cost(from_state, to_state)
+        return nav_steps
+
+    def get_cheapest_G2_nav_steps(self, from_state:"DeviceState", to_state:"DeviceState",
+                                  restart_event:"InputEvent"=None, max_steps=None):
+        """
+        get the G2 navigation steps with the lowest expected cost, considering a restart edge
+        from every state to the launch state, i.e. killing the app and starting it, which costs get_restart_cost()
+        :param restart_event: the event to kill the app, None to disable restarting
+        :param max_steps: paths with this number of steps or more are ignored
+        :return: (nav_steps, cost), nav_steps starts with (from_state, restart_event) and the start intent
+                 if restarting is cheaper, (None, None) if the target is not reachable
+        """
+        candidates = []
+        nav_steps, nav_cost = self.__get_G2_nav_steps_and_cost(from_state, to_state)
+        if nav_steps:
+            candidates.append((nav_steps, nav_cost))
+        # a restart edge is only worth taking as the first step, as it leads to the launch state from anywhere
+        if restart_event is not None and self.launch_transition is not None:
+            before_launch_state_str, start_event, launch_state_str = self.launch_transition
+            launch_state = self.get_state(launch_state_str)
+            restart_steps = [(from_state, restart_event), (self.get_state(before_launch_state_str), start_event)]
+            if self.get_cluster_str(launch_state) == self.get_cluster_str(to_state):
+                candidates.append((restart_steps, self.get_restart_cost()))
+            else:
+                nav_steps, nav_cost = self.__get_G2_nav_steps_and_cost(launch_state, to_state)
+                if nav_steps:
+                    candidates.append((restart_steps + nav_steps, self.get_restart_cost() + nav_cost))
+        if max_steps is not None:
+            candidates = [candidate for candidate in candidates if len(candidate[0]) < max_steps]
+        if not candidates:
+            return None, None
+        return min(candidates, key=lambda candidate: candidate[1])
+
+    def __get_G2_nav_steps_and_cost(self, from_state:"DeviceState", to_state:"DeviceState"):
         if from_state is None or to_state is None:
-            return None
-        from_state_str = from_state.structure_str
-        to_state_str = to_state.structure_str
+            return None, None
+        from_state_str = self.get_cluster_str(from_state)
+        to_state_str = self.get_cluster_str(to_state)
         try:
             nav_steps = []
-            state_strs = nx.shortest_path(G=self.G2, source=from_state_str, target=to_state_str)
+            nav_cost, state_strs = nx.single_source_dijkstra(G=self.G2, source=from_state_str, target=to_state_str,
+                                                             weight=self.__edge_weight)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
-                return None
+                return None, None
             start_state_str = state_strs[0]
             for state_str in state_strs[1:]:
                 edge = self.G2[start_state_str][state_str]
-                edge_event_strs = list(edge["events"].keys())
-                start_state = random.choice(self.G2.nodes[start_state_str]['states'])
-                event_str = random.choice(edge_event_strs)
-                event = edge["events"][event_str]["event"]
+                start_state = self.get_state(random.choice(self.G2.nodes[start_state_str]['states'].state_strs))
+                event = edge["events"][self.__get_cheapest_event_key(edge)]["event"]
                 nav_steps.append((start_state, event))
                 start_state_str = state_str
             if nav_steps is None:
-                return None
+                return None, None
             # return nav_steps
             # simplify the path
             simple_nav_steps = []
             last_state, last_action = nav_steps[-1]
             for state, action in nav_steps:
-                if state.structure_str == last_state.structure_str:
+                if self.get_cluster_str(state) == self.get_cluster_str(last_state):
                     simple_nav_steps.append((state, last_action))
                     break
                 simple_nav_steps.append((state, action))
-            return simple_nav_steps
+            return simple_nav_steps, nav_cost
         except Exception as e:
             print(e)
-            return None
+            return None, None
 
@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+import typing
+if typing.TYPE_CHECKING:
+    from .device_state import DeviceState
+    from .input_event import InputEvent
+
+UTG_DB_FILE_NAME = "utg.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS states (
+    state_str TEXT PRIMARY KEY,
+    structure_str TEXT NOT NULL,
+    foreground_activity TEXT,
+    tag TEXT,
+    state_json TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS transitions (
+    from_state_str TEXT NOT NULL,
+    to_state_str TEXT NOT NULL,
+    event_key TEXT NOT NULL,
+    event_str TEXT NOT NULL,
+    event_id INTEGER NOT NULL,
+    event_json TEXT NOT NULL,
+    cost REAL,
+    num_hits INTEGER NOT NULL,
+    PRIMARY KEY (from_state_str, to_state_str, event_key)
+);
+CREATE TABLE IF NOT EXISTS explored_events (
+    event_key TEXT PRIMARY KEY,
+    effective INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS explored_cluster_events (
+    cluster_event_key TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UTGDatabase(object):
+    """
+    Durable copy of a UTG, stored as a SQLite database in the output dir.
+    Every change of the UTG is written in its own transaction, so a killed run loses at most one step.
+    """
+
+    def __init__(self, db_path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    @staticmethod
+    def get_db_path(output_dir):
+        return os.path.join(output_dir, UTG_DB_FILE_NAME)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def add_state(self, state:"DeviceState"):
+        state_dict = state.to_dict()
+        state_dict["screenshot_path"] = state.screenshot_path
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO states VALUES (?, ?, ?, ?, ?)",
+                              (state.state_str, state.structure_str, state.foreground_activity,
+                               state.tag, json.dumps(state_dict)))
+
+    def has_state(self, state_str):
+        with self.lock:
+            row = self.conn.execute("SELECT 1 FROM states WHERE state_str = ?", (state_str,)).fetchone()
+        return row is not None
+
+    def get_state_dict(self, state_str):
+        """
+        get the dict of a state, as produced by DeviceState.to_dict plus its screenshot_path
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT state_json FROM states WHERE state_str = ?", (state_str,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_state_dicts(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT state_json FROM states ORDER BY rowid").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def add_transition(self, from_state_str, to_state_str, event_key, event_str, event_id, event:"InputEvent",
+                       cost=None, num_hits=1, cluster_event_key=None):
+        """
+        record an effective event and the edge it creates, or update the measured cost of the edge
+        :param cluster_event_key: the key of the event in the cluster of its state, see UTG.is_event_explored
+        """
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO transitions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (from_state_str, to_state_str, event_key, event_str, event_id, event.to_json(),
+                               cost, num_hits))
+            self.conn.execute("INSERT OR REPLACE INTO explored_events VALUES (?, 1)", (event_key,))
+            if cluster_event_key is not None:
+                self.conn.execute("INSERT OR IGNORE INTO explored_cluster_events VALUES (?)", (cluster_event_key,))
+
+    def add_ineffective_event(self, from_state_str, event_key, cluster_event_key=None):
+        """
+        record an ineffective event and drop the edges it used to create
+        :param cluster_event_key: the key of the event in the cluster of its state, see UTG.is_event_explored
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM transitions WHERE from_state_str = ? AND event_key = ?",
+                              (from_state_str, event_key))
+            self.conn.execute("INSERT OR REPLACE INTO explored_events VALUES (?, 0)", (event_key,))
+            if cluster_event_key is not None:
+                self.conn.execute("INSERT OR IGNORE INTO explored_cluster_events VALUES (?)", (cluster_event_key,))
+
+    def add_explored_events(self, event_keys, effective):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO explored_events VALUES (?, ?)",
+                                  [(event_key, 1 if effective else 0) for event_key in event_keys])
+
+    def add_explored_cluster_events(self, cluster_event_keys):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO explored_cluster_events VALUES (?)",
+                                  [(cluster_event_key,) for cluster_event_key in cluster_event_keys])
+
+    def remove_transition(self, from_state_str, to_state_str, event_key):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM transitions WHERE from_state_str = ? AND to_state_str = ? AND event_key = ?",
+                              (from_state_str, to_state_str, event_key))
+
+    def get_transitions(self):
+        """
+        :return: list of (from_state_str, to_state_str, event_key, event_str, event_id, event_dict, cost, num_hits),
+                 in the order of event_id
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT from_state_str, to_state_str, event_key, event_str, event_id, event_json, "
+                                     "cost, num_hits FROM transitions ORDER BY event_id").fetchall()
+        return [(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]), row[6], row[7]) for row in rows]
+
+    def get_explored_events(self):
+        """
+        :return: (effective_event_keys, ineffective_event_keys)
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT event_key, effective FROM explored_events").fetchall()
+        effective_event_keys = set(row[0] for row in rows if row[1])
+        ineffective_event_keys = set(row[0] for row in rows if not row[1])
+        return effective_event_keys, ineffective_event_keys
+
+    def get_explored_cluster_event_keys(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT cluster_event_key FROM explored_cluster_events").fetchall()
+        return set(row[0] for row in rows)
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
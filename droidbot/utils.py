@@ -1,6 +1,5 @@
 import re
 import functools
-from datetime import datetime
 import warnings
 import os
 import yaml
@@ -32,19 +31,18 @@ def parse_log(log_msg):
     @param log_msg:
     @return:
     """
-    m = LOGCAT_THREADTIME_RE.match(log_msg)
-    if not m:
+    from .log_parser import split_log_line, parse_log_time
+    fields = split_log_line(log_msg)
+    if fields is None:
         return None
+    log_time, pid, tid, level, tag, content = fields
     log_dict = {}
-    date = m.group("date")
-    time = m.group("time")
-    log_dict["pid"] = m.group("pid")
-    log_dict["tid"] = m.group("tid")
-    log_dict["level"] = m.group("level")
-    log_dict["tag"] = m.group("tag")
-    log_dict["content"] = m.group("content")
-    datetime_str = "%s-%s %s" % (datetime.today().year, date, time)
-    log_dict["datetime"] = datetime.strptime(datetime_str, "%Y-%m-%d %H:%M:%S.%f")
+    log_dict["pid"] = str(pid)
+    log_dict["tid"] = str(tid)
+    log_dict["level"] = level
+    log_dict["tag"] = tag
+    log_dict["content"] = content
+    log_dict["datetime"] = parse_log_time(log_time)
 
     return log_dict
 